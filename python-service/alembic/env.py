@@ -16,6 +16,7 @@ fileConfig(config.config_file_name)
 # for 'autogenerate' support
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
+import app.models  # noqa: F401,E402  (registers the tables on Base.metadata)
 target_metadata = Base.metadata
 
 # other values from the config, defined by the needs of env.py,
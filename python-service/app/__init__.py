@@ -1,14 +1,4 @@
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
-from app.config import SQLALCHEMY_DATABASE_URI
-
-db = SQLAlchemy()
-
 def create_app():
-    app = Flask(__name__)
-    app.config["SQLALCHEMY_DATABASE_URI"] = SQLALCHEMY_DATABASE_URI
-    db.init_app(app)
-    Migrate(app, db)
-
-    return app
+    # Lets `flask --app app` find the single application factory in app.main
+    from app.main import create_app as _create_app
+    return _create_app()
@@ -0,0 +1,416 @@
+import asyncio
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from urllib.parse import parse_qsl
+from sqlalchemy import select
+from app.main import create_app
+from app.async_database import AsyncSessionLocal, async_engine, dispose_engines, read_sessionmaker
+from app.changes import EVENT_STREAM_MIMETYPE, change_bus, poll_changes_async, stream_changes_async
+from app.cache import DEPARTMENTS_KEY, department_tests_key, range_cache, user_tests_key
+from app.compression import choose_codec, is_compressible, should_compress, weaken_etag
+from app.conditional import etag_matches, make_etag, validator_headers, version_query
+from app.config import ASGI_ADMISSION_THREADS, ASGI_SYNC_THREADS, CHANGES_MAX_WAIT_SECONDS, METRICS_ENABLED
+from app.metrics import begin_request, instrument_engine, metrics
+from app.models import ReferenceRange, Department
+from app.pagination import NDJSON_MIMETYPE, encode_cursor, keyset_query, parse_page_args
+from app import ratelimit
+from app.ratelimit import rate_limit_headers
+from app.serializers import department_serializer, dumps, reference_range_serializer
+from app.tokens import decode_token, revocations
+
+# ASGI deployment mode: `uvicorn app.asgi:app`.
+#
+# The read-heavy GET routes are served natively on the async engine, and
+# the change feed natively on the loop, where open streams and long polls
+# hold no thread. Every other request (writes, /auth, NDJSON streams, and
+# anything whose token does not verify) is handed to the unchanged Flask
+# app on a thread pool, so routes, payloads and error responses stay
+# identical to sync mode.
+# Native routes pass the same admission control (rate limits and the
+# concurrency cap) as the Flask hooks, and read from the same place:
+# reference ranges from a replica chosen by the shared SessionRouter
+# (read-your-writes included), departments from the primary.
+
+class ThreadPoolWsgiToAsgi:
+    # Runs a WSGI app for ASGI requests on a bounded thread pool of its own.
+    # asgiref's WsgiToAsgi runs with thread_sensitive=True, which serializes
+    # every request onto one thread, and offers no public way to swap the
+    # executor; this is the small subset of it the Flask fallback needs.
+
+    def __init__(self, wsgi_application, max_threads):
+        self.wsgi_application = wsgi_application
+        self.executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        body = SpooledTemporaryFile(max_size=65536)
+        try:
+            while True:
+                message = await receive()
+                if message['type'] != 'http.request':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, self.run, loop, wsgi_environ(scope, body), send)
+        finally:
+            body.close()
+
+    def run(self, loop, environ, send):
+        # On a pool thread: send() is awaited on the loop, one message at a
+        # time, so a streamed response is written as it is produced
+        def sync_send(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            started['message'] = {
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+            }
+
+        result = self.wsgi_application(environ, start_response)
+        try:
+            for chunk in result:
+                if not started.get('sent'):
+                    started['sent'] = True
+                    sync_send(started['message'])
+                if chunk:
+                    sync_send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not started.get('sent'):
+                sync_send(started['message'])
+            sync_send({'type': 'http.response.body'})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+def wsgi_environ(scope, body):
+    script_name = scope.get('root_path', '').encode('utf8').decode('latin-1')
+    path_info = scope['path'].encode('utf8').decode('latin-1')
+    if path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+            name = f'HTTP_{name}'
+        value = value.decode('latin-1')
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+    return environ
+
+
+class StreamingBody:
+    # A handler result sent chunk by chunk: an async iterator of bytes, its
+    # content type and what to call once the response is over
+
+    def __init__(self, chunks, content_type, on_close=None):
+        self.chunks = chunks
+        self.content_type = content_type
+        self.on_close = on_close
+
+
+class AsyncRequest:
+
+    def __init__(self, scope):
+        self.query_string = scope.get('query_string', b'').decode('latin-1')
+        self.args = dict(parse_qsl(self.query_string))
+        self.headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+        self.read_sessions = None
+
+
+def plain_json(request):
+    # NDJSON streams, the columnar format and as_of reads (served from the
+    # version history) are left to Flask
+    return request.args.get('format') not in ('ndjson', 'columns') \
+        and NDJSON_MIMETYPE not in request.headers.get('accept', '') and 'as_of' not in request.args
+
+
+class AsyncAPI:
+
+    def __init__(self, flask_app, max_threads=ASGI_SYNC_THREADS):
+        self.flask_app = flask_app
+        self.fallback = ThreadPoolWsgiToAsgi(flask_app, max_threads)
+        self.admission_executor = ThreadPoolExecutor(max_workers=ASGI_ADMISSION_THREADS,
+                                                     thread_name_prefix='admission')
+        # (path pattern, Flask rule and endpoint, handler, whether a request
+        # can be served natively). The rule and endpoint label metrics and
+        # pick the rate limit, as they do for the Flask route.
+        self.routes = [
+            (re.compile(r'^/api/tests$'), '/api/tests', 'test_bp.get_user_tests', self.user_tests, plain_json),
+            (re.compile(r'^/api/departments/(\d+)/tests$'), '/api/departments/<int:dept_id>/tests',
+             'test_bp.get_tests_by_department', self.department_tests, plain_json),
+            (re.compile(r'^/api/departments$'), '/api/departments', 'test_bp.get_departments',
+             self.departments, None),
+            (re.compile(r'^/api/tests/changes$'), '/api/tests/changes', 'test_bp.watch_changes',
+             self.changes, None),
+        ]
+        if METRICS_ENABLED:
+            instrument_engine(async_engine.sync_engine)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            for pattern, rule, endpoint, handler, native in self.routes:
+                match = pattern.match(scope['path'])
+                if match is None:
+                    continue
+                started = time.perf_counter()
+                stats = begin_request()
+                if revocations.needs_refresh():
+                    await asyncio.to_thread(revocations.refresh)
+                request = AsyncRequest(scope)
+                if native is not None and not native(request):
+                    break
+                identity = self.identity(request)
+                if identity is None:
+                    break
+                status = await self.serve(receive, send, request, rule, endpoint, handler, identity,
+                                          match.groups())
+                if METRICS_ENABLED:
+                    metrics.observe('GET', rule, status, time.perf_counter() - started, stats)
+                return
+
+        await self.fallback(scope, receive, send)
+
+    def check_rate(self, rule, identity):
+        # Same buckets as the Flask hooks; the app context is for the
+        # store-outage warning
+        with self.flask_app.app_context():
+            return ratelimit.admission.check_rate('GET', rule, 'test_bp', lambda: f'user:{identity}')
+
+    async def admit(self, rule, endpoint, identity):
+        # (rejection, rate limit, holds a slot), as AdmissionControl.admit.
+        # A store round trip may block, so it runs on the admission
+        # executor; the wait for a slot happens on the loop itself. Neither
+        # takes a thread from the default executor that admitted requests
+        # compress and refresh on.
+        admission = ratelimit.admission
+        limit = None
+        if admission.store is not None:
+            loop = asyncio.get_running_loop()
+            retry_after, limit = await loop.run_in_executor(self.admission_executor, self.check_rate, rule, identity)
+            if retry_after is not None:
+                return admission.rate_limited(retry_after), limit, False
+        rejection, slot = await admission.acquire_slot_async(endpoint)
+        return rejection, limit, slot
+
+    async def serve(self, receive, send, request, rule, endpoint, handler, identity, args):
+        admission = ratelimit.admission
+        rejection, limit, slot = None, None, False
+        if admission.enabled:
+            rejection, limit, slot = await self.admit(rule, endpoint, identity)
+        try:
+            if rejection is not None:
+                message, status, retry_after = rejection
+                payload, headers = {"error": message}, {'Retry-After': str(retry_after)}
+            else:
+                payload, status, *rest = await self.dispatch(handler, request, identity, *args)
+                headers = dict(rest[0]) if rest else {}
+            if limit is not None:
+                headers.update(rate_limit_headers(limit))
+            if isinstance(payload, StreamingBody):
+                await self.send_stream(receive, send, payload, status, headers)
+            else:
+                await self.send_json(send, request, payload, status, headers)
+            return status
+        finally:
+            if slot:
+                admission.release_slot()
+
+    def identity(self, request):
+        # Only fully valid tokens take the async path; anything else falls
+        # back to Flask so the JWT error responses stay exactly the same.
+        # Possibly revoked tokens fall back too, where the revocation is
+        # confirmed against the database.
+        header = request.headers.get('authorization', '')
+        if not header.startswith('Bearer '):
+            return None
+        try:
+            with self.flask_app.app_context():
+                claims = decode_token(header[len('Bearer '):])
+                if revocations.might_be_revoked(claims['jti']):
+                    return None
+                return claims[self.flask_app.config['JWT_IDENTITY_CLAIM']]
+        except Exception:
+            return None
+
+    async def dispatch(self, handler, request, *args):
+        try:
+            return await handler(request, *args)
+        except ValueError as ve:
+            return {"error": str(ve)}, 400
+        except Exception as e:
+            return {"error": str(e)}, 400
+
+    async def send_json(self, send, request, payload, status, headers=None):
+        # payload may already be encoded, e.g. a cached body
+        body = payload if isinstance(payload, bytes) else dumps(payload)
+        headers = dict(headers or {})
+        if status not in (204, 304) and is_compressible('application/json', headers):
+            headers['Vary'] = 'Accept-Encoding'
+            codec = choose_codec(request.headers.get('accept-encoding')) if should_compress(len(body)) else None
+            if codec is not None:
+                # Compressing a large body is CPU work; keep it off the event loop
+                body = await asyncio.to_thread(codec.compress, body)
+                headers['Content-Encoding'] = codec.name
+                if 'ETag' in headers:
+                    headers['ETag'] = weaken_etag(headers['ETag'])
+        raw_headers = [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+        raw_headers.extend((name.lower().encode(), value.encode()) for name, value in headers.items())
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': raw_headers
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def send_stream(self, receive, send, body, status, headers):
+        # Sends chunks as they are produced until the body ends or the
+        # client disconnects; body.on_close runs either way
+        raw_headers = [(b'content-type', body.content_type.encode())]
+        raw_headers.extend((name.lower().encode(), value.encode()) for name, value in headers.items())
+
+        async def stream():
+            await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+            async for chunk in body.chunks:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        async def disconnected():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        streaming, watching = asyncio.ensure_future(stream()), asyncio.ensure_future(disconnected())
+        try:
+            await asyncio.wait((streaming, watching), return_when=asyncio.FIRST_COMPLETED)
+            if streaming.done():
+                streaming.result()
+        finally:
+            for task in (streaming, watching):
+                task.cancel()
+            await asyncio.gather(streaming, watching, return_exceptions=True)
+            await body.chunks.aclose()
+            if body.on_close is not None:
+                body.on_close()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await dispose_engines()
+                self.fallback.executor.shutdown(wait=False)
+                self.admission_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _read_sessions(self, request, user_id):
+        # One routing decision per request, like get_read_session(), so the
+        # validators and the rows come from the same database
+        if request.read_sessions is None:
+            request.read_sessions = await read_sessionmaker(user_id)
+        return request.read_sessions
+
+    async def _load_tests(self, sessions, query):
+        async with sessions() as session:
+            return dumps(reference_range_serializer.many(await session.execute(query)))
+
+    async def _validators(self, sessions, variant, **filters):
+        async with sessions() as session:
+            version = tuple((await session.execute(version_query(**filters))).one())
+        etag = make_etag(version, variant)
+        return version, etag, validator_headers(etag, version)
+
+    async def user_tests(self, request, user_id):
+        sessions = await self._read_sessions(request, user_id)
+        version, etag, headers = await self._validators(sessions, f"json:{request.query_string}", created_by=user_id)
+        if etag_matches(request.headers.get('if-none-match'), etag):
+            return b'', 304, headers
+        query = select(*reference_range_serializer.columns).filter_by(created_by=user_id)
+
+        if 'limit' not in request.args and 'cursor' not in request.args:
+            results = await range_cache.get_or_load_async(
+                user_tests_key(user_id), lambda: self._load_tests(sessions, query), version=version
+            )
+            return results, 200, headers
+
+        limit, after_id = parse_page_args(request.args)
+        async with sessions() as session:
+            tests = (await session.execute(keyset_query(query, ReferenceRange.id, after_id).limit(limit + 1))).all()
+        next_cursor = None
+        if len(tests) > limit:
+            tests = tests[:limit]
+            next_cursor = encode_cursor(tests[-1].id)
+        return {"items": reference_range_serializer.many(tests), "next_cursor": next_cursor}, 200, headers
+
+    async def department_tests(self, request, user_id, dept_id):
+        dept_id = int(dept_id)
+        sessions = await self._read_sessions(request, user_id)
+        version, etag, headers = await self._validators(sessions, 'json', department_id=dept_id, created_by=user_id)
+        if etag_matches(request.headers.get('if-none-match'), etag):
+            return b'', 304, headers
+        query = select(*reference_range_serializer.columns).filter_by(department_id=dept_id, created_by=user_id)
+        results = await range_cache.get_or_load_async(
+            department_tests_key(dept_id, user_id), lambda: self._load_tests(sessions, query), version=version
+        )
+        return results, 200, headers
+
+    async def departments(self, request, user_id):
+        async def load():
+            async with AsyncSessionLocal() as session:
+                rows = await session.execute(select(*department_serializer.columns).order_by(Department.name))
+            return dumps(department_serializer.many(rows))
+
+        return await range_cache.get_or_load_async(DEPARTMENTS_KEY, load), 200
+
+    async def changes(self, request, user_id):
+        # watch_changes() on the loop: SSE when the client accepts
+        # text/event-stream, else a long poll
+        try:
+            department_id = int(request.args['department_id']) if request.args.get('department_id') else None
+            last_event_id = request.headers.get('last-event-id') or request.args.get('last_event_id')
+
+            if EVENT_STREAM_MIMETYPE in request.headers.get('accept', ''):
+                if not change_bus.add_subscriber():
+                    return {"error": "Too many open change streams"}, 503, {'Retry-After': '5'}
+                body = StreamingBody(stream_changes_async(user_id, department_id, last_event_id),
+                                     f'{EVENT_STREAM_MIMETYPE}; charset=utf-8', change_bus.remove_subscriber)
+                return body, 200, {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+            wait = min(max(float(request.args.get('wait', 0)), 0.0), CHANGES_MAX_WAIT_SECONDS)
+            return await poll_changes_async(user_id, department_id, last_event_id, wait), 200
+        except ValueError:
+            return {"error": "department_id and wait must be numbers"}, 400
+
+
+app = AsyncAPI(create_app())
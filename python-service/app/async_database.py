@@ -0,0 +1,82 @@
+import asyncio
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from app import database
+from app.config import (
+    DB_URL, ASYNC_DATABASE_URL, DB_ECHO, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_PRE_PING,
+    DB_POOL_RECYCLE, DB_POOL_TIMEOUT, METRICS_ENABLED
+)
+
+# Only imported by the ASGI entry point, so sync workers never build this pool
+
+ASYNC_DRIVERS = {
+    'postgresql': 'asyncpg',
+    'sqlite': 'aiosqlite',
+    'mysql': 'aiomysql',
+}
+
+
+def async_url(url):
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for {backend}; set ASYNC_DATABASE_URL")
+    return url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+
+
+def async_engine_options(url):
+    options = {"echo": DB_ECHO, "pool_pre_ping": DB_POOL_PRE_PING}
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return options
+    options.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_timeout=DB_POOL_TIMEOUT
+    )
+    return options
+
+
+ASYNC_DB_URL = make_url(ASYNC_DATABASE_URL) if ASYNC_DATABASE_URL else async_url(DB_URL)
+
+async_engine = create_async_engine(ASYNC_DB_URL, **async_engine_options(ASYNC_DB_URL))
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# Async engines for the read replicas, created on first use and keyed by the
+# replica's sync engine, which is what the router hands out
+_replica_sessions = {}
+
+
+def replica_sessionmaker(engine):
+    sessions = _replica_sessions.get(engine)
+    if sessions is None:
+        url = async_url(engine.url)
+        replica_engine = create_async_engine(url, **async_engine_options(url))
+        for replica in database.router.replicas:
+            if replica.engine is engine:
+                database.router.watch(replica, replica_engine.sync_engine)
+        if METRICS_ENABLED:
+            from app.metrics import instrument_engine
+            instrument_engine(replica_engine.sync_engine)
+        sessions = _replica_sessions[engine] = async_sessionmaker(
+            replica_engine, autoflush=False, expire_on_commit=False
+        )
+    return sessions
+
+
+async def read_sessionmaker(user_id=None):
+    # The async get_read_session(): a replica's sessionmaker when one is
+    # configured and usable, else AsyncSessionLocal. Choosing can run a
+    # blocking health check, so it happens off the event loop.
+    router = database.router
+    if not router.replicas:
+        return AsyncSessionLocal
+    engine = await asyncio.to_thread(router.replica_for, user_id)
+    return replica_sessionmaker(engine) if engine is not None else AsyncSessionLocal
+
+
+async def dispose_engines():
+    await async_engine.dispose()
+    for sessions in list(_replica_sessions.values()):
+        await sessions.kw['bind'].dispose()
+    _replica_sessions.clear()
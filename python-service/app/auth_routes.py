@@ -1,17 +1,24 @@
 from flask import Blueprint, request, jsonify
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask_jwt_extended import create_access_token
+from flask_jwt_extended import create_access_token, get_jwt, get_jwt_identity, jwt_required
 from app.models import User
-from app.database import SessionLocal
+from app.database import get_session
 from datetime import timedelta
 from app.schemas import RegisterSchema, LoginSchema
+from app.passwords import HashingBusy, password_hasher
+from app.tokens import revocations
 from marshmallow import ValidationError
 
 auth_bp = Blueprint('auth_bp', __name__)
 
+
+def _busy_response(busy):
+    response = jsonify({"error": str(busy)})
+    response.headers['Retry-After'] = str(busy.retry_after)
+    return response, 429
+
 @auth_bp.route('/register', methods=['POST'])
 def register():
-    session = SessionLocal()
+    session = get_session()
     try:
         json_data = request.get_json()
         # Validate input data using RegisterSchema
@@ -23,7 +30,7 @@ def register():
             return jsonify({"error": "User already exists"}), 400
 
         # Hash the password before storing it
-        hashed_password = generate_password_hash(data['password'])
+        hashed_password = password_hasher.hash(data['password'])
         new_user = User(
             email=data['email'],
             password_hash=hashed_password,
@@ -33,18 +40,19 @@ def register():
         session.commit()
         return jsonify({"message": "User registered successfully"}), 201
 
+    except HashingBusy as busy:
+        session.rollback()
+        return _busy_response(busy)
     except ValidationError as ve:
         session.rollback()
         return jsonify({"error": ve.messages}), 400
     except Exception as e:
         session.rollback()
         return jsonify({"error": str(e)}), 400
-    finally:
-        session.close()
 
 @auth_bp.route('/login', methods=['POST'])
 def login():
-    session = SessionLocal()
+    session = get_session()
     try:
         json_data = request.get_json()
         # Validate input using LoginSchema
@@ -52,16 +60,37 @@ def login():
         data = schema.load(json_data)
 
         user = session.query(User).filter_by(email=data['email']).first()
-        if not user or not check_password_hash(user.password_hash, data['password']):
+        if not user or not password_hasher.verify(user.password_hash, data['password']):
             return jsonify({"error": "Invalid email or password"}), 401
 
+        # Upgrade hashes made with an older method or cost while we have the plaintext
+        if password_hasher.needs_rehash(user.password_hash):
+            try:
+                user.password_hash = password_hasher.hash(data['password'])
+                session.commit()
+            except HashingBusy:
+                session.rollback()
+
         # Create a JWT access token (expires in 1 hour)
         access_token = create_access_token(identity=user.id, expires_delta=timedelta(hours=1))
         return jsonify({"access_token": access_token}), 200
 
+    except HashingBusy as busy:
+        return _busy_response(busy)
     except ValidationError as ve:
         return jsonify({"error": ve.messages}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 400
-    finally:
-        session.close()
+
+@auth_bp.route('/logout', methods=['POST'])
+@jwt_required()
+def logout():
+    session = get_session()
+    try:
+        # Revokes this access token everywhere; other workers pick it up on
+        # their next revocation refresh
+        revocations.revoke(session, get_jwt(), get_jwt_identity())
+        return jsonify({"message": "Logged out"}), 200
+    except Exception as e:
+        session.rollback()
+        return jsonify({"error": str(e)}), 400
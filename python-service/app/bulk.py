@@ -0,0 +1,147 @@
+import csv
+import io
+import json
+from datetime import datetime
+from sqlalchemy import delete, func, insert, select, update
+from marshmallow import ValidationError
+from app.config import BULK_INSERT_CHUNK_SIZE, BULK_MAX_ROWS
+from app.models import ReferenceRange
+from app.schemas import ReferenceRangeSchema
+from app.units import CONVERSION_INPUTS, canonical_range, refresh_canonical
+from app.versions import close_versions, record_versions
+
+CSV_MIMETYPES = ('text/csv', 'application/csv')
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonl')
+
+
+class BulkPayloadError(ValueError):
+    pass
+
+
+def _text_lines(stream):
+    return io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+
+def parse_json_array(request):
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        raise BulkPayloadError("Expected a JSON array of reference ranges")
+    return data, {}
+
+
+def parse_ndjson(stream):
+    rows, errors = [], {}
+    for line in _text_lines(stream):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            rows.append(json.loads(line))
+        except ValueError:
+            errors[len(rows)] = {"_schema": ["Invalid JSON"]}
+            rows.append(None)
+    return rows, errors
+
+
+def parse_csv(stream):
+    rows = []
+    for record in csv.DictReader(_text_lines(stream)):
+        # Empty cells mean "not provided" so optional ids load as missing
+        rows.append({k: v for k, v in record.items() if k and v not in (None, '')})
+    return rows, {}
+
+
+def parse_payload(request):
+    mimetype = request.mimetype
+    if mimetype in CSV_MIMETYPES:
+        rows, errors = parse_csv(request.stream)
+    elif mimetype in NDJSON_MIMETYPES:
+        rows, errors = parse_ndjson(request.stream)
+    else:
+        rows, errors = parse_json_array(request)
+
+    if not rows:
+        raise BulkPayloadError("No reference ranges provided")
+    if len(rows) > BULK_MAX_ROWS:
+        raise BulkPayloadError(f"At most {BULK_MAX_ROWS} rows may be imported per request")
+    return rows, errors
+
+
+def validate_rows(rows, parse_errors=None):
+    # One schema pass over the whole batch; errors are keyed by row index
+    errors = {}
+    try:
+        valid_data = ReferenceRangeSchema(many=True).load(rows)
+    except ValidationError as ve:
+        errors = ve.messages if isinstance(ve.messages, dict) else {"_schema": ve.messages}
+        valid_data = ve.valid_data or []
+    errors.update(parse_errors or {})
+
+    valid = [data for index, data in enumerate(valid_data) if index not in errors]
+    return valid, errors
+
+
+def insert_ranges(session, rows, user_id, chunk_size=BULK_INSERT_CHUNK_SIZE):
+    now = datetime.utcnow()
+    values = [{
+        "test_name": data['test_name'],
+        "min_value": data['min_value'],
+        "max_value": data['max_value'],
+        "units": data['units'],
+        "department_id": data['department_id'],
+        "source_id": data.get('source_id'),
+        "study_id": data.get('study_id'),
+        "sex": data.get('sex'),
+        "age_min": data.get('age_min'),
+        "age_max": data.get('age_max'),
+        "pregnancy": data.get('pregnancy'),
+        "created_by": user_id,
+        "created_at": now,
+        "updated_at": now,
+        **canonical_range(data['test_name'], data['units'], data['min_value'], data['max_value'])
+    } for data in rows]
+
+    # Multi-row INSERT ... VALUES per chunk, all inside the caller's transaction
+    for start in range(0, len(values), chunk_size):
+        session.execute(insert(ReferenceRange).values(values[start:start + chunk_size]))
+    if values:
+        record_versions(session, ReferenceRange.created_by == user_id, ReferenceRange.updated_at == now)
+    return len(values)
+
+
+def filter_criteria(user_id, filters):
+    # Always scoped to the caller's own ranges
+    criteria = [ReferenceRange.created_by == user_id]
+    for name, values in filters.items():
+        column = getattr(ReferenceRange, name)
+        criteria.append(column == values[0] if len(values) == 1 else column.in_(values))
+    return criteria
+
+
+def matched_departments(session, criteria):
+    # {department_id: matching rows}, one grouped query; used for dry runs,
+    # the matched count and cache invalidation
+    rows = session.execute(
+        select(ReferenceRange.department_id, func.count()).where(*criteria).group_by(ReferenceRange.department_id)
+    )
+    return dict(rows.all())
+
+
+def update_ranges(session, user_id, criteria, values):
+    # One set-based UPDATE in the caller's transaction; returns rows updated
+    now = datetime.utcnow()
+    stmt = update(ReferenceRange).where(*criteria).values(**values, updated_at=now)
+    updated = session.execute(stmt, execution_options={"synchronize_session": False}).rowcount
+    if updated and CONVERSION_INPUTS & set(values):
+        # The rows just written are exactly this user's rows stamped `now`
+        # (the filter itself may no longer match them)
+        refresh_canonical(session, ReferenceRange.created_by == user_id, ReferenceRange.updated_at == now)
+    if updated:
+        record_versions(session, ReferenceRange.created_by == user_id, ReferenceRange.updated_at == now)
+    return updated
+
+
+def delete_ranges(session, criteria):
+    close_versions(session, datetime.utcnow(), *criteria)
+    stmt = delete(ReferenceRange).where(*criteria)
+    return session.execute(stmt, execution_options={"synchronize_session": False}).rowcount
@@ -0,0 +1,171 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from app.config import CACHE_ENABLED, CACHE_MAX_BYTES, CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS
+
+_MISSING = object()
+
+
+def estimate_size(value):
+    # Rough deep size in bytes, good enough to bound the cache's footprint
+    nbytes = getattr(value, 'nbytes', None)
+    if nbytes is not None:
+        return nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    # Thread-safe LRU with a per-entry TTL, bounded by entry count and
+    # (optionally) estimated bytes. Keys are tuples such as ('tests', user_id).
+    # Entries may carry a version; a lookup with a different version is a
+    # miss, which lets callers tie an entry to the database state it came from.
+
+    def __init__(self, max_entries=1024, max_bytes=None, ttl=60, enabled=True, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.enabled = enabled
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = self.stale = 0
+
+    def get(self, key, default=None, version=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            value, size, expires_at, entry_version = entry
+            if expires_at <= self._clock():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            if version is not None and entry_version != version:
+                self._remove(key)
+                self.stale += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=None, version=None, ttl=None):
+        # ttl overrides the cache default for this entry (e.g. a token's exp)
+        if not self.enabled:
+            return
+        size = estimate_size(value) if size is None else size
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, self._clock() + (self.ttl if ttl is None else ttl), version)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (
+                    self.max_bytes is not None and self._bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader, version=None):
+        if not self.enabled:
+            return loader()
+        value = self.get(key, _MISSING, version)
+        if value is _MISSING:
+            value = loader()
+            self.set(key, value, version=version)
+        return value
+
+    async def get_or_load_async(self, key, loader, version=None):
+        # Same as get_or_load for the ASGI handlers; loader is a coroutine function
+        if not self.enabled:
+            return await loader()
+        value = self.get(key, _MISSING, version)
+        if value is _MISSING:
+            value = await loader()
+            self.set(key, value, version=version)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        _, size, _, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "stale": self.stale
+            }
+
+
+range_cache = LRUCache(
+    max_entries=CACHE_MAX_ENTRIES,
+    max_bytes=CACHE_MAX_BYTES,
+    ttl=CACHE_TTL_SECONDS,
+    enabled=CACHE_ENABLED
+)
+
+DEPARTMENTS_KEY = ('departments',)
+
+
+def user_tests_key(user_id):
+    return ('tests', user_id)
+
+
+def department_tests_key(dept_id, user_id):
+    return ('department_tests', dept_id, user_id)
+
+
+def range_index_key(user_id):
+    return ('range_index', user_id)
+
+
+def version_index_key(user_id):
+    return ('version_index', user_id)
+
+
+def search_index_key(user_id):
+    return ('search_index', user_id)
+
+
+def invalidate_ranges(user_id, department_ids=()):
+    # Drop exactly the entries a write to this user's ranges can change. The
+    # range index is kept: it checks its version on use and refreshes only
+    # the changed analytes (see RangeIndex.current)
+    range_cache.invalidate(
+        user_tests_key(user_id),
+        search_index_key(user_id),
+        *(department_tests_key(dept_id, user_id) for dept_id in set(department_ids))
+    )
@@ -0,0 +1,277 @@
+import asyncio
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from app.conditional import range_version, version_query
+from app.config import (
+    CHANGES_BUFFER_SIZE, CHANGES_HEARTBEAT_SECONDS, CHANGES_MAX_SUBSCRIBERS, CHANGES_STREAM_SECONDS
+)
+from app.database import SessionLocal
+from app.serializers import dumps
+
+# Change feed for reference ranges. The write routes publish one event per
+# committed write to an in-process bus; /api/tests/changes serves them as
+# server-sent events or long-poll JSON, scoped to the caller and optionally
+# one department. Recent events stay in a ring buffer so a client can
+# resume from its Last-Event-ID.
+#
+# Event ids are '<epoch>:<sequence>' with a random epoch per process: an id
+# from another worker, from before a restart, or older than the buffer
+# cannot be resumed and gets a 'reset' event (refetch the list) instead of
+# silently missing changes. Writes served by other workers never reach this
+# bus; open streams catch those by comparing the range version on every
+# heartbeat and send 'resync' when it moved without an event.
+#
+# In ASGI mode the feed is served on the event loop (read_async), so open
+# streams and long polls hold no thread; in sync mode each holds one.
+
+EVENT_STREAM_MIMETYPE = 'text/event-stream'
+
+
+class ChangeBus:
+
+    def __init__(self, capacity=CHANGES_BUFFER_SIZE, max_subscribers=CHANGES_MAX_SUBSCRIBERS):
+        self.epoch = os.urandom(4).hex()
+        self.max_subscribers = max_subscribers
+        # (sequence, user_id, user's range version after the write, event)
+        self._events = deque(maxlen=capacity)
+        self._sequence = 0
+        self._changed = threading.Condition()
+        # (loop, asyncio.Event) for each reader waiting in read_async
+        self._waiters = set()
+        self.subscribers = 0
+        self.published = 0
+        self.resets = 0
+
+    def event_id(self, sequence):
+        return f'{self.epoch}:{sequence}'
+
+    @property
+    def last_event_id(self):
+        return self.event_id(self._sequence)
+
+    def publish(self, user_id, kind, department_ids, ids=None, count=None, version=None):
+        with self._changed:
+            self._sequence += 1
+            event = {
+                "id": self.event_id(self._sequence),
+                "type": kind,
+                "ids": ids,
+                "count": len(ids) if count is None else count,
+                "department_ids": sorted(set(department_ids))
+            }
+            self._events.append((self._sequence, user_id, version, event))
+            self.published += 1
+            self._changed.notify_all()
+            for loop, waiter in self._waiters:
+                loop.call_soon_threadsafe(waiter.set)
+        return event
+
+    def position(self, last_event_id):
+        # The sequence to read after, or None when last_event_id cannot be
+        # resumed. No id starts from now.
+        if not last_event_id:
+            return self._sequence
+        epoch, _, sequence = last_event_id.partition(':')
+        try:
+            sequence = int(sequence)
+        except ValueError:
+            return None
+        with self._changed:
+            if epoch != self.epoch or sequence > self._sequence or not self._resumable(sequence):
+                self.resets += 1
+                return None
+        return sequence
+
+    def _resumable(self, after):
+        # Called under the lock: nothing after `after` has left the buffer
+        return not self._events or self._events[0][0] <= after + 1
+
+    def read(self, after, user_id, department_id=None, timeout=0):
+        # Events for user_id after sequence `after`, waiting up to timeout
+        # for one. Returns (events, last sequence read, the user's range
+        # version as of the last event for them or None, reset); reset means
+        # events were dropped from the buffer before this reader got them.
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                if not self._resumable(after):
+                    self.resets += 1
+                    return [], self._sequence, None, True
+                events, version = [], None
+                if self._events and after < self._sequence:
+                    start = after + 1 - self._events[0][0]
+                    for _, owner, owner_version, event in itertools.islice(self._events, start, None):
+                        if owner != user_id:
+                            continue
+                        version = owner_version
+                        if department_id is None or department_id in event["department_ids"]:
+                            events.append(event)
+                after = self._sequence
+                if events or version is not None:
+                    return events, after, version, False
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return [], after, None, False
+                self._changed.wait(remaining)
+
+    async def read_async(self, after, user_id, department_id=None, timeout=0):
+        # read() for the event loop: waits on an asyncio.Event that publish
+        # sets, not on the condition, so a waiting reader holds no thread
+        deadline = time.monotonic() + timeout
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._changed:
+            self._waiters.add(waiter)
+        try:
+            while True:
+                waiter[1].clear()
+                events, after, version, reset = result = self.read(after, user_id, department_id)
+                remaining = deadline - time.monotonic()
+                if events or version is not None or reset or remaining <= 0:
+                    return result
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._changed:
+                self._waiters.discard(waiter)
+
+    def add_subscriber(self):
+        with self._changed:
+            if self.subscribers >= self.max_subscribers:
+                return False
+            self.subscribers += 1
+            return True
+
+    def remove_subscriber(self):
+        with self._changed:
+            self.subscribers -= 1
+
+    def stats(self):
+        return {
+            "published": self.published,
+            "buffered": len(self._events),
+            "capacity": self._events.maxlen,
+            "subscribers": self.subscribers,
+            "resets": self.resets
+        }
+
+
+change_bus = ChangeBus()
+
+
+def publish_change(session, user_id, kind, department_ids, ids=None, count=None):
+    # Called after the write has committed. The version lets streams on
+    # this worker tell their own events apart from writes made elsewhere.
+    version = range_version(session, created_by=user_id)
+    return change_bus.publish(user_id, kind, department_ids, ids, count, version)
+
+
+def poll_changes(user_id, department_id, last_event_id, wait):
+    after = change_bus.position(last_event_id)
+    if after is None:
+        return {"events": [], "last_event_id": change_bus.last_event_id, "reset": True}
+    events, after, _, reset = change_bus.read(after, user_id, department_id, timeout=wait)
+    return {"events": events, "last_event_id": change_bus.event_id(after), "reset": reset}
+
+
+async def poll_changes_async(user_id, department_id, last_event_id, wait):
+    after = change_bus.position(last_event_id)
+    if after is None:
+        return {"events": [], "last_event_id": change_bus.last_event_id, "reset": True}
+    events, after, _, reset = await change_bus.read_async(after, user_id, department_id, timeout=wait)
+    return {"events": events, "last_event_id": change_bus.event_id(after), "reset": reset}
+
+
+def _current_version(user_id):
+    session = SessionLocal()
+    try:
+        return range_version(session, created_by=user_id)
+    finally:
+        session.close()
+
+
+async def _current_version_async(user_id):
+    # Imported here: sync workers never build the async engine
+    from app.async_database import AsyncSessionLocal
+    async with AsyncSessionLocal() as session:
+        return tuple((await session.execute(version_query(created_by=user_id))).one())
+
+
+def _sse(kind, event_id, data):
+    return b'id: ' + event_id.encode() + b'\nevent: ' + kind.encode() + b'\ndata: ' + dumps(data) + b'\n\n'
+
+
+def _resume(last_event_id):
+    # (sequence to read after, reset frame or None) for a new stream
+    after = change_bus.position(last_event_id)
+    if after is not None:
+        return after, None
+    after = change_bus.position(None)
+    return after, _sse('reset', change_bus.event_id(after), {"reason": "unknown or expired Last-Event-ID"})
+
+
+def _event_frames(after, events, reset):
+    if reset:
+        yield _sse('reset', change_bus.event_id(after), {"reason": "events expired before delivery"})
+    for event in events:
+        yield _sse(event["type"], event["id"], event)
+
+
+def _idle_frame(after, version, current):
+    # After a quiet heartbeat: resync when the version moved without an event
+    if current != version:
+        return _sse('resync', change_bus.event_id(after), {"reason": "changed on another worker"})
+    return b': keep-alive\n\n'
+
+
+def stream_changes(user_id, department_id, last_event_id):
+    # Generator for one SSE connection. Streams close after
+    # CHANGES_STREAM_SECONDS and the client's reconnect resumes from its
+    # Last-Event-ID, so no thread is held indefinitely.
+    after, frame = _resume(last_event_id)
+    if frame is not None:
+        yield frame
+    version = _current_version(user_id)
+    deadline = time.monotonic() + CHANGES_STREAM_SECONDS
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        events, after, event_version, reset = change_bus.read(
+            after, user_id, department_id, timeout=min(CHANGES_HEARTBEAT_SECONDS, remaining)
+        )
+        yield from _event_frames(after, events, reset)
+        if event_version is not None:
+            version = event_version
+        elif not reset:
+            current = _current_version(user_id)
+            yield _idle_frame(after, version, current)
+            version = current
+
+
+async def stream_changes_async(user_id, department_id, last_event_id):
+    # stream_changes() on the event loop
+    after, frame = _resume(last_event_id)
+    if frame is not None:
+        yield frame
+    version = await _current_version_async(user_id)
+    deadline = time.monotonic() + CHANGES_STREAM_SECONDS
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        events, after, event_version, reset = await change_bus.read_async(
+            after, user_id, department_id, timeout=min(CHANGES_HEARTBEAT_SECONDS, remaining)
+        )
+        for frame in _event_frames(after, events, reset):
+            yield frame
+        if event_version is not None:
+            version = event_version
+        elif not reset:
+            current = await _current_version_async(user_id)
+            yield _idle_frame(after, version, current)
+            version = current
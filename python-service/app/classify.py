@@ -0,0 +1,317 @@
+import copy
+import math
+import sys
+import numpy as np
+from sqlalchemy import func, or_, select
+from app.conditional import range_version
+from app.config import CLASSIFY_MAX_RESULTS
+from app.intervals import IntervalTree
+from app.models import ReferenceRange, ReferenceRangeVersion, SEXES
+from app.units import to_canonical
+
+FLAG_LOW = 'L'
+FLAG_NORMAL = 'N'
+FLAG_HIGH = 'H'
+
+
+def normalize_test_name(name):
+    return ' '.join(str(name).lower().split())
+
+
+def range_key(test_name, units):
+    # Keyed on the canonical unit, so a result in mg/dL finds a range
+    # stored in mmol/L; unknown units still have to match exactly
+    return normalize_test_name(test_name), to_canonical(test_name, units)[0]
+
+
+class Patient:
+    # Demographics used to pick a stratified range; None means unknown
+    __slots__ = ('age', 'sex', 'pregnant')
+
+    def __init__(self, age=None, sex=None, pregnant=None):
+        self.age = age
+        self.sex = sex
+        self.pregnant = pregnant
+
+
+UNKNOWN_PATIENT = Patient()
+
+
+class AnalyteRanges:
+    # All ranges for one (test name, canonical unit), with an interval tree
+    # on age. Ranges with no age bounds are also kept apart, for patients
+    # whose age is unknown.
+
+    def __init__(self, slots, strata):
+        self.slots = slots
+        self.tree = IntervalTree([(strata[slot][1], strata[slot][2], slot) for slot in slots])
+        self.unbounded = [slot for slot in slots if strata[slot][1] is None and strata[slot][2] is None]
+
+    def resolve(self, patient, strata, range_ids):
+        candidates = self.tree.query(patient.age) if patient.age is not None else self.unbounded
+        best, best_rank = -1, None
+        for slot in candidates:
+            sex, age_min, age_max, pregnancy = strata[slot]
+            if sex is not None and sex != patient.sex:
+                continue
+            if pregnancy is not None and pregnancy != patient.pregnant:
+                continue
+            # Most specific range wins: more matched strata, then the
+            # narrowest age band, then the newest range
+            width = (math.inf if age_max is None else age_max) - (-math.inf if age_min is None else age_min)
+            rank = ((sex is not None) + (pregnancy is not None), -width, range_ids[slot])
+            if best_rank is None or rank > best_rank:
+                best, best_rank = slot, rank
+        return best
+
+
+class RangeIndex:
+    # In-memory lookup from (normalized test name, canonical units) and a
+    # patient to a range slot. Each analyte has an interval tree on age, so
+    # resolving a stratified range is O(log n) rather than a scan. Bounds
+    # live in parallel NumPy arrays, converted to the canonical unit, so a
+    # batch is flagged in one vectorized comparison; open-ended ranges are
+    # stored as +/-inf.
+    #
+    # The index remembers the range_version it was built at. refreshed()
+    # returns a new index that re-reads only ranges written since then and
+    # rebuilds only their analytes; the cached index is never mutated.
+
+    COLUMNS = (
+        ReferenceRange.id, ReferenceRange.test_name, ReferenceRange.units,
+        ReferenceRange.min_value, ReferenceRange.max_value,
+        ReferenceRange.sex, ReferenceRange.age_min, ReferenceRange.age_max, ReferenceRange.pregnancy
+    )
+
+    def __init__(self, rows, version=None):
+        self.version = version
+        self.range_ids = np.empty(0, dtype=np.int64)
+        self.low = np.empty(0, dtype=np.float64)
+        self.high = np.empty(0, dtype=np.float64)
+        self.rows = []
+        self.strata = []
+        self.keys = []
+        self._slot_by_id = {}
+        self._key_slots = {}
+        self._analytes = {}
+        self._extend(rows, set())
+
+    def _extend(self, rows, changed_keys):
+        range_ids, lows, highs = [], [], []
+        for row in rows:
+            range_id, test_name, units, min_value, max_value, sex, age_min, age_max, pregnancy = row
+            slot = len(self.rows)
+            key = range_key(test_name, units)
+            factor = to_canonical(test_name, units)[1]
+            range_ids.append(range_id)
+            lows.append(-math.inf if min_value is None else min_value * factor)
+            highs.append(math.inf if max_value is None else max_value * factor)
+            self.rows.append(tuple(row))
+            self.strata.append((sex, age_min, age_max, pregnancy))
+            self.keys.append(key)
+            self._slot_by_id[range_id] = slot
+            self._key_slots.setdefault(key, []).append(slot)
+            changed_keys.add(key)
+
+        self.range_ids = np.concatenate([self.range_ids, np.array(range_ids, dtype=np.int64)])
+        self.low = np.concatenate([self.low, np.array(lows, dtype=np.float64)])
+        self.high = np.concatenate([self.high, np.array(highs, dtype=np.float64)])
+        for key in changed_keys:
+            slots = self._key_slots.get(key)
+            if slots:
+                self._analytes[key] = AnalyteRanges(slots, self.strata)
+            else:
+                self._analytes.pop(key, None)
+                self._key_slots.pop(key, None)
+
+    def __len__(self):
+        return len(self._analytes)
+
+    @property
+    def nbytes(self):
+        # Used by the cache to size entries; Python-side rows dominate
+        return (self.range_ids.nbytes + self.low.nbytes + self.high.nbytes
+                + sys.getsizeof(self._analytes) + 300 * len(self.rows))
+
+    @classmethod
+    def load(cls, session, user_id, version=None):
+        # Version first: a write landing in between is simply re-read by
+        # the next refresh, which is idempotent
+        version = version or range_version(session, created_by=user_id)
+        rows = session.query(*cls.COLUMNS).filter_by(created_by=user_id).order_by(ReferenceRange.id)
+        return cls(rows, version)
+
+    @classmethod
+    def current(cls, session, user_id, index=None):
+        # The cached index if it is still current, else an incrementally
+        # refreshed copy, else a full build
+        version = range_version(session, created_by=user_id)
+        if index is None or index.version is None or index.version[2] is None:
+            return cls.load(session, user_id, version)
+        if index.version == version:
+            return index
+        return index.refreshed(session, user_id, version)
+
+    def refreshed(self, session, user_id, version):
+        index = copy.copy(self)
+        index.rows, index.strata, index.keys = list(self.rows), list(self.strata), list(self.keys)
+        index._slot_by_id = dict(self._slot_by_id)
+        index._key_slots = {key: list(slots) for key, slots in self._key_slots.items()}
+        index._analytes = dict(self._analytes)
+        index.version = version
+
+        # Inserts and updates since the last build: ranges with a version
+        # past the last version id (every write appends one), and ranges
+        # stamped at or after the last updated_at (writes made outside the
+        # app). A version committed out of id order lands at or below the
+        # last id and escapes that, but moves the count there: rebuild.
+        _, _, updated_at, versions, last_version = self.version
+        last_version = last_version or 0
+        if session.scalar(select(func.count(ReferenceRangeVersion.id)).where(
+            ReferenceRangeVersion.created_by == user_id, ReferenceRangeVersion.id <= last_version
+        )) != versions:
+            return type(self).load(session, user_id, version)
+        written = select(ReferenceRangeVersion.range_id).where(
+            ReferenceRangeVersion.created_by == user_id, ReferenceRangeVersion.id > last_version
+        )
+        rows = session.query(*self.COLUMNS).filter(
+            ReferenceRange.created_by == user_id,
+            or_(ReferenceRange.updated_at >= updated_at, ReferenceRange.id.in_(written))
+        ).order_by(ReferenceRange.id).all()
+        changed_keys = index._remove([row[0] for row in rows])
+
+        # Deletes leave no row behind; the count tells whether any happened
+        if len(index._slot_by_id) + len(rows) != version[0]:
+            live = set(session.scalars(select(ReferenceRange.id).where(ReferenceRange.created_by == user_id)))
+            changed_keys |= index._remove([range_id for range_id in index._slot_by_id if range_id not in live])
+
+        # Dead slots stay in the arrays; rebuild once they dominate
+        if len(index.rows) + len(rows) > 2 * (len(index._slot_by_id) + len(rows)) + 1024:
+            return type(self).load(session, user_id, version)
+        index._extend(rows, changed_keys)
+        return index
+
+    def _remove(self, range_ids):
+        changed_keys = set()
+        for range_id in range_ids:
+            slot = self._slot_by_id.pop(range_id, None)
+            if slot is not None:
+                key = self.keys[slot]
+                self._key_slots[key] = [s for s in self._key_slots[key] if s != slot]
+                changed_keys.add(key)
+        return changed_keys
+
+    def lookup(self, test_name, units, patient=UNKNOWN_PATIENT):
+        analyte = self._analytes.get(range_key(test_name, units))
+        if analyte is None:
+            return -1
+        return analyte.resolve(patient, self.strata, self.range_ids)
+
+    def range_for(self, slot):
+        range_id, test_name, units, min_value, max_value, sex, age_min, age_max, pregnancy = self.rows[slot]
+        return {
+            "id": range_id,
+            "test_name": test_name,
+            "min_value": min_value,
+            "max_value": max_value,
+            "units": units,
+            "sex": sex,
+            "age_min": age_min,
+            "age_max": age_max,
+            "pregnancy": pregnancy
+        }
+
+    def classify(self, test_names, values, units, patient=UNKNOWN_PATIENT):
+        slots = np.fromiter(
+            (self.lookup(name, unit, patient) for name, unit in zip(test_names, units)),
+            dtype=np.int64,
+            count=len(test_names)
+        )
+        # Unit factors come from the cached conversion table
+        factors = np.fromiter(
+            (to_canonical(name, unit)[1] for name, unit in zip(test_names, units)),
+            dtype=np.float64,
+            count=len(test_names)
+        )
+        values = np.asarray(values, dtype=np.float64) * factors
+        resolved = slots >= 0
+        flags = np.full(len(slots), None, dtype=object)
+        if not resolved.any():
+            return flags, np.full(len(slots), -1, dtype=np.int64), resolved
+
+        # Unresolved results point at slot 0 and are masked out below
+        safe = np.where(resolved, slots, 0)
+        low, high = self.low[safe], self.high[safe]
+        flags[resolved] = FLAG_NORMAL
+        flags[resolved & (values < low)] = FLAG_LOW
+        flags[resolved & (values > high)] = FLAG_HIGH
+        range_ids = np.where(resolved, self.range_ids[safe], -1)
+        return flags, range_ids, resolved
+
+
+def parse_patient(data):
+    # {"age": years, "sex": "M"/"F", "pregnant": bool}; every field optional
+    if data is None:
+        return UNKNOWN_PATIENT
+    if not isinstance(data, dict):
+        raise ValueError("patient must be an object")
+    age, sex, pregnant = data.get('age'), data.get('sex'), data.get('pregnant')
+    if age is not None:
+        try:
+            age = float(age)
+        except (TypeError, ValueError):
+            raise ValueError("patient age must be a number of years")
+        if not math.isfinite(age) or age < 0:
+            raise ValueError("patient age must be a non-negative number of years")
+    if sex is not None:
+        sex = str(sex).upper()[:1]
+        if sex not in SEXES:
+            raise ValueError("patient sex must be 'M' or 'F'")
+    if pregnant is not None and not isinstance(pregnant, bool):
+        raise ValueError("patient pregnant must be true or false")
+    return Patient(age, sex, pregnant)
+
+
+def parse_results(payload):
+    # Accepts {"results": [...]} or a bare list; each result is either an
+    # object with test_name/value/units or a [test_name, value, units] tuple
+    results = payload.get('results') if isinstance(payload, dict) else payload
+    if not isinstance(results, list) or not results:
+        raise ValueError("Expected a non-empty list of results")
+    if len(results) > CLASSIFY_MAX_RESULTS:
+        raise ValueError(f"At most {CLASSIFY_MAX_RESULTS} results may be classified per request")
+
+    test_names, values, units = [], [], []
+    for index, result in enumerate(results):
+        if isinstance(result, dict):
+            test_name, value, unit = result.get('test_name'), result.get('value'), result.get('units')
+        elif isinstance(result, (list, tuple)) and len(result) == 3:
+            test_name, value, unit = result
+        else:
+            raise ValueError(f"Result {index} must be an object or a [test_name, value, units] tuple")
+
+        if not isinstance(test_name, str) or not test_name.strip():
+            raise ValueError(f"Result {index} is missing test_name")
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Result {index} has a non-numeric value")
+        if not math.isfinite(value):
+            raise ValueError(f"Result {index} has a non-finite value")
+
+        test_names.append(test_name)
+        values.append(value)
+        units.append(unit)
+    return test_names, values, units
+
+
+def classify_results(index, test_names, values, units, patient=UNKNOWN_PATIENT):
+    flags, range_ids, resolved = index.classify(test_names, values, units, patient)
+    return [{
+        "test_name": test_name,
+        "value": value,
+        "units": unit,
+        "flag": flag,
+        "range_id": int(range_id) if matched else None
+    } for test_name, value, unit, flag, range_id, matched
+        in zip(test_names, values, units, flags.tolist(), range_ids.tolist(), resolved.tolist())]
@@ -0,0 +1,126 @@
+import os
+import click
+from app.config import EXPORT_CHUNK_SIZE, GO_DATABASE_URL, SYNC_CHUNK_SIZE, UNIT_NORMALIZE_CHUNK_SIZE
+from app.database import SessionLocal, create_db
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+
+def _alembic_config():
+    from alembic.config import Config
+    config = Config(os.path.join(MIGRATIONS_DIR, 'alembic.ini'))
+    config.set_main_option('script_location', MIGRATIONS_DIR)
+    return config
+
+
+def register_commands(app):
+
+    # Schema management is an explicit deploy step, never done at import time
+    @app.cli.command('init-db')
+    def init_db():
+        """Create any missing tables from the models and stamp the migration head."""
+        from alembic import command
+        create_db()
+        # create_all already builds the latest schema, so later upgrades start from here
+        command.stamp(_alembic_config(), 'head')
+        click.echo("Database tables created.")
+
+    @app.cli.command('db-upgrade')
+    @click.argument('revision', default='head')
+    def db_upgrade(revision):
+        """Apply Alembic migrations up to REVISION."""
+        from alembic import command
+        command.upgrade(_alembic_config(), revision)
+
+    @app.cli.command('db-downgrade')
+    @click.argument('revision')
+    def db_downgrade(revision):
+        """Revert Alembic migrations down to REVISION."""
+        from alembic import command
+        command.downgrade(_alembic_config(), revision)
+
+    @app.cli.command('export-ranges')
+    @click.argument('output')
+    @click.option('--format', 'fmt', type=click.Choice(['parquet', 'arrow']), default=None,
+                  help="Defaults from the OUTPUT extension, else parquet.")
+    @click.option('--since', default=None, help="Only ranges updated after this ISO timestamp (a previous watermark).")
+    @click.option('--user-id', type=int, default=None, help="Only ranges created by this user.")
+    @click.option('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+    def export_ranges(output, fmt, since, user_id, chunk_size):
+        """Write the reference range catalog to a Parquet or Arrow IPC file."""
+        from app.export import ExportUnavailable, parse_since, write_export
+        fmt = fmt or ('arrow' if output.endswith(('.arrow', '.feather', '.ipc')) else 'parquet')
+        session = SessionLocal()
+        try:
+            rows, watermark = write_export(session, output, fmt, parse_since(since), user_id, chunk_size)
+        except (ExportUnavailable, ValueError) as e:
+            raise click.ClickException(str(e))
+        finally:
+            session.close()
+        click.echo(f"Exported {rows} rows to {output}.")
+        if watermark is not None:
+            click.echo(f"Watermark: {watermark.isoformat()} (pass as --since for the next incremental export)")
+
+    @app.cli.command('normalize-units')
+    @click.option('--missing-only', is_flag=True, help="Only rows whose canonical columns were never filled.")
+    @click.option('--chunk-size', type=int, default=UNIT_NORMALIZE_CHUNK_SIZE)
+    def normalize_units(missing_only, chunk_size):
+        """Recompute canonical-unit bounds for the reference range catalog."""
+        from app.models import ReferenceRange
+        from app.units import refresh_canonical
+        criteria = [ReferenceRange.canonical_units.is_(None)] if missing_only else []
+        session = SessionLocal()
+        try:
+            # Committed per chunk so a large catalog never holds one long transaction
+            total = refresh_canonical(session, *criteria, chunk_size=chunk_size, commit=True, open_versions=True)
+        finally:
+            session.close()
+        click.echo(f"Normalized units for {total} reference ranges.")
+
+    @app.cli.command('prune-revoked-tokens')
+    def prune_revoked_tokens():
+        """Delete revocation records for tokens that have already expired."""
+        from app.tokens import revocations
+        session = SessionLocal()
+        try:
+            total = revocations.prune(session)
+        finally:
+            session.close()
+        click.echo(f"Pruned {total} expired token revocations.")
+
+    @app.cli.command('sync-ranges')
+    @click.argument('direction', type=click.Choice(['pull', 'push']))
+    @click.option('--go-url', default=GO_DATABASE_URL, help="go-service database URL (defaults to GO_DATABASE_URL).")
+    @click.option('--user-id', type=int, default=None,
+                  help="Owner of pulled ranges (required for pull); for push, only this user's ranges.")
+    @click.option('--since', default=None, help="Only rows changed after this ISO timestamp (a previous watermark).")
+    @click.option('--chunk-size', type=int, default=SYNC_CHUNK_SIZE)
+    def sync_ranges(direction, go_url, user_id, since, chunk_size):
+        """Copy reference ranges from (pull) or to (push) the go-service database."""
+        from sqlalchemy import create_engine
+        from app.export import parse_since
+        from app.sync import pull, push
+        if not go_url:
+            raise click.ClickException("--go-url or GO_DATABASE_URL is required")
+        if direction == 'pull' and user_id is None:
+            raise click.ClickException("--user-id is required for pull")
+        try:
+            since = parse_since(since)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        go_engine = create_engine(go_url)
+        session = SessionLocal()
+        try:
+            with go_engine.connect() as go_connection:
+                if direction == 'pull':
+                    result = pull(session, go_connection, user_id, since, chunk_size)
+                else:
+                    result = push(session, go_connection, user_id, since, chunk_size)
+        finally:
+            session.close()
+            go_engine.dispose()
+        counts = ", ".join(f"{result[key]} {key}" for key in ('read', 'inserted', 'updated', 'unchanged', 'skipped')
+                           if key in result)
+        click.echo(f"Synced reference ranges ({direction}): {counts}.")
+        if result["watermark"] is not None:
+            click.echo(f"Watermark: {result['watermark'].isoformat()} (pass as --since for the next incremental sync)")
@@ -0,0 +1,148 @@
+import gzip
+import zlib
+from flask import request
+from werkzeug.http import parse_accept_header
+from app.config import COMPRESS_ALGORITHMS, COMPRESS_ENABLED, COMPRESS_LEVEL, COMPRESS_MIN_SIZE
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/csv', 'text/plain'}
+
+
+class GzipCodec:
+    name = 'gzip'
+
+    def __init__(self, level=COMPRESS_LEVEL):
+        self.level = level
+
+    def compress(self, data):
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+    def stream(self, chunks):
+        # wbits=31 writes the gzip container around the deflate stream
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+class BrotliCodec:
+    name = 'br'
+
+    def __init__(self, level=COMPRESS_LEVEL):
+        # brotli quality runs 0-11; the shared level maps onto it directly
+        self.level = min(level, 11)
+
+    def compress(self, data):
+        return brotli.compress(data, quality=self.level)
+
+    def stream(self, chunks):
+        compressor = brotli.Compressor(quality=self.level)
+        for chunk in chunks:
+            data = compressor.process(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+
+
+class ZstdCodec:
+    name = 'zstd'
+
+    def __init__(self, level=COMPRESS_LEVEL):
+        self.compressor = zstandard.ZstdCompressor(level=level)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def stream(self, chunks):
+        compressor = self.compressor.compressobj()
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+def available_codecs(names=COMPRESS_ALGORITHMS):
+    # Preference order follows COMPRESS_ALGORITHMS; missing modules are skipped
+    factories = {'gzip': GzipCodec}
+    if brotli is not None:
+        factories['br'] = BrotliCodec
+    if zstandard is not None:
+        factories['zstd'] = ZstdCodec
+    return {name: factories[name]() for name in names if name in factories}
+
+
+CODECS = available_codecs()
+
+
+def choose_codec(accept_encoding, codecs=None):
+    # Highest client quality wins; ties go to the server's preference order
+    codecs = CODECS if codecs is None else codecs
+    if not accept_encoding:
+        return None
+    accept = parse_accept_header(accept_encoding)
+    best, best_quality = None, 0
+    for name, codec in codecs.items():
+        quality = accept[name]
+        if quality > best_quality:
+            best, best_quality = codec, quality
+    return best
+
+
+def is_compressible(mimetype, headers):
+    return COMPRESS_ENABLED and mimetype in COMPRESSIBLE_MIMETYPES and 'Content-Encoding' not in headers
+
+
+def should_compress(size):
+    # size is None for streamed bodies, which are always compressed
+    return size is None or size >= COMPRESS_MIN_SIZE
+
+
+def weaken_etag(etag):
+    # The compressed bytes differ from the identity representation, so the
+    # validator becomes weak; If-None-Match still matches it weakly
+    if etag and not etag.startswith('W/'):
+        return f'W/{etag}'
+    return etag
+
+
+def compress_response(response):
+    # after_request hook: buffered bodies are compressed once above the size
+    # threshold, streamed bodies (NDJSON) chunk by chunk as they are produced
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return response
+    if not is_compressible(response.mimetype, response.headers):
+        return response
+    # Vary even when this body is too small, so caches never mix encodings
+    response.vary.add('Accept-Encoding')
+    if not should_compress(None if response.is_streamed else response.content_length):
+        return response
+
+    codec = choose_codec(request.headers.get('Accept-Encoding'))
+    if codec is None:
+        return response
+
+    if response.is_streamed:
+        response.response = codec.stream(response.response)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(codec.compress(response.get_data()))
+    response.headers['Content-Encoding'] = codec.name
+    if 'ETag' in response.headers:
+        response.headers['ETag'] = weaken_etag(response.headers['ETag'])
+    return response
+
+
+def init_app(app):
+    app.after_request(compress_response)
@@ -0,0 +1,49 @@
+import hashlib
+from sqlalchemy import func, select
+from werkzeug.http import http_date, parse_etags
+from app.models import ReferenceRange, ReferenceRangeVersion
+
+# Conditional GET for the catalog lists. The version of a list is
+# (row count, max id, max updated_at, versions, last version id) over the
+# same filter. updated_at is stamped in Python before commit, so two writes
+# can commit in the opposite order to their stamps and leave the first
+# three unchanged; every write also appends a version, or closes one and
+# moves the count, in its own transaction, so the versions count moves on
+# every commit whatever the order. Computing it is a few aggregates over
+# indexes, so a 304 never loads or serializes the rows.
+
+CACHE_CONTROL = 'private, no-cache'
+
+
+def version_query(**filters):
+    criteria = [getattr(ReferenceRangeVersion, key) == value for key, value in filters.items()]
+    return select(
+        func.count(ReferenceRange.id), func.max(ReferenceRange.id), func.max(ReferenceRange.updated_at),
+        select(func.count(ReferenceRangeVersion.id)).where(*criteria).scalar_subquery(),
+        select(func.max(ReferenceRangeVersion.id)).where(*criteria).scalar_subquery()
+    ).filter_by(**filters)
+
+
+def range_version(session, **filters):
+    return tuple(session.execute(version_query(**filters)).one())
+
+
+def make_etag(version, variant=''):
+    # variant distinguishes representations of the same rows (format, page)
+    count, max_id, updated_at, versions, last_version = version
+    raw = f"{count}:{max_id}:{updated_at.isoformat() if updated_at else ''}:{versions}:{last_version}:{variant}"
+    return hashlib.sha1(raw.encode()).hexdigest()[:24]
+
+
+def etag_matches(if_none_match, etag):
+    # if_none_match is the raw header value; GET uses the weak comparison
+    return bool(if_none_match) and parse_etags(if_none_match).contains_weak(etag)
+
+
+def validator_headers(etag, version):
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': CACHE_CONTROL}
+    # Deletes do not advance max(updated_at), so Last-Modified is advisory
+    # and only If-None-Match is used to answer 304
+    if version[2] is not None:
+        headers['Last-Modified'] = http_date(version[2])
+    return headers
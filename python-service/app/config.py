@@ -6,6 +6,23 @@ load_dotenv()
 # Database URL for connecting to PostgreSQL
 DB_URL = os.getenv('DATABASE_URL')  
 
+# Connection pool settings (ignored for in-memory SQLite)
+DB_ECHO = os.getenv('DB_ECHO', 'False') == 'True'
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'True') == 'True'
+
+# Read replicas (comma-separated URLs) for the read-only routes. A replica
+# that fails its health check is skipped until the next check; a user's
+# reads stay on the primary for READ_YOUR_WRITES_SECONDS after their write.
+DB_REPLICA_URLS = [u.strip() for u in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if u.strip()]
+DB_REPLICA_CHECK_SECONDS = float(os.getenv('DB_REPLICA_CHECK_SECONDS', 5))
+# PostgreSQL replicas replaying further behind than this are skipped (0 disables)
+DB_REPLICA_MAX_LAG_SECONDS = float(os.getenv('DB_REPLICA_MAX_LAG_SECONDS', 0))
+READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', 5))
+
 # Database URL for connecting to PostgreSQL (Flask-SQLAlchemy expects this key)
 SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL')
 
@@ -21,3 +38,142 @@ MAIL_SERVER = os.getenv('MAIL_SERVER')
 MAIL_PORT = os.getenv('MAIL_PORT', 587)  
 MAIL_USE_TLS = os.getenv('MAIL_USE_TLS', 'True') == 'True' 
 
+# Pagination and streaming for list endpoints
+DEFAULT_PAGE_LIMIT = int(os.getenv('DEFAULT_PAGE_LIMIT', 100))
+MAX_PAGE_LIMIT = int(os.getenv('MAX_PAGE_LIMIT', 1000))
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', 500))
+
+# Bulk import of reference ranges
+BULK_INSERT_CHUNK_SIZE = int(os.getenv('BULK_INSERT_CHUNK_SIZE', 500))
+BULK_MAX_ROWS = int(os.getenv('BULK_MAX_ROWS', 50000))
+
+# Result classification
+CLASSIFY_MAX_RESULTS = int(os.getenv('CLASSIFY_MAX_RESULTS', 20000))
+
+# In-process read-through cache for reference ranges and departments
+CACHE_ENABLED = os.getenv('CACHE_ENABLED', 'True') == 'True'
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 1024))
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+CACHE_TTL_SECONDS = float(os.getenv('CACHE_TTL_SECONDS', 60))
+
+# Test name search: 'auto' uses pg_trgm on PostgreSQL and an in-memory trie elsewhere
+SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'auto')
+SEARCH_DEFAULT_LIMIT = int(os.getenv('SEARCH_DEFAULT_LIMIT', 10))
+SEARCH_MAX_LIMIT = int(os.getenv('SEARCH_MAX_LIMIT', 50))
+
+# ASGI serving mode: async driver URL, derived from DATABASE_URL when unset
+ASYNC_DATABASE_URL = os.getenv('ASYNC_DATABASE_URL')
+# Threads that serve the routes handed back to the Flask app in ASGI mode
+ASGI_SYNC_THREADS = int(os.getenv('ASGI_SYNC_THREADS', 16))
+# Threads for rate-limit store calls from the native ASGI routes, kept apart
+# from the event loop's default executor
+ASGI_ADMISSION_THREADS = int(os.getenv('ASGI_ADMISSION_THREADS', 4))
+
+# Password hashing. The method is any werkzeug method string, including its
+# cost parameters, e.g. 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'.
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt')
+# Size of the hashing process pool per worker; 0 hashes inline on the request thread
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+# Hashes allowed in flight per worker before /auth answers 429; 0 for no limit
+PASSWORD_HASH_MAX_PENDING = int(os.getenv('PASSWORD_HASH_MAX_PENDING', 4 * (os.cpu_count() or 1)))
+PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', 10))
+PASSWORD_HASH_RETRY_AFTER = int(os.getenv('PASSWORD_HASH_RETRY_AFTER', 1))
+
+# JSON encoder for list responses: 'auto' prefers orjson when it is installed
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'auto')
+
+# Response compression, negotiated from Accept-Encoding. Codecs whose module
+# is not installed (brotli, zstandard) are skipped.
+COMPRESS_ENABLED = os.getenv('COMPRESS_ENABLED', 'True') == 'True'
+COMPRESS_ALGORITHMS = [a.strip() for a in os.getenv('COMPRESS_ALGORITHMS', 'br,zstd,gzip').split(',') if a.strip()]
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 6))
+
+# Columnar (Parquet / Arrow IPC) catalog export; rows per server-side chunk
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 50000))
+# How far the export watermark trails the clock; must exceed the longest
+# write transaction, or its rows can be missed by incremental exports
+EXPORT_WATERMARK_LAG_SECONDS = int(os.getenv('EXPORT_WATERMARK_LAG_SECONDS', 60))
+
+# Rows per chunk when recomputing canonical-unit bounds (flask normalize-units)
+UNIT_NORMALIZE_CHUNK_SIZE = int(os.getenv('UNIT_NORMALIZE_CHUNK_SIZE', 5000))
+
+# Request metrics, served at /metrics in Prometheus text format. When
+# METRICS_TOKEN is set the endpoint requires it as a bearer token; without
+# one it only answers clients in METRICS_ALLOWED_IPS (behind a proxy, wrap
+# the app in ProxyFix so remote_addr is the client).
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+METRICS_ALLOWED_IPS = {a.strip() for a in os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if a.strip()}
+# User ids allowed to read /api/cache/stats and /api/pool/stats; with none
+# set those endpoints answer 403. The same numbers are on /metrics, which is
+# protected as above.
+STATS_ADMIN_IDS = {i.strip() for i in os.getenv('STATS_ADMIN_IDS', '').split(',') if i.strip()}
+# Identical SELECTs within one request before an N+1 warning is logged
+N_PLUS_ONE_THRESHOLD = int(os.getenv('N_PLUS_ONE_THRESHOLD', 10))
+
+# Request profiling. With PROFILE_ENABLED an 'X-Profile: 1' header profiles
+# that request; PROFILE_SAMPLE_RATE profiles a random fraction of all
+# requests. Dumps go to PROFILE_DIR: .prof for cProfile, .html for pyinstrument.
+PROFILE_ENABLED = os.getenv('PROFILE_ENABLED', 'False') == 'True'
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(os.getenv('TMPDIR', '/tmp'), 'refrangehub-profiles'))
+PROFILE_BACKEND = os.getenv('PROFILE_BACKEND', 'cprofile')
+
+# Verified-token cache: decoded JWT claims keyed by a hash of the raw
+# token, so repeat requests skip signature verification. An entry never
+# outlives the token's exp.
+TOKEN_CACHE_ENABLED = os.getenv('TOKEN_CACHE_ENABLED', 'True') == 'True'
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv('TOKEN_CACHE_MAX_ENTRIES', 10000))
+TOKEN_CACHE_TTL_SECONDS = float(os.getenv('TOKEN_CACHE_TTL_SECONDS', 300))
+
+# JWT signing. HS256 signs with SECRET_KEY. For an asymmetric algorithm
+# (RS256, ES256, ...) set JWT_PRIVATE_KEY_PATH on the nodes that issue
+# tokens and JWT_PUBLIC_KEY_PATHS (comma-separated PEM files) wherever
+# tokens are verified; a key's id (kid) is its file name without extension.
+JWT_ALGORITHM = os.getenv('JWT_ALGORITHM', 'HS256')
+JWT_PRIVATE_KEY_PATH = os.getenv('JWT_PRIVATE_KEY_PATH')
+JWT_PUBLIC_KEY_PATHS = [p.strip() for p in os.getenv('JWT_PUBLIC_KEY_PATHS', '').split(',') if p.strip()]
+
+# Token revocation (/auth/logout). Revoked jtis are held in an in-memory
+# bloom filter that picks up other workers' revocations every
+# TOKEN_REVOCATION_REFRESH_SECONDS.
+TOKEN_REVOCATION_REFRESH_SECONDS = float(os.getenv('TOKEN_REVOCATION_REFRESH_SECONDS', 5))
+TOKEN_REVOCATION_CAPACITY = int(os.getenv('TOKEN_REVOCATION_CAPACITY', 100000))
+TOKEN_REVOCATION_ERROR_RATE = float(os.getenv('TOKEN_REVOCATION_ERROR_RATE', 0.001))
+
+# go-service database for flask sync-ranges, and rows per sync chunk
+GO_DATABASE_URL = os.getenv('GO_DATABASE_URL')
+SYNC_CHUNK_SIZE = int(os.getenv('SYNC_CHUNK_SIZE', 5000))
+# How far a sync watermark trails the clock; must exceed the longest write
+# transaction on either side plus the clock skew between the two services
+SYNC_WATERMARK_LAG_SECONDS = int(os.getenv('SYNC_WATERMARK_LAG_SECONDS', 60))
+
+# Admission control. Token buckets per client, keyed on the JWT identity
+# (client IP for /auth and unauthenticated requests). A limit is
+# '<requests>/<seconds>': a bucket of that many requests, refilled evenly
+# over the period. RATE_LIMIT_ROUTES overrides single routes, e.g.
+# 'POST /api/tests=60/60,POST /auth/login=5/60'. Buckets live in this
+# process unless RATE_LIMIT_STORAGE_URL points at Redis, which shares them
+# across workers.
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'False') == 'True'
+RATE_LIMIT_API = os.getenv('RATE_LIMIT_API', '600/60')
+RATE_LIMIT_AUTH = os.getenv('RATE_LIMIT_AUTH', '20/60')
+RATE_LIMIT_ROUTES = os.getenv('RATE_LIMIT_ROUTES', '')
+RATE_LIMIT_STORAGE_URL = os.getenv('RATE_LIMIT_STORAGE_URL')
+# Requests served at once per worker (0 disables). Past that a request
+# waits up to CONCURRENCY_QUEUE_TIMEOUT seconds for a slot, then gets 503.
+CONCURRENCY_LIMIT = int(os.getenv('CONCURRENCY_LIMIT', 0))
+CONCURRENCY_QUEUE_TIMEOUT = float(os.getenv('CONCURRENCY_QUEUE_TIMEOUT', 2))
+CONCURRENCY_RETRY_AFTER = int(os.getenv('CONCURRENCY_RETRY_AFTER', 1))
+
+# Change feed (/api/tests/changes). Events kept per worker for Last-Event-ID
+# resume; keep-alive interval; how long one stream stays open before the
+# client reconnects; longest long-poll wait; open streams allowed per worker.
+# In sync mode every open stream or long poll holds a request thread; in
+# ASGI mode the feed is served on the event loop and holds none.
+CHANGES_BUFFER_SIZE = int(os.getenv('CHANGES_BUFFER_SIZE', 10000))
+CHANGES_HEARTBEAT_SECONDS = float(os.getenv('CHANGES_HEARTBEAT_SECONDS', 15))
+CHANGES_STREAM_SECONDS = float(os.getenv('CHANGES_STREAM_SECONDS', 300))
+CHANGES_MAX_WAIT_SECONDS = float(os.getenv('CHANGES_MAX_WAIT_SECONDS', 30))
+CHANGES_MAX_SUBSCRIBERS = int(os.getenv('CHANGES_MAX_SUBSCRIBERS', 100))
@@ -1,12 +1,278 @@
-from sqlalchemy import create_engine
+import itertools
+import threading
+import time
+from flask import g, has_request_context
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import create_engine, event, exc, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from app.config import DB_URL
+from sqlalchemy.pool import QueuePool
+from app.config import (
+    DB_URL, DB_ECHO, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_PRE_PING, DB_POOL_RECYCLE, DB_POOL_TIMEOUT,
+    DB_REPLICA_CHECK_SECONDS, DB_REPLICA_MAX_LAG_SECONDS, DB_REPLICA_URLS, READ_YOUR_WRITES_SECONDS
+)
 
 Base = declarative_base()
 
-engine = create_engine(DB_URL, echo=True)
+
+class PoolMetrics:
+    # Checkout wait times recorded by InstrumentedQueuePool
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record(self, seconds, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += int(timed_out)
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = self.timeouts = 0
+            self.wait_seconds_total = self.wait_seconds_max = 0.0
+
+
+pool_metrics = PoolMetrics()
+
+
+class InstrumentedQueuePool(QueuePool):
+
+    def connect(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            pool_metrics.record(time.perf_counter() - start, timed_out)
+
+
+def engine_options(url):
+    options = {"echo": DB_ECHO, "pool_pre_ping": DB_POOL_PRE_PING}
+    url = make_url(url)
+    # In-memory SQLite keeps one connection per thread; pool sizing does not apply
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return options
+    options.update(
+        poolclass=InstrumentedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_timeout=DB_POOL_TIMEOUT
+    )
+    return options
+
+
+engine = create_engine(DB_URL, **engine_options(DB_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+class Replica:
+
+    def __init__(self, url):
+        self.url = make_url(url).render_as_string(hide_password=True)
+        self.engine = create_engine(url, **engine_options(url))
+        self.healthy = True
+        self.next_check = 0.0
+        self.check_lock = threading.Lock()
+        self.reads = 0
+        self.failures = 0
+
+
+class SessionRouter:
+    # Chooses the database for read-only work. Replicas take turns; each is
+    # health-checked (SELECT 1, plus the replay lag on PostgreSQL) at most
+    # every check_seconds, and one that fails or drops a connection is
+    # skipped until a later check passes. With no usable replica reads go
+    # to the primary. After a user commits on the primary their reads stay
+    # there for read_your_writes seconds, so they never see a replica that
+    # has not replayed their own write yet. The window is kept per process.
+
+    def __init__(self, replica_urls=(), check_seconds=DB_REPLICA_CHECK_SECONDS,
+                 max_lag_seconds=DB_REPLICA_MAX_LAG_SECONDS, read_your_writes=READ_YOUR_WRITES_SECONDS,
+                 clock=time.monotonic):
+        self.replicas = [Replica(url) for url in replica_urls]
+        self.check_seconds = check_seconds
+        self.max_lag_seconds = max_lag_seconds
+        self.read_your_writes = read_your_writes
+        self._clock = clock
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        # user id -> clock time until which that user reads the primary
+        self._recent_writes = {}
+        self.sticky_reads = self.fallback_reads = 0
+        for replica in self.replicas:
+            self.watch(replica, replica.engine)
+
+    def watch(self, replica, engine):
+        # A connection dropped by engine (the replica's own, or another
+        # engine on the same server) marks the replica down until a check
+        event.listen(engine, 'handle_error', self._disconnect_handler(replica))
+
+    def _disconnect_handler(self, replica):
+        def handle_error(context):
+            if context.is_disconnect:
+                replica.healthy = False
+                replica.next_check = self._clock() + self.check_seconds
+        return handle_error
+
+    def record_write(self, user_id):
+        if not self.replicas or user_id is None:
+            return
+        now = self._clock()
+        with self._lock:
+            self._recent_writes[user_id] = now + self.read_your_writes
+            if len(self._recent_writes) > 10000:
+                self._recent_writes = {k: v for k, v in self._recent_writes.items() if v > now}
+
+    def _sticky(self, user_id):
+        until = self._recent_writes.get(user_id)
+        if until is None:
+            return False
+        if until > self._clock():
+            return True
+        with self._lock:
+            self._recent_writes.pop(user_id, None)
+        return False
+
+    def replica_for(self, user_id=None):
+        # A replica engine, or None for the primary
+        if not self.replicas:
+            return None
+        if user_id is not None and self._sticky(user_id):
+            self.sticky_reads += 1
+            return None
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self._turn) % len(self.replicas)]
+            if self._available(replica):
+                replica.reads += 1
+                return replica.engine
+        self.fallback_reads += 1
+        return None
+
+    def _available(self, replica):
+        # One thread runs a due check; the rest go by the last result
+        if self._clock() >= replica.next_check and replica.check_lock.acquire(blocking=False):
+            try:
+                replica.healthy = self._check(replica)
+                replica.next_check = self._clock() + self.check_seconds
+            finally:
+                replica.check_lock.release()
+        return replica.healthy
+
+    def _check(self, replica):
+        try:
+            with replica.engine.connect() as conn:
+                if self.max_lag_seconds > 0 and conn.dialect.name == 'postgresql':
+                    # Time since the last replayed transaction; NULL when the
+                    # server is not in recovery. An idle primary also makes
+                    # this grow, so set the limit above the quiet periods.
+                    lag = conn.execute(text(
+                        "SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())"
+                    )).scalar()
+                    if lag is not None and lag > self.max_lag_seconds:
+                        replica.failures += 1
+                        return False
+                else:
+                    conn.execute(text('SELECT 1'))
+            return True
+        except exc.SQLAlchemyError:
+            replica.failures += 1
+            return False
+
+    def stats(self):
+        return {
+            "replicas": len(self.replicas),
+            "healthy_replicas": sum(1 for replica in self.replicas if replica.healthy),
+            "replica_reads": sum(replica.reads for replica in self.replicas),
+            "sticky_reads": self.sticky_reads,
+            "fallback_reads": self.fallback_reads,
+            "replica_check_failures": sum(replica.failures for replica in self.replicas),
+            "by_replica": {replica.url: {"healthy": replica.healthy, "reads": replica.reads}
+                           for replica in self.replicas}
+        }
+
+
+router = SessionRouter(DB_REPLICA_URLS)
+
+
+@event.listens_for(SessionLocal, 'after_commit')
+def _record_write(session):
+    # Commits made while serving an authenticated request pin that user's
+    # reads to the primary for a while
+    if router.replicas and has_request_context():
+        try:
+            router.record_write(get_jwt_identity())
+        except RuntimeError:
+            pass
+
+
+def get_session():
+    # One session per app context, opened on first use
+    if 'db_session' not in g:
+        g.db_session = SessionLocal()
+    return g.db_session
+
+
+def get_read_session(user_id=None):
+    # Session for read-only work on behalf of user_id: a replica when one
+    # is configured and usable, else the same session as get_session()
+    if 'db_read_session' not in g:
+        bind = router.replica_for(user_id)
+        g.db_read_session = SessionLocal(bind=bind) if bind is not None else get_session()
+    return g.db_read_session
+
+
+def close_session(exception=None):
+    read_session = g.pop('db_read_session', None)
+    session = g.pop('db_session', None)
+    if read_session is not None and read_session is not session:
+        read_session.close()
+    if session is not None:
+        if exception is not None:
+            session.rollback()
+        session.close()
+
+
+def init_app(app):
+    app.teardown_appcontext(close_session)
+
+
+def pool_stats():
+    pool = engine.pool
+    stats = {
+        "pool_class": type(pool).__name__,
+        "checkouts": pool_metrics.checkouts,
+        "checkout_timeouts": pool_metrics.timeouts,
+        "checkout_wait_seconds_total": pool_metrics.wait_seconds_total,
+        "checkout_wait_seconds_max": pool_metrics.wait_seconds_max,
+        "checkout_wait_seconds_avg": (
+            pool_metrics.wait_seconds_total / pool_metrics.checkouts if pool_metrics.checkouts else 0.0
+        )
+    }
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        stats.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            saturation=pool.checkedout() / capacity if capacity else 0.0
+        )
+    return stats
+
+
+def router_stats():
+    return router.stats()
+
+
 def create_db():
     Base.metadata.create_all(bind=engine)
@@ -0,0 +1,217 @@
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import exists, func, literal, select
+from app.config import EXPORT_CHUNK_SIZE, EXPORT_WATERMARK_LAG_SECONDS
+from app.models import ReferenceRange, ReferenceRangeVersion, Department, Source, Study
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+EXPORT_FORMATS = {
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+
+class ExportUnavailable(RuntimeError):
+    pass
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ExportUnavailable("Columnar export requires pyarrow (pip install pyarrow)")
+
+
+# (output column, selected expression, arrow type name) for the denormalized
+# export; departments are required, sources and studies are outer joined.
+# Incremental exports also carry one row per deleted range: deleted is true,
+# updated_at is when it was deleted and every other column but id is null.
+EXPORT_COLUMNS = [
+    ('id', ReferenceRange.id, 'int64'),
+    ('test_name', ReferenceRange.test_name, 'string'),
+    ('min_value', ReferenceRange.min_value, 'float64'),
+    ('max_value', ReferenceRange.max_value, 'float64'),
+    ('units', ReferenceRange.units, 'string'),
+    ('canonical_units', ReferenceRange.canonical_units, 'string'),
+    ('canonical_min', ReferenceRange.canonical_min, 'float64'),
+    ('canonical_max', ReferenceRange.canonical_max, 'float64'),
+    ('sex', ReferenceRange.sex, 'string'),
+    ('age_min', ReferenceRange.age_min, 'float64'),
+    ('age_max', ReferenceRange.age_max, 'float64'),
+    ('pregnancy', ReferenceRange.pregnancy, 'bool'),
+    ('department_id', ReferenceRange.department_id, 'int64'),
+    ('department_name', Department.name, 'string'),
+    ('source_id', ReferenceRange.source_id, 'int64'),
+    ('source_name', Source.name, 'string'),
+    ('source_type', Source.source_type, 'string'),
+    ('study_id', ReferenceRange.study_id, 'int64'),
+    ('study_title', Study.title, 'string'),
+    ('study_publication_date', Study.publication_date, 'timestamp'),
+    ('created_by', ReferenceRange.created_by, 'int64'),
+    ('created_at', ReferenceRange.created_at, 'timestamp'),
+    ('updated_at', ReferenceRange.updated_at, 'timestamp'),
+    ('deleted', literal(False), 'bool'),
+]
+
+
+def export_schema(metadata=None):
+    require_pyarrow()
+    types = {'int64': pa.int64(), 'float64': pa.float64(), 'string': pa.string(), 'bool': pa.bool_(),
+             'timestamp': pa.timestamp('us')}
+    return pa.schema([(name, types[kind]) for name, _, kind in EXPORT_COLUMNS], metadata=metadata)
+
+
+def _filters(user_id=None):
+    return [ReferenceRange.created_by == user_id] if user_id is not None else []
+
+
+def export_watermark():
+    # Taken before the export runs and trailing the clock by the lag: a row
+    # stamped before the watermark but committed after the export started
+    # would otherwise be behind every later since. Rows changed within the
+    # lag are exported again by the next incremental run, so consumers
+    # upsert by id.
+    return datetime.utcnow() - timedelta(seconds=EXPORT_WATERMARK_LAG_SECONDS)
+
+
+def export_statement(since=None, user_id=None):
+    stmt = (
+        select(*(column for _, column, _ in EXPORT_COLUMNS))
+        .select_from(ReferenceRange)
+        .join(Department, ReferenceRange.department_id == Department.id)
+        .outerjoin(Source, ReferenceRange.source_id == Source.id)
+        .outerjoin(Study, ReferenceRange.study_id == Study.id)
+        .where(*_filters(user_id))
+        .order_by(ReferenceRange.id)
+    )
+    if since is not None:
+        stmt = stmt.where(ReferenceRange.updated_at > since)
+    return stmt
+
+
+def tombstone_statement(since, user_id=None):
+    # (range id, deleted at) for ranges deleted after since: close_versions
+    # closes the last version of a range as it is deleted, so those are the
+    # ranges with a version closed since and no row left
+    filters = [ReferenceRangeVersion.created_by == user_id] if user_id is not None else []
+    return (
+        select(ReferenceRangeVersion.range_id, func.max(ReferenceRangeVersion.valid_to))
+        .where(*filters, ReferenceRangeVersion.valid_to > since,
+               ~exists().where(ReferenceRange.id == ReferenceRangeVersion.range_id))
+        .group_by(ReferenceRangeVersion.range_id)
+        .order_by(ReferenceRangeVersion.range_id)
+    )
+
+
+def iter_record_batches(session, schema, since=None, user_id=None, chunk_size=EXPORT_CHUNK_SIZE):
+    # yield_per streams through a server-side cursor where the driver has
+    # one, so only chunk_size rows are held in Python at a time. Executed on
+    # the session's connection: plain column rows need no ORM loading step.
+    connection = session.connection()
+    stmt = export_statement(since, user_id).execution_options(yield_per=chunk_size)
+    for partition in connection.execute(stmt).partitions():
+        columns = zip(*partition)
+        yield pa.RecordBatch.from_arrays(
+            [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema
+        )
+    if since is None:
+        return
+    stmt = tombstone_statement(since, user_id).execution_options(yield_per=chunk_size)
+    for partition in connection.execute(stmt).partitions():
+        ids, deleted_at = zip(*partition)
+        values = {'id': ids, 'updated_at': deleted_at, 'deleted': [True] * len(ids)}
+        yield pa.RecordBatch.from_arrays(
+            [pa.array(values.get(field.name, [None] * len(ids)), type=field.type) for field in schema], schema=schema
+        )
+
+
+class _ChunkSink:
+    # Write-only file object that hands written bytes back to a generator,
+    # so the writers below can stream to an HTTP response
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def _open_writer(sink, fmt, schema, stream=False):
+    if fmt == 'parquet':
+        return pq.ParquetWriter(sink, schema, compression='zstd')
+    if fmt == 'arrow':
+        # The IPC stream format needs no seeking, so it is what goes over HTTP
+        return pa.ipc.new_stream(sink, schema) if stream else pa.ipc.new_file(sink, schema)
+    raise ValueError(f"Unsupported export format: {fmt}")
+
+
+def _metadata(since, watermark):
+    return {
+        b'since': since.isoformat().encode() if since else b'',
+        b'watermark': watermark.isoformat().encode() if watermark else b'',
+    }
+
+
+def write_export(session, path, fmt='parquet', since=None, user_id=None, chunk_size=EXPORT_CHUNK_SIZE):
+    # Returns (rows written, watermark); pass the watermark as `since` next time
+    require_pyarrow()
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    watermark = export_watermark()
+    schema = export_schema(_metadata(since, watermark))
+    rows = 0
+    writer = _open_writer(path, fmt, schema)
+    try:
+        for batch in iter_record_batches(session, schema, since, user_id, chunk_size):
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    finally:
+        writer.close()
+    return rows, watermark
+
+
+def stream_export(session, fmt, since, watermark, user_id=None, chunk_size=EXPORT_CHUNK_SIZE):
+    # Yields the encoded file chunk by chunk; memory stays at one chunk
+    schema = export_schema(_metadata(since, watermark))
+    sink = _ChunkSink()
+    writer = _open_writer(pa.PythonFile(sink, mode='w'), fmt, schema, stream=True)
+    for batch in iter_record_batches(session, schema, since, user_id, chunk_size):
+        writer.write_batch(batch)
+        data = sink.drain()
+        if data:
+            yield data
+    writer.close()
+    yield sink.drain()
+
+
+def parse_since(value):
+    if not value:
+        return None
+    try:
+        since = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError("since must be an ISO 8601 timestamp")
+    # Stored timestamps are naive UTC
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return since
@@ -0,0 +1,86 @@
+import math
+
+
+class _Node:
+    __slots__ = ('center', 'by_low', 'by_high', 'left', 'right')
+
+    def __init__(self, center, by_low, by_high):
+        self.center = center
+        self.by_low = by_low
+        self.by_high = by_high
+        self.left = None
+        self.right = None
+
+
+class IntervalTree:
+    # Static centered interval tree over half-open [low, high) intervals.
+    # Each node keeps the intervals that straddle its center, sorted both by
+    # low and by high, so a point query walks one root-to-leaf path and
+    # only touches intervals that match: O(log n + k). None bounds mean
+    # unbounded on that side.
+
+    def __init__(self, intervals):
+        intervals = [(-math.inf if low is None else low, math.inf if high is None else high, item)
+                     for low, high, item in intervals]
+        self._size = len(intervals)
+        self._root = self._build(intervals)
+
+    def __len__(self):
+        return self._size
+
+    @classmethod
+    def _build(cls, intervals):
+        if not intervals:
+            return None
+        endpoints = sorted(x for low, high, _ in intervals for x in (low, high) if math.isfinite(x))
+        center = endpoints[len(endpoints) // 2] if endpoints else 0.0
+
+        here, left, right = [], [], []
+        for interval in intervals:
+            low, high, _ = interval
+            if high <= center:
+                left.append(interval)
+            elif low > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+
+        node = _Node(
+            center,
+            sorted(here, key=lambda interval: interval[0]),
+            sorted(here, key=lambda interval: interval[1], reverse=True)
+        )
+        # Every interval lands in exactly one subtree, so the recursion
+        # always shrinks; a degenerate split just keeps them at this node
+        if left and len(left) < len(intervals):
+            node.left = cls._build(left)
+        else:
+            node.by_low.extend(left)
+        if right and len(right) < len(intervals):
+            node.right = cls._build(right)
+        else:
+            node.by_low.extend(right)
+        if len(node.by_low) != len(here):
+            node.by_low.sort(key=lambda interval: interval[0])
+            node.by_high = sorted(node.by_low, key=lambda interval: interval[1], reverse=True)
+        return node
+
+    def query(self, point):
+        found = []
+        node = self._root
+        while node is not None:
+            if point < node.center:
+                for low, high, item in node.by_low:
+                    if low > point:
+                        break
+                    if point < high:
+                        found.append(item)
+                node = node.left
+            else:
+                for low, high, item in node.by_high:
+                    if high <= point:
+                        break
+                    if low <= point:
+                        found.append(item)
+                node = node.right
+        return found
@@ -1,28 +1,26 @@
 from flask import Flask, jsonify
-from flask_jwt_extended import JWTManager
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
-from app.config import SECRET_KEY, DEBUG, SQLALCHEMY_DATABASE_URI
+from app.config import SECRET_KEY, DEBUG
 from app.auth_routes import auth_bp
 from app.routes import test_bp
-from app.database import create_db
-
-create_db()
-db = SQLAlchemy()
-migrate = Migrate()
+from app.database import init_app as init_database
+from app.compression import init_app as init_compression
+from app.metrics import init_app as init_metrics
+from app.ratelimit import init_app as init_ratelimit
+from app.tokens import init_app as init_tokens
+from app.cli import register_commands
 
 def create_app():
     app = Flask(__name__)
     app.config['SECRET_KEY'] = SECRET_KEY
     app.config['DEBUG'] = DEBUG
     app.config['JWT_SECRET_KEY'] = SECRET_KEY
-    app.config['SQLALCHEMY_DATABASE_URI'] = SQLALCHEMY_DATABASE_URI
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-    db.init_app(app)
-    migrate.init_app(app, db)
 
-    jwt = JWTManager(app)
+    jwt = init_tokens(app)
+    init_database(app)
+    init_metrics(app)
+    init_ratelimit(app)
+    init_compression(app)
+    register_commands(app)
 
     # Register blueprints
     app.register_blueprint(auth_bp, url_prefix='/auth')
@@ -0,0 +1,363 @@
+import cProfile
+import itertools
+import os
+import random
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from flask import Response, current_app, g, jsonify, request
+from sqlalchemy import event
+from app.cache import range_cache
+from app.changes import change_bus
+from app.config import (
+    METRICS_ALLOWED_IPS, METRICS_ENABLED, METRICS_TOKEN, N_PLUS_ONE_THRESHOLD, PROFILE_BACKEND, PROFILE_DIR,
+    PROFILE_ENABLED, PROFILE_SAMPLE_RATE
+)
+from app.database import engine, pool_stats, router, router_stats
+from app.passwords import password_hasher
+from app.ratelimit import admission_stats
+from app.tokens import revocations, token_cache
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+# Per-request instrumentation. Every request gets a RequestStats in a
+# context variable; SQLAlchemy cursor events add each statement's count
+# and time to it, so the numbers cover the sync engine, the async engine
+# (its events run in the caller's context) and streamed bodies alike. When
+# the response is done the totals go into per-endpoint histograms, which
+# /metrics renders in the Prometheus text format.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # Buckets are upper bounds (le); the last slot is +Inf
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestStats:
+    __slots__ = ('statements', 'sql_seconds', 'selects')
+
+    def __init__(self):
+        self.statements = 0
+        self.sql_seconds = 0.0
+        # SELECT text -> executions; the same text repeated many times in
+        # one request is the N+1 signature (lazy loads, per-row lookups)
+        self.selects = {}
+
+    def repeated_select(self):
+        if not self.selects:
+            return None, 0
+        statement = max(self.selects, key=self.selects.get)
+        return statement, self.selects[statement]
+
+
+_current_request = ContextVar('current_request', default=None)
+
+
+def begin_request():
+    stats = RequestStats()
+    _current_request.set(stats)
+    return stats
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.latency = {}
+        self.statements = {}
+        self.sql_seconds = {}
+        self.n_plus_one = {}
+
+    def observe(self, method, endpoint, status, seconds, stats=None):
+        key, status_key = (method, endpoint), (method, endpoint, str(status))
+        with self._lock:
+            self.requests[status_key] = self.requests.get(status_key, 0) + 1
+            self.latency.setdefault(key, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            if stats is not None:
+                self.statements.setdefault(key, Histogram(STATEMENT_BUCKETS)).observe(stats.statements)
+                self.sql_seconds.setdefault(key, Histogram(LATENCY_BUCKETS)).observe(stats.sql_seconds)
+
+    def flag_n_plus_one(self, method, endpoint):
+        with self._lock:
+            self.n_plus_one[(method, endpoint)] = self.n_plus_one.get((method, endpoint), 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.latency.clear()
+            self.statements.clear()
+            self.sql_seconds.clear()
+            self.n_plus_one.clear()
+
+    def render(self, gauges=()):
+        lines = []
+        with self._lock:
+            _counter(lines, 'http_requests_total', 'Requests by endpoint and status',
+                     (('method', 'endpoint', 'status'), self.requests))
+            _histogram(lines, 'http_request_duration_seconds', 'Request latency, including streamed bodies',
+                       self.latency)
+            _histogram(lines, 'db_statements_per_request', 'SQL statements executed per request', self.statements)
+            _histogram(lines, 'db_statement_seconds_per_request', 'Time spent in SQL per request', self.sql_seconds)
+            _counter(lines, 'db_n_plus_one_total', 'Requests that repeated one SELECT past the N+1 threshold',
+                     (('method', 'endpoint'), self.n_plus_one))
+        for name, kind, help_text, value in gauges:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+def _counter(lines, name, help_text, labelled):
+    label_names, values = labelled
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} counter')
+    for key, value in sorted(values.items()):
+        lines.append(f'{name}{_labels(label_names, key)} {value}')
+
+
+def _histogram(lines, name, help_text, histograms):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} histogram')
+    for key, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+            cumulative += count
+            le = 'le="' + _number(bound) + '"'
+            lines.append(f'{name}_bucket{_labels(("method", "endpoint"), key, le)} {cumulative}')
+        lines.append(f'{name}_sum{_labels(("method", "endpoint"), key)} {_number(histogram.sum)}')
+        lines.append(f'{name}_count{_labels(("method", "endpoint"), key)} {histogram.count}')
+
+
+# Cumulative values in the stats dicts; everything else is a gauge
+COUNTER_STATS = {'hits', 'misses', 'evictions', 'expirations', 'invalidations', 'stale', 'checkouts',
+                 'checkout_timeouts', 'rejected', 'checks', 'positives', 'false_positives', 'refreshes', 'rebuilds',
+                 'replica_reads', 'sticky_reads', 'fallback_reads', 'replica_check_failures',
+                 'admitted', 'limited', 'shed', 'store_errors', 'published', 'resets'}
+
+
+def collect_gauges():
+    sources = (
+        ('cache', 'Range cache', range_cache.stats()),
+        ('db_pool', 'Connection pool', pool_stats()),
+        ('db_router', 'Read router', router_stats()),
+        ('password_hash', 'Password hashing pool', password_hasher.stats()),
+        ('admission', 'Admission control', admission_stats()),
+        ('token_cache', 'Verified-token cache', token_cache.stats()),
+        ('token_revocation', 'Token revocation filter', revocations.stats()),
+        ('changes', 'Change feed', change_bus.stats()),
+    )
+    gauges = []
+    for prefix, source, stats in sources:
+        for key, value in stats.items():
+            if not isinstance(value, (int, float)):
+                continue
+            counter = key in COUNTER_STATS
+            name = f"{prefix}_{key}{'_total' if counter else ''}"
+            gauges.append((name, 'counter' if counter else 'gauge', f"{source} {key.replace('_', ' ')}", value))
+    return gauges
+
+
+# -----------------------------
+# SQL instrumentation
+# -----------------------------
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_request.get() is not None:
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_request.get()
+    started = conn.info.get('metrics_started')
+    if stats is None or not started:
+        return
+    stats.statements += 1
+    stats.sql_seconds += time.perf_counter() - started.pop()
+    if statement.lstrip()[:6].upper() == 'SELECT':
+        stats.selects[statement] = stats.selects.get(statement, 0) + 1
+
+
+def instrument_engine(target):
+    if not event.contains(target, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(target, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(target, 'after_cursor_execute', _after_cursor_execute)
+
+
+def check_n_plus_one(logger, method, endpoint, stats):
+    statement, count = stats.repeated_select()
+    if count >= N_PLUS_ONE_THRESHOLD > 0:
+        metrics.flag_n_plus_one(method, endpoint)
+        logger.warning("Possible N+1 in %s %s: %d identical SELECTs: %s",
+                       method, endpoint, count, ' '.join(statement.split())[:300])
+
+
+# -----------------------------
+# Profiling
+# -----------------------------
+
+class _CProfile:
+    suffix = '.prof'
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def save(self, path):
+        self.profiler.disable()
+        self.profiler.dump_stats(path)
+
+
+class _Pyinstrument:
+    suffix = '.html'
+
+    def __init__(self):
+        self.profiler = pyinstrument.Profiler(async_mode='disabled')
+        self.profiler.start()
+
+    def save(self, path):
+        self.profiler.stop()
+        with open(path, 'w') as f:
+            f.write(self.profiler.output_html())
+
+
+# One profiled request at a time: profilers hook the interpreter and
+# overlapping ones would skew each other
+_profile_slot = threading.Lock()
+_profile_sequence = itertools.count(1)
+
+
+def _start_profile(explicit):
+    if not (explicit or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE)):
+        return None
+    if not _profile_slot.acquire(blocking=False):
+        return None
+    return _Pyinstrument() if PROFILE_BACKEND == 'pyinstrument' and pyinstrument is not None else _CProfile()
+
+
+def _save_profile(profile, method, endpoint):
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', endpoint).strip('_') or 'root'
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{next(_profile_sequence)}-{method}-{slug}"
+        path = os.path.join(PROFILE_DIR, name + profile.suffix)
+        profile.save(path)
+        return path
+    finally:
+        _profile_slot.release()
+
+
+# -----------------------------
+# Flask hooks
+# -----------------------------
+
+def _endpoint():
+    # The route pattern, not the path, so ids do not explode the label set
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def before_request():
+    g.metrics_started = time.perf_counter()
+    g.metrics_stats = begin_request()
+    explicit = PROFILE_ENABLED and request.headers.get('X-Profile', '').lower() in ('1', 'true', 'yes')
+    g.profile_explicit = explicit
+    g.profile = _start_profile(explicit)
+
+
+def after_request(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    stats = g.pop('metrics_stats')
+    method, endpoint, status = request.method, _endpoint(), response.status_code
+    logger = current_app.logger
+
+    profile = g.pop('profile', None)
+    if profile is not None:
+        path = _save_profile(profile, method, endpoint)
+        if g.pop('profile_explicit', False):
+            response.headers['X-Profile-Path'] = path
+
+    def record():
+        metrics.observe(method, endpoint, status, time.perf_counter() - started, stats)
+        check_n_plus_one(logger, method, endpoint, stats)
+
+    # Streamed bodies (NDJSON, exports) keep running queries after this
+    # hook; record them once the server has sent the last chunk
+    if response.is_streamed:
+        response.call_on_close(record)
+    else:
+        record()
+    return response
+
+
+def teardown_request(exception=None):
+    # after_request is skipped when a request fails before producing a
+    # response; never leave the profiling slot held
+    profile = g.pop('profile', None)
+    if profile is not None:
+        _save_profile(profile, request.method, _endpoint())
+
+
+def metrics_view():
+    # Cache, pool and admission internals: never served to just anyone
+    if METRICS_TOKEN:
+        if request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+            return jsonify({"error": "Unauthorized"}), 401
+    elif request.remote_addr not in METRICS_ALLOWED_IPS:
+        return jsonify({"error": "Forbidden"}), 403
+    return Response(metrics.render(collect_gauges()), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+def init_app(app):
+    if not METRICS_ENABLED:
+        return
+    instrument_engine(engine)
+    for replica in router.replicas:
+        instrument_engine(replica.engine)
+    app.before_request(before_request)
+    # Registered before compression, so this after_request runs last and
+    # times the compressed response
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -1,8 +1,12 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Text
+from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, DateTime, Text, Index, DDL, event, func
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from app.database import Base
 
+# Sex strata for reference ranges; NULL on a range means it applies to both
+SEXES = ('M', 'F')
+
+
 class User(Base):
     __tablename__ = 'users'
 
@@ -13,6 +17,23 @@ class User(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
 
 
+class RevokedToken(Base):
+    __tablename__ = 'revoked_tokens'
+
+    # One row per logged-out access token. Rows past expires_at can be
+    # pruned (flask prune-revoked-tokens); the token is rejected anyway.
+    id = Column(Integer, primary_key=True)
+    jti = Column(String(64), unique=True, nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=True)
+    expires_at = Column(DateTime, nullable=False)
+    revoked_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    # For listing revocations by time; the in-memory filter refreshes by id
+    __table_args__ = (
+        Index('ix_revoked_tokens_revoked_at', 'revoked_at'),
+    )
+
+
 class Department(Base):
     __tablename__ = 'departments'
 
@@ -29,17 +50,99 @@ class ReferenceRange(Base):
     min_value = Column(Float)
     max_value = Column(Float)
     units = Column(String(50))
+    # min/max converted to a canonical unit (see app.units) so ranges
+    # reported in different units can be compared directly
+    canonical_units = Column(String(50))
+    canonical_min = Column(Float)
+    canonical_max = Column(Float)
+    # Stratification: NULL means "applies to everyone". Ages are in years,
+    # half-open [age_min, age_max) so adjacent bands do not overlap.
+    sex = Column(String(1))
+    age_min = Column(Float)
+    age_max = Column(Float)
+    pregnancy = Column(Boolean)
     department_id = Column(Integer, ForeignKey('departments.id'), nullable=False)
     source_id = Column(Integer, ForeignKey('sources.id'), nullable=True)
     study_id = Column(Integer, ForeignKey('studies.id'), nullable=True)
     created_by = Column(Integer, ForeignKey('users.id'), nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # id of the matching row in the go-service reference_ranges table,
+    # maintained by flask sync-ranges (see app.sync)
+    external_id = Column(Integer)
 
     department = relationship('Department')
     source = relationship('Source', back_populates='reference_ranges')
     study = relationship('Study', back_populates='reference_ranges')
     user = relationship('User')
 
+    # Every list/lookup is scoped to created_by; (id, created_by) lookups are
+    # served by the primary key. (created_by, updated_at) answers the ETag
+    # aggregate from the index alone; updated_at alone drives incremental
+    # exports. Keep in sync with migrations/versions.
+    __table_args__ = (
+        Index('ix_reference_ranges_created_by_id', 'created_by', 'id'),
+        Index('ix_reference_ranges_created_by_updated_at', 'created_by', 'updated_at'),
+        Index('ix_reference_ranges_updated_at', 'updated_at'),
+        Index('ix_reference_ranges_department_id_created_by', 'department_id', 'created_by'),
+        Index('ix_reference_ranges_created_by_external_id', 'created_by', 'external_id', unique=True),
+    )
+
+
+Index('ix_reference_ranges_test_name_lower', func.lower(ReferenceRange.test_name))
+
+# Trigram index for substring/fuzzy search on PostgreSQL
+event.listen(
+    ReferenceRange.__table__,
+    'after_create',
+    DDL(
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm; '
+        'CREATE INDEX IF NOT EXISTS ix_reference_ranges_test_name_trgm '
+        'ON reference_ranges USING gin (lower(test_name) gin_trgm_ops)'
+    ).execute_if(dialect='postgresql')
+)
+
+
+class ReferenceRangeVersion(Base):
+    __tablename__ = 'reference_range_versions'
+
+    # Append-only history of reference_ranges: every write opens a version
+    # with the range's values as of that write and closes the previous one.
+    # A version is in force over [valid_from, valid_to); valid_to is NULL
+    # while it is current. Deleting a range only closes its last version,
+    # so range_id carries no foreign key.
+    id = Column(Integer, primary_key=True)
+    range_id = Column(Integer, nullable=False)
+    test_name = Column(String(255), nullable=False)
+    min_value = Column(Float)
+    max_value = Column(Float)
+    units = Column(String(50))
+    canonical_units = Column(String(50))
+    canonical_min = Column(Float)
+    canonical_max = Column(Float)
+    sex = Column(String(1))
+    age_min = Column(Float)
+    age_max = Column(Float)
+    pregnancy = Column(Boolean)
+    department_id = Column(Integer, nullable=False)
+    source_id = Column(Integer)
+    study_id = Column(Integer)
+    created_by = Column(Integer, nullable=False)
+    valid_from = Column(DateTime, nullable=False)
+    valid_to = Column(DateTime)
+
+    # (created_by, valid_from, valid_to) answers as-of reads for one user;
+    # (created_by, department_id, id) the list version's revision aggregate;
+    # (range_id) WHERE valid_to IS NULL finds the version a write closes and
+    # allows one open version per range. Keep in sync with migrations/versions.
+    __table_args__ = (
+        Index('ix_reference_range_versions_created_by_valid_from', 'created_by', 'valid_from', 'valid_to'),
+        Index('ix_reference_range_versions_created_by_department_id', 'created_by', 'department_id', 'id'),
+        Index('ix_reference_range_versions_range_id', 'range_id'),
+        Index('ix_reference_range_versions_open', 'range_id', unique=True,
+              postgresql_where=valid_to.is_(None), sqlite_where=valid_to.is_(None)),
+    )
+
 
 class Source(Base):
     __tablename__ = 'sources'
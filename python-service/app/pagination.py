@@ -0,0 +1,72 @@
+import base64
+import binascii
+from app.config import DEFAULT_PAGE_LIMIT, MAX_PAGE_LIMIT, STREAM_BATCH_SIZE
+from app.serializers import dumps
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    # Cursors are opaque to clients but are just the last id seen, base64 encoded
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+
+def parse_page_args(args):
+    limit = args.get('limit', DEFAULT_PAGE_LIMIT)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError("limit must be an integer")
+    if limit < 1:
+        raise ValueError("limit must be positive")
+
+    cursor = args.get('cursor')
+    after_id = decode_cursor(cursor) if cursor else None
+    return min(limit, MAX_PAGE_LIMIT), after_id
+
+
+def keyset_query(query, id_column, after_id=None):
+    # Keyset on the primary key: ids follow insertion order, so this walks
+    # the rows in creation order without OFFSET scans.
+    if after_id is not None:
+        query = query.filter(id_column > after_id)
+    return query.order_by(id_column)
+
+
+def keyset_page(query, id_column, limit, after_id=None):
+    # Fetch one extra row to know whether another page exists
+    rows = keyset_query(query, id_column, after_id).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].id)
+    return rows, next_cursor
+
+
+def stream_ndjson(query, id_column, serialize, after_id=None):
+    for row in keyset_query(query, id_column, after_id).yield_per(STREAM_BATCH_SIZE):
+        yield dumps(serialize(row)) + b'\n'
+
+
+def response_format(request):
+    # 'ndjson', 'columns' (one array per field) or plain 'json'
+    if wants_ndjson(request):
+        return 'ndjson'
+    if request.args.get('format') == 'columns':
+        return 'columns'
+    return 'json'
+
+
+def wants_ndjson(request):
+    if request.args.get('format') == 'ndjson':
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
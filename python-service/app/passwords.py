@@ -0,0 +1,125 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from werkzeug.security import generate_password_hash, check_password_hash
+from app.config import (
+    PASSWORD_HASH_METHOD, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING, PASSWORD_HASH_TIMEOUT,
+    PASSWORD_HASH_RETRY_AFTER
+)
+
+
+class HashingBusy(Exception):
+    # Raised when the hashing queue is full; callers answer 429 with Retry-After
+
+    def __init__(self, retry_after=PASSWORD_HASH_RETRY_AFTER):
+        super().__init__("Too many concurrent authentication requests")
+        self.retry_after = retry_after
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _verify(pwhash, password):
+    return check_password_hash(pwhash, password)
+
+
+def pool_context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+class PasswordHasher:
+    # Runs the CPU-heavy hash work on a bounded process pool so request
+    # threads are not held for hundreds of ms per login. At most
+    # max_pending hashes may be queued or running per worker process; past
+    # that callers get HashingBusy instead of piling up. max_pending=0 sets
+    # no limit; workers=0 hashes inline on the request thread.
+    # Pool processes are started by a forkserver (spawn where there is
+    # none), never forked from the multi-threaded worker: a fork copies
+    # locks other threads held, and the child can deadlock on them.
+
+    def __init__(self, method=PASSWORD_HASH_METHOD, workers=PASSWORD_HASH_WORKERS,
+                 max_pending=PASSWORD_HASH_MAX_PENDING, timeout=PASSWORD_HASH_TIMEOUT):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending) if max_pending > 0 else None
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._method_prefix = None
+        self._stats_lock = threading.Lock()
+        self.pending = 0
+        self.rejected = 0
+
+    def _pool(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=pool_context())
+            return self._executor
+
+    def _release(self, future=None):
+        with self._stats_lock:
+            self.pending -= 1
+        if self._slots is not None:
+            self._slots.release()
+
+    def _run(self, fn, *args):
+        if self._slots is not None and not self._slots.acquire(blocking=False):
+            with self._stats_lock:
+                self.rejected += 1
+            raise HashingBusy()
+        with self._stats_lock:
+            self.pending += 1
+        if self.workers <= 0:
+            try:
+                return fn(*args)
+            finally:
+                self._release()
+        try:
+            future = self._pool().submit(fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        # The slot is held until the pool is done with the hash, not just
+        # until the caller stops waiting: work abandoned on timeout still
+        # occupies a process, so it still counts against max_pending
+        future.add_done_callback(self._release)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            # Still queued: drop it, which releases the slot right away
+            future.cancel()
+            raise HashingBusy()
+
+    def hash(self, password):
+        return self._run(_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(_verify, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        # Stored hashes look like "scrypt:32768:8:1$salt$hash"; compare the
+        # fully expanded method so cost changes are picked up too
+        if self._method_prefix is None:
+            self._method_prefix = generate_password_hash('', method=self.method).split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self._method_prefix
+
+    def stats(self):
+        return {
+            "method": self.method,
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "rejected": self.rejected
+        }
+
+    def shutdown(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,310 @@
+import asyncio
+import math
+import threading
+import time
+from flask import current_app, g, jsonify, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from app.config import (
+    CONCURRENCY_LIMIT, CONCURRENCY_QUEUE_TIMEOUT, CONCURRENCY_RETRY_AFTER, RATE_LIMIT_API, RATE_LIMIT_AUTH,
+    RATE_LIMIT_ENABLED, RATE_LIMIT_ROUTES, RATE_LIMIT_STORAGE_URL
+)
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Admission control, checked before any route runs: a token bucket per
+# client and blueprint (or per client and route, for routes with their own
+# limit) answers 429 once a client has spent its budget, and a per-worker
+# concurrency cap answers 503 when no slot frees up within the queue
+# timeout. Both set Retry-After.
+
+BLUEPRINT_LIMITS = {'auth_bp': RATE_LIMIT_AUTH, 'test_bp': RATE_LIMIT_API}
+
+# Exempt from the concurrency cap: the metrics scrape, so overload stays
+# visible, and change streams, which are open for minutes and have their
+# own cap (CHANGES_MAX_SUBSCRIBERS)
+UNCAPPED_ENDPOINTS = {'metrics', 'test_bp.watch_changes'}
+
+
+def parse_limit(value):
+    # '<requests>/<seconds>' -> (capacity, tokens per second)
+    requests, _, seconds = value.partition('/')
+    capacity, period = int(requests), float(seconds or 1)
+    if capacity <= 0 or period <= 0:
+        raise ValueError(f"Invalid rate limit {value!r}")
+    return capacity, capacity / period
+
+
+def parse_route_limits(value):
+    # 'POST /api/tests=60/60,POST /auth/login=5/60' -> {('POST', '/api/tests'): (60, 1.0), ...}
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        route, _, limit = item.rpartition('=')
+        method, _, rule = route.strip().partition(' ')
+        limits[(method.upper(), rule.strip())] = parse_limit(limit)
+    return limits
+
+
+class MemoryStore:
+    # Buckets for this process only. Full buckets are dropped once the
+    # table grows past max_keys; a missing bucket starts full, so nothing
+    # is lost by dropping them.
+
+    def __init__(self, max_keys=100000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def consume(self, key, capacity, rate, cost=1):
+        # Returns (allowed, tokens left)
+        now = self._clock()
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            # The third field is when the bucket will be full again
+            self._buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+            if len(self._buckets) > self.max_keys:
+                self._buckets = {k: bucket for k, bucket in self._buckets.items() if bucket[2] > now}
+        return allowed, tokens
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisStore:
+    # Buckets shared by every worker. The refill and spend run as one Lua
+    # script on the server clock, so concurrent workers never race and
+    # their clocks need not agree.
+
+    SCRIPT = """
+    local capacity, rate, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    local allowed = 0
+    if tokens >= cost then
+        tokens = tokens - cost
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+    return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url, prefix='ratelimit:'):
+        if redis is None:
+            raise RuntimeError("RATE_LIMIT_STORAGE_URL needs the redis package")
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self.prefix = prefix
+        self._script = self.client.register_script(self.SCRIPT)
+
+    def consume(self, key, capacity, rate, cost=1):
+        allowed, tokens = self._script(keys=[self.prefix + key], args=[capacity, rate, cost])
+        return bool(allowed), float(tokens)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+def make_store(url=RATE_LIMIT_STORAGE_URL):
+    return RedisStore(url) if url else MemoryStore()
+
+
+class AdmissionControl:
+
+    def __init__(self, store=None, blueprint_limits=None, route_limits=None,
+                 concurrency_limit=CONCURRENCY_LIMIT, queue_timeout=CONCURRENCY_QUEUE_TIMEOUT,
+                 retry_after=CONCURRENCY_RETRY_AFTER, rate_limits_enabled=RATE_LIMIT_ENABLED):
+        self.store = store if store is not None else (make_store() if rate_limits_enabled else None)
+        self.blueprint_limits = blueprint_limits if blueprint_limits is not None else {
+            name: parse_limit(limit) for name, limit in BLUEPRINT_LIMITS.items()
+        }
+        self.route_limits = route_limits if route_limits is not None else parse_route_limits(RATE_LIMIT_ROUTES)
+        self.concurrency_limit = concurrency_limit
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._slots = threading.BoundedSemaphore(concurrency_limit) if concurrency_limit > 0 else None
+        self._stats_lock = threading.Lock()
+        self.admitted = self.limited = self.shed = self.store_errors = 0
+        self.in_flight = 0
+
+    @property
+    def enabled(self):
+        return self.store is not None or self._slots is not None
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def client_key(self):
+        # Identity from a valid bearer token; the IP for /auth and for
+        # requests without one (the route itself still answers 401). Behind
+        # a proxy, wrap the app in ProxyFix so remote_addr is the client.
+        if request.blueprint != 'auth_bp':
+            try:
+                verify_jwt_in_request(optional=True)
+                identity = get_jwt_identity()
+            except Exception:
+                identity = None
+            if identity is not None:
+                return f'user:{identity}'
+        return f'ip:{request.remote_addr}'
+
+    def limit_for(self, method, rule, blueprint):
+        # (bucket scope, capacity, rate) for this request, or None
+        route = (method, rule)
+        if route in self.route_limits:
+            return (f'{method} {rule}', *self.route_limits[route])
+        if blueprint in self.blueprint_limits:
+            return (blueprint, *self.blueprint_limits[blueprint])
+        return None
+
+    def check_rate(self, method, rule, blueprint, client_key):
+        # (seconds to wait or None when admitted, (capacity, tokens left) or
+        # None when unlimited). client_key is called only when a limit applies.
+        limit = self.limit_for(method, rule, blueprint) if self.store is not None else None
+        if limit is None:
+            return None, None
+        scope, capacity, rate = limit
+        try:
+            allowed, tokens = self.store.consume(f'{scope}:{client_key()}', capacity, rate)
+        except Exception as e:
+            # A store outage must not take the API down with it
+            self._count('store_errors')
+            current_app.logger.warning("Rate limit store unavailable: %s", e)
+            return None, None
+        if allowed:
+            return None, (capacity, tokens)
+        return max(1, math.ceil((1 - tokens) / rate)), (capacity, tokens)
+
+    def capped(self, endpoint):
+        return self._slots is not None and endpoint not in UNCAPPED_ENDPOINTS
+
+    def admit(self, method, rule, blueprint, endpoint, client_key):
+        # The admission decision for the Flask hooks. Returns (rejection,
+        # rate limit, holds a slot); rejection is (message, status, retry
+        # after) or None. A caller holding a slot must release_slot() once
+        # the response is sent.
+        retry_after, limit = self.check_rate(method, rule, blueprint, client_key)
+        if retry_after is not None:
+            return self.rate_limited(retry_after), limit, False
+        if self.capped(endpoint):
+            if not self._slots.acquire(timeout=self.queue_timeout):
+                return self._shed(), limit, False
+            return self._admitted(True), limit, True
+        return self._admitted(False), limit, False
+
+    async def acquire_slot_async(self, endpoint):
+        # The concurrency cap for the native ASGI routes: (rejection, holds
+        # a slot). Same semaphore as the Flask hooks, so the cap stays one
+        # per worker, but waited for by polling on the event loop: a queued
+        # request holds no thread, so it cannot starve admitted requests of
+        # the executor they need to finish.
+        if not self.capped(endpoint):
+            return self._admitted(False), False
+        deadline = time.monotonic() + self.queue_timeout
+        delay = 0.001
+        while not self._slots.acquire(blocking=False):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return self._shed(), False
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+        return self._admitted(True), True
+
+    def rate_limited(self, retry_after):
+        self._count('limited')
+        return "Rate limit exceeded", 429, retry_after
+
+    def _shed(self):
+        self._count('shed')
+        return "Server is busy", 503, self.retry_after
+
+    def _admitted(self, slot):
+        with self._stats_lock:
+            self.admitted += 1
+            if slot:
+                self.in_flight += 1
+        return None
+
+    def before_request(self):
+        rule = request.url_rule.rule if request.url_rule is not None else None
+        rejection, limit, slot = self.admit(request.method, rule, request.blueprint, request.endpoint, self.client_key)
+        if limit is not None:
+            g.rate_limit = limit
+        if rejection is not None:
+            return _reject(*rejection)
+        g.admission_slot = slot
+        return None
+
+    def release_slot(self):
+        with self._stats_lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def release(self):
+        if g.pop('admission_slot', False):
+            self.release_slot()
+
+    def after_request(self, response):
+        limit = g.pop('rate_limit', None)
+        if limit is not None:
+            response.headers.update(rate_limit_headers(limit))
+        # A streamed body keeps its slot until the server has sent it
+        if response.is_streamed and g.pop('admission_slot', False):
+            response.call_on_close(self.release_slot)
+        else:
+            self.release()
+        return response
+
+    def teardown_request(self, exception=None):
+        # after_request is skipped when a request fails without a response
+        self.release()
+
+    def stats(self):
+        return {
+            "rate_limited": self.store is not None,
+            "store": type(self.store).__name__ if self.store is not None else None,
+            "concurrency_limit": self.concurrency_limit,
+            "in_flight": self.in_flight,
+            "admitted": self.admitted,
+            "limited": self.limited,
+            "shed": self.shed,
+            "store_errors": self.store_errors
+        }
+
+
+def rate_limit_headers(limit):
+    return {'X-RateLimit-Limit': str(limit[0]), 'X-RateLimit-Remaining': str(int(limit[1]))}
+
+
+def _reject(message, status, retry_after):
+    response = jsonify({"error": message})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, status
+
+
+admission = AdmissionControl()
+
+
+def admission_stats():
+    return admission.stats()
+
+
+def init_app(app):
+    if not admission.enabled:
+        return
+    app.before_request(admission.before_request)
+    app.after_request(admission.after_request)
+    app.teardown_request(admission.teardown_request)
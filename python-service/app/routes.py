@@ -1,16 +1,44 @@
-from flask import Blueprint, request, jsonify
+from datetime import datetime
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from app.models import ReferenceRange, Department
-from app.database import SessionLocal
-from app.schemas import ReferenceRangeSchema
+from app.models import ReferenceRange, ReferenceRangeVersion, Department
+from app.database import get_read_session, get_session, pool_stats, router_stats
+from app.schemas import BulkDeleteSchema, BulkUpdateSchema, ReferenceRangeSchema
+from app.classify import RangeIndex, classify_results, parse_patient, parse_results
+from app.search import load_trie, search_postgres
+from app.bulk import (
+    BulkPayloadError, delete_ranges, filter_criteria, insert_ranges, matched_departments, parse_payload,
+    update_ranges, validate_rows
+)
+from app.cache import (
+    DEPARTMENTS_KEY, department_tests_key, invalidate_ranges, range_cache, range_index_key,
+    search_index_key, user_tests_key, version_index_key
+)
+from app.pagination import (
+    NDJSON_MIMETYPE, decode_cursor, keyset_page, parse_page_args, response_format, stream_ndjson
+)
+from app.conditional import etag_matches, make_etag, range_version, validator_headers
+from app.export import (
+    EXPORT_FORMATS, ExportUnavailable, export_watermark, parse_since, require_pyarrow, stream_export
+)
+from app.units import conversion_factor, convert
+from app.changes import EVENT_STREAM_MIMETYPE, change_bus, poll_changes, publish_change, stream_changes
+from app.serializers import (
+    department_serializer, dumps, json_response, reference_range_serializer, reference_range_version_serializer
+)
+from app.versions import VersionIndex, close_versions, in_force, parse_as_of, record_versions
+from app.config import (
+    CHANGES_MAX_WAIT_SECONDS, SEARCH_BACKEND, SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT, STATS_ADMIN_IDS
+)
 from marshmallow import ValidationError
 
 test_bp = Blueprint('test_bp', __name__)
 
+
 @test_bp.route('/tests', methods=['POST'])
 @jwt_required()
 def create_test():
-    session = SessionLocal()
+    session = get_session()
     user_id = get_jwt_identity()
     
     try:
@@ -29,7 +57,11 @@ def create_test():
             created_by=user_id
         )
         session.add(new_test)
+        session.flush()
+        record_versions(session, ReferenceRange.id == new_test.id)
         session.commit()
+        invalidate_ranges(user_id, [new_test.department_id])
+        publish_change(session, user_id, 'insert', [new_test.department_id], [new_test.id])
         return jsonify({"message": "Test created", "id": new_test.id}), 201
     except ValidationError as ve:
         session.rollback()
@@ -37,37 +69,281 @@ def create_test():
     except Exception as e:
         session.rollback()
         return jsonify({"error": str(e)}), 400
-    finally:
-        session.close()
+
+def _flag(name):
+    return request.args.get(name, '').lower() in ('1', 'true', 'yes')
+
+@test_bp.route('/tests/bulk', methods=['POST'])
+@jwt_required()
+def bulk_create_tests():
+    session = get_session()
+    user_id = get_jwt_identity()
+    dry_run = _flag('dry_run')
+    skip_invalid = _flag('skip_invalid')
+
+    try:
+        rows, parse_errors = parse_payload(request)
+        valid, errors = validate_rows(rows, parse_errors)
+        result = {
+            "received": len(rows),
+            "valid": len(valid),
+            "inserted": 0,
+            "dry_run": dry_run,
+            "errors": {str(index): messages for index, messages in sorted(errors.items())}
+        }
+
+        if errors and not skip_invalid:
+            return jsonify(result), 400
+        if dry_run or not valid:
+            return jsonify(result), 200
+
+        result["inserted"] = insert_ranges(session, valid, user_id)
+        session.commit()
+        department_ids = [data['department_id'] for data in valid]
+        invalidate_ranges(user_id, department_ids)
+        publish_change(session, user_id, 'insert', department_ids, count=result["inserted"])
+        return jsonify(result), 201
+    except BulkPayloadError as be:
+        return jsonify({"error": str(be)}), 400
+    except Exception as e:
+        session.rollback()
+        return jsonify({"error": str(e)}), 400
+
+@test_bp.route('/tests/bulk', methods=['PATCH'])
+@jwt_required()
+def bulk_update_tests():
+    session = get_session()
+    user_id = get_jwt_identity()
+    dry_run = _flag('dry_run')
+    try:
+        data = BulkUpdateSchema().load(request.get_json())
+        criteria = filter_criteria(user_id, data['filter'])
+        departments = matched_departments(session, criteria)
+        result = {"matched": sum(departments.values()), "updated": 0, "dry_run": dry_run}
+        if dry_run or not departments:
+            return jsonify(result), 200
+
+        result["updated"] = update_ranges(session, user_id, criteria, data['set'])
+        session.commit()
+        department_ids = list(departments)
+        if 'department_id' in data['set']:
+            department_ids.append(data['set']['department_id'])
+        invalidate_ranges(user_id, department_ids)
+        publish_change(session, user_id, 'update', department_ids, count=result["updated"])
+        return jsonify(result), 200
+    except ValidationError as ve:
+        session.rollback()
+        return jsonify({"error": ve.messages}), 400
+    except Exception as e:
+        session.rollback()
+        return jsonify({"error": str(e)}), 400
+
+@test_bp.route('/tests/bulk', methods=['DELETE'])
+@jwt_required()
+def bulk_delete_tests():
+    session = get_session()
+    user_id = get_jwt_identity()
+    dry_run = _flag('dry_run')
+    try:
+        data = BulkDeleteSchema().load(request.get_json())
+        criteria = filter_criteria(user_id, data['filter'])
+        departments = matched_departments(session, criteria)
+        result = {"matched": sum(departments.values()), "deleted": 0, "dry_run": dry_run}
+        if dry_run or not departments:
+            return jsonify(result), 200
+
+        result["deleted"] = delete_ranges(session, criteria)
+        session.commit()
+        invalidate_ranges(user_id, departments)
+        publish_change(session, user_id, 'delete', departments, count=result["deleted"])
+        return jsonify(result), 200
+    except ValidationError as ve:
+        session.rollback()
+        return jsonify({"error": ve.messages}), 400
+    except Exception as e:
+        session.rollback()
+        return jsonify({"error": str(e)}), 400
 
 @test_bp.route('/tests', methods=['GET'])
 @jwt_required()
 def get_user_tests():
-    session = SessionLocal()
     user_id = get_jwt_identity()
     try:
-        tests = session.query(ReferenceRange).filter_by(created_by=user_id).all()
-        results = [{
-            "id": t.id,
-            "test_name": t.test_name,
-            "min_value": t.min_value,
-            "max_value": t.max_value,
-            "units": t.units,
-            "department_id": t.department_id,
-            "source_id": t.source_id,
-            "study_id": t.study_id,
-            "created_at": t.created_at.isoformat()
-        } for t in tests]
-        return jsonify(results), 200
+        # Answer polls from the version aggregate before touching any rows
+        version = range_version(get_read_session(user_id), created_by=user_id)
+        representation = response_format(request)
+        etag = make_etag(version, f"{representation}:{request.query_string.decode()}")
+        headers = validator_headers(etag, version)
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            return '', 304, headers
+
+        as_of = parse_as_of(request.args.get('as_of'))
+        if as_of is None:
+            serializer, key = reference_range_serializer, ReferenceRange.id
+            criteria = (ReferenceRange.created_by == user_id,)
+        else:
+            # The ranges as they stood at as_of, from the version history
+            serializer, key = reference_range_version_serializer, ReferenceRangeVersion.range_id
+            criteria = (ReferenceRangeVersion.created_by == user_id, *in_force(as_of))
+
+        if representation == 'ndjson':
+            after_id = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+
+            # The app context is torn down before the body is streamed, so the
+            # generator opens its own request-scoped session when it starts
+            def generate():
+                query = serializer.query(get_read_session(user_id)).filter(*criteria)
+                yield from stream_ndjson(query, key, serializer.to_dict, after_id)
+
+            return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE), 200, headers
+
+        query = serializer.query(get_read_session(user_id)).filter(*criteria)
+        serialize = serializer.columnar if representation == 'columns' else serializer.many
+
+        # Without limit/cursor the endpoint keeps returning the full list.
+        # The encoded body is cached under its version, so a hit does no
+        # serialization and never outlives a write made by another worker.
+        if 'limit' not in request.args and 'cursor' not in request.args:
+            if representation == 'columns' or as_of is not None:
+                return json_response(serialize(query.order_by(key))), 200, headers
+            body = range_cache.get_or_load(
+                user_tests_key(user_id),
+                lambda: dumps(reference_range_serializer.many(query)),
+                version=version
+            )
+            return json_response(body), 200, headers
+
+        limit, after_id = parse_page_args(request.args)
+        tests, next_cursor = keyset_page(query, key, limit, after_id)
+        return json_response({
+            "items": serialize(tests),
+            "next_cursor": next_cursor
+        }), 200, headers
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+@test_bp.route('/tests/export', methods=['GET'])
+@jwt_required()
+def export_tests():
+    user_id = get_jwt_identity()
+    try:
+        require_pyarrow()
+        fmt = request.args.get('format', 'parquet')
+        if fmt not in EXPORT_FORMATS:
+            return jsonify({"error": f"format must be one of: {', '.join(EXPORT_FORMATS)}"}), 400
+        since = parse_since(request.args.get('since'))
+        watermark = export_watermark()
+
+        def generate():
+            yield from stream_export(get_read_session(user_id), fmt, since, watermark, user_id)
+
+        headers = {
+            'Content-Disposition': f'attachment; filename="reference_ranges.{fmt}"',
+            'X-Export-Watermark': watermark.isoformat() if watermark else ''
+        }
+        return Response(stream_with_context(generate()), mimetype=EXPORT_FORMATS[fmt]), 200, headers
+    except ExportUnavailable as eu:
+        return jsonify({"error": str(eu)}), 501
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+@test_bp.route('/tests/changes', methods=['GET'])
+@jwt_required()
+def watch_changes():
+    # Server-sent events when the client accepts text/event-stream, else a
+    # long poll: JSON with the events after last_event_id, waiting up to
+    # ?wait= seconds for one. Either way the cursor is the Last-Event-ID
+    # header or ?last_event_id=.
+    user_id = get_jwt_identity()
+    try:
+        department_id = int(request.args['department_id']) if request.args.get('department_id') else None
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+
+        if EVENT_STREAM_MIMETYPE in request.headers.get('Accept', ''):
+            if not change_bus.add_subscriber():
+                response = jsonify({"error": "Too many open change streams"})
+                response.headers['Retry-After'] = '5'
+                return response, 503
+            response = Response(stream_with_context(stream_changes(user_id, department_id, last_event_id)),
+                                mimetype=EVENT_STREAM_MIMETYPE)
+            # Given back when the server closes the response, even if the
+            # client went away before the first event
+            response.call_on_close(change_bus.remove_subscriber)
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response
+
+        wait = min(max(float(request.args.get('wait', 0)), 0.0), CHANGES_MAX_WAIT_SECONDS)
+        return jsonify(poll_changes(user_id, department_id, last_event_id, wait)), 200
+    except ValueError:
+        return jsonify({"error": "department_id and wait must be numbers"}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+@test_bp.route('/tests/search', methods=['GET'])
+@jwt_required()
+def search_tests():
+    user_id = get_jwt_identity()
+    session = get_read_session(user_id)
+    try:
+        q = request.args.get('q', '').strip()
+        if not q:
+            return jsonify({"error": "Query parameter q is required"}), 400
+        limit = min(int(request.args.get('limit', SEARCH_DEFAULT_LIMIT)), SEARCH_MAX_LIMIT)
+        if limit < 1:
+            return jsonify({"error": "limit must be positive"}), 400
+
+        backend = SEARCH_BACKEND
+        if backend == 'auto':
+            backend = 'postgres' if session.get_bind().dialect.name == 'postgresql' else 'trie'
+        if backend == 'postgres':
+            matches = search_postgres(session, user_id, q, limit)
+        else:
+            # Versioned like the other cached reads, so writes made on other
+            # workers (which cannot invalidate this one's cache) show up
+            trie = range_cache.get_or_load(search_index_key(user_id), lambda: load_trie(session, user_id),
+                                           version=range_version(session, created_by=user_id))
+            matches = trie.search(q, limit)
+
+        # ?units= re-expresses each match in the caller's unit where the
+        # analyte allows it; factors come from the cached conversion table
+        target_units = request.args.get('units')
+        results = []
+        for row, match in matches:
+            result = {
+                "id": row.id,
+                "test_name": row.test_name,
+                "min_value": row.min_value,
+                "max_value": row.max_value,
+                "units": row.units,
+                "canonical_units": row.canonical_units,
+                "canonical_min": row.canonical_min,
+                "canonical_max": row.canonical_max,
+                "department_id": row.department_id,
+                "match": match
+            }
+            if target_units:
+                factor = conversion_factor(row.test_name, row.units, target_units)
+                result["converted"] = None if factor is None else {
+                    "units": target_units,
+                    "min_value": convert(row.min_value, factor),
+                    "max_value": convert(row.max_value, factor)
+                }
+            results.append(result)
+        return jsonify({"query": q, "results": results}), 200
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 400
-    finally:
-        session.close()
 
 @test_bp.route('/tests/<int:test_id>', methods=['PUT'])
 @jwt_required()
 def update_test(test_id):
-    session = SessionLocal()
+    session = get_session()
     user_id = get_jwt_identity()
     try:
         json_data = request.get_json()
@@ -79,10 +355,19 @@ def update_test(test_id):
         if not test_item:
             return jsonify({"error": "Test not found"}), 404
 
+        department_ids = [test_item.department_id]
+        updated_at = test_item.updated_at
         for key, value in data.items():
             setattr(test_item, key, value)
-        
+        department_ids.append(test_item.department_id)
+
+        # A PUT that changes nothing is not flushed and opens no version
+        session.flush()
+        if test_item.updated_at != updated_at:
+            record_versions(session, ReferenceRange.id == test_id)
         session.commit()
+        invalidate_ranges(user_id, department_ids)
+        publish_change(session, user_id, 'update', department_ids, [test_id])
         return jsonify({"message": "Test updated"}), 200
     except ValidationError as ve:
         session.rollback()
@@ -90,56 +375,86 @@ def update_test(test_id):
     except Exception as e:
         session.rollback()
         return jsonify({"error": str(e)}), 400
-    finally:
-        session.close()
 
 @test_bp.route('/tests/<int:test_id>', methods=['DELETE'])
 @jwt_required()
 def delete_test(test_id):
-    session = SessionLocal()
+    session = get_session()
     user_id = get_jwt_identity()
     try:
         test_item = session.query(ReferenceRange).filter_by(id=test_id, created_by=user_id).first()
         if not test_item:
             return jsonify({"error": "Test not found"}), 404
         
+        department_id = test_item.department_id
+        close_versions(session, datetime.utcnow(), ReferenceRange.id == test_id)
         session.delete(test_item)
         session.commit()
+        invalidate_ranges(user_id, [department_id])
+        publish_change(session, user_id, 'delete', [department_id], [test_id])
         return jsonify({"message": "Test deleted"}), 200
     except Exception as e:
         session.rollback()
         return jsonify({"error": str(e)}), 400
-    finally:
-        session.close()
 
 @test_bp.route('/departments/<int:dept_id>/tests', methods=['GET'])
 @jwt_required()
 def get_tests_by_department(dept_id):
-    session = SessionLocal()
     user_id = get_jwt_identity()
+    session = get_read_session(user_id)
+    try:
+        version = range_version(session, department_id=dept_id, created_by=user_id)
+        representation = 'columns' if request.args.get('format') == 'columns' else 'json'
+        # Same variant as the native ASGI handler, which serves the plain list
+        variant = f"{representation}:{request.args['as_of']}" if 'as_of' in request.args else representation
+        etag = make_etag(version, variant)
+        headers = validator_headers(etag, version)
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            return '', 304, headers
+
+        as_of = parse_as_of(request.args.get('as_of'))
+        if as_of is not None:
+            rows = reference_range_version_serializer.query(session).filter(
+                ReferenceRangeVersion.created_by == user_id, ReferenceRangeVersion.department_id == dept_id,
+                *in_force(as_of)
+            ).order_by(ReferenceRangeVersion.range_id)
+            serialize = reference_range_version_serializer.columnar if representation == 'columns' \
+                else reference_range_version_serializer.many
+            return json_response(serialize(rows)), 200, headers
+
+        if representation == 'columns':
+            rows = reference_range_serializer.query(session).filter_by(department_id=dept_id, created_by=user_id)
+            return json_response(reference_range_serializer.columnar(rows)), 200, headers
+
+        body = range_cache.get_or_load(
+            department_tests_key(dept_id, user_id),
+            lambda: dumps(reference_range_serializer.many(
+                reference_range_serializer.query(session).filter_by(department_id=dept_id, created_by=user_id)
+            )),
+            version=version
+        )
+        return json_response(body), 200, headers
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+@test_bp.route('/departments', methods=['GET'])
+@jwt_required()
+def get_departments():
+    session = get_session()
     try:
-        tests = session.query(ReferenceRange).filter_by(department_id=dept_id, created_by=user_id).all()
-        results = [{
-            "id": t.id,
-            "test_name": t.test_name,
-            "min_value": t.min_value,
-            "max_value": t.max_value,
-            "units": t.units,
-            "department_id": t.department_id,
-            "source_id": t.source_id,
-            "study_id": t.study_id,
-            "created_at": t.created_at.isoformat()
-        } for t in tests]
-        return jsonify(results), 200
+        body = range_cache.get_or_load(DEPARTMENTS_KEY, lambda: dumps(department_serializer.many(
+            department_serializer.query(session).order_by(Department.name)
+        )))
+        return json_response(body), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 400
-    finally:
-        session.close()
 
 @test_bp.route('/departments', methods=['POST'])
 @jwt_required()
 def create_department():
-    session = SessionLocal()
+    session = get_session()
     user_id = get_jwt_identity()
     
     try:
@@ -157,12 +472,95 @@ def create_department():
         
         session.add(new_department)
         session.commit()
+        range_cache.invalidate(DEPARTMENTS_KEY)
         
         return jsonify({"message": "Department created", "id": new_department.id}), 201
     
     except Exception as e:
         session.rollback()
         return jsonify({"error": str(e)}), 400
-    finally:
-        session.close()
 
+def _range_index(session, user_id):
+    # One version query per request; after a write only the changed
+    # analytes are re-read and rebuilt
+    cached = range_cache.get(range_index_key(user_id))
+    index = RangeIndex.current(session, user_id, cached)
+    if index is not cached:
+        range_cache.set(range_index_key(user_id), index)
+    return index
+
+def _index_as_of(session, user_id, as_of):
+    # The live index, or the version history seen at as_of
+    if as_of is None:
+        return _range_index(session, user_id)
+    cached = range_cache.get(version_index_key(user_id))
+    index = VersionIndex.current(session, user_id, cached)
+    if index is not cached:
+        range_cache.set(version_index_key(user_id), index)
+    return index.at(as_of)
+
+@test_bp.route('/tests/resolve', methods=['GET'])
+@jwt_required()
+def resolve_test():
+    user_id = get_jwt_identity()
+    session = get_read_session(user_id)
+    try:
+        test_name = request.args.get('test_name', '').strip()
+        units = request.args.get('units', '').strip()
+        if not test_name or not units:
+            return jsonify({"error": "Query parameters test_name and units are required"}), 400
+        pregnant = request.args.get('pregnant')
+        patient = parse_patient({
+            "age": request.args.get('age'),
+            "sex": request.args.get('sex'),
+            "pregnant": None if pregnant is None else pregnant.lower() in ('1', 'true', 'yes')
+        })
+        index = _index_as_of(session, user_id, parse_as_of(request.args.get('as_of')))
+        slot = index.lookup(test_name, units, patient)
+        if slot < 0:
+            return jsonify({"error": "No applicable range"}), 404
+        return jsonify(index.range_for(slot)), 200
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+@test_bp.route('/classify', methods=['POST'])
+@jwt_required()
+def classify():
+    user_id = get_jwt_identity()
+    session = get_read_session(user_id)
+    try:
+        payload = request.get_json()
+        test_names, values, units = parse_results(payload)
+        patient = parse_patient(payload.get('patient') if isinstance(payload, dict) else None)
+        as_of = payload.get('as_of') if isinstance(payload, dict) else None
+        # Every result is resolved in memory against the per-user index
+        index = _index_as_of(session, user_id, parse_as_of(as_of or request.args.get('as_of')))
+        results = classify_results(index, test_names, values, units, patient)
+        return jsonify({
+            "results": results,
+            "unmatched": sum(1 for r in results if r["flag"] is None)
+        }), 200
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+def is_stats_admin():
+    # Cache and pool internals are for operators, not every signed-in user
+    return str(get_jwt_identity()) in STATS_ADMIN_IDS
+
+@test_bp.route('/cache/stats', methods=['GET'])
+@jwt_required()
+def cache_stats():
+    if not is_stats_admin():
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(range_cache.stats()), 200
+
+@test_bp.route('/pool/stats', methods=['GET'])
+@jwt_required()
+def get_pool_stats():
+    if not is_stats_admin():
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(dict(pool_stats(), router=router_stats())), 200
@@ -1,4 +1,5 @@
-from marshmallow import Schema, fields, validate, ValidationError
+from marshmallow import Schema, fields, validate, validates_schema, ValidationError
+from app.models import SEXES
 
 class RegisterSchema(Schema):
     email = fields.Email(required=True)
@@ -17,3 +18,51 @@ class ReferenceRangeSchema(Schema):
     department_id = fields.Int(required=True)
     source_id = fields.Int(required=False, allow_none=True)
     study_id = fields.Int(required=False, allow_none=True)
+    sex = fields.Str(required=False, allow_none=True, validate=validate.OneOf(SEXES))
+    age_min = fields.Float(required=False, allow_none=True, validate=validate.Range(min=0))
+    age_max = fields.Float(required=False, allow_none=True, validate=validate.Range(min=0))
+    pregnancy = fields.Bool(required=False, allow_none=True)
+
+    @validates_schema
+    def check_age_band(self, data, **kwargs):
+        age_min, age_max = data.get('age_min'), data.get('age_max')
+        if age_min is not None and age_max is not None and age_min >= age_max:
+            raise ValidationError("age_min must be below age_max", 'age_max')
+
+
+class OneOrMany(fields.List):
+    # Accepts a single value or a list of values and always loads a list
+    def _deserialize(self, value, attr, data, **kwargs):
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        return super()._deserialize(value, attr, data, **kwargs)
+
+
+class RangeFilterSchema(Schema):
+    # Filter for bulk update/delete; fields are ANDed, list values are IN (...)
+    id = OneOrMany(fields.Int(), validate=validate.Length(min=1))
+    test_name = OneOrMany(fields.Str(), validate=validate.Length(min=1))
+    units = OneOrMany(fields.Str(), validate=validate.Length(min=1))
+    department_id = OneOrMany(fields.Int(), validate=validate.Length(min=1))
+    source_id = OneOrMany(fields.Int(), validate=validate.Length(min=1))
+    study_id = OneOrMany(fields.Int(), validate=validate.Length(min=1))
+
+    @validates_schema
+    def require_filter(self, data, **kwargs):
+        # An empty filter would touch every range the user owns
+        if not data:
+            raise ValidationError("At least one filter field is required")
+
+
+class BulkUpdateSchema(Schema):
+    filter = fields.Nested(RangeFilterSchema, required=True)
+    set = fields.Nested(ReferenceRangeSchema(partial=True), required=True)
+
+    @validates_schema
+    def require_values(self, data, **kwargs):
+        if not data.get('set'):
+            raise ValidationError("At least one field to set is required", 'set')
+
+
+class BulkDeleteSchema(Schema):
+    filter = fields.Nested(RangeFilterSchema, required=True)
@@ -0,0 +1,200 @@
+import heapq
+from sqlalchemy import case, func, or_
+from app.models import ReferenceRange
+
+# Common analyte abbreviations and shorthand, expanded at query time so
+# "alk phos" finds "Alkaline Phosphatase" and "hgb" finds "Hemoglobin"
+SYNONYMS = {
+    "a1c": ["hemoglobin a1c"],
+    "alb": ["albumin"],
+    "alk phos": ["alkaline phosphatase"],
+    "alp": ["alkaline phosphatase"],
+    "alt": ["alanine aminotransferase"],
+    "ast": ["aspartate aminotransferase"],
+    "bili": ["bilirubin"],
+    "bun": ["blood urea nitrogen", "urea nitrogen"],
+    "ca": ["calcium"],
+    "chol": ["cholesterol"],
+    "cl": ["chloride"],
+    "creat": ["creatinine"],
+    "cr": ["creatinine"],
+    "crp": ["c reactive protein", "c-reactive protein"],
+    "ferr": ["ferritin"],
+    "ggt": ["gamma glutamyl transferase"],
+    "glu": ["glucose"],
+    "hb": ["hemoglobin", "haemoglobin"],
+    "hct": ["hematocrit", "haematocrit"],
+    "hgb": ["hemoglobin", "haemoglobin"],
+    "inr": ["international normalized ratio"],
+    "k": ["potassium"],
+    "ldh": ["lactate dehydrogenase"],
+    "mcv": ["mean corpuscular volume"],
+    "mg": ["magnesium"],
+    "na": ["sodium"],
+    "phos": ["phosphorus", "phosphate"],
+    "plt": ["platelet", "platelets"],
+    "pt": ["prothrombin time"],
+    "ptt": ["partial thromboplastin time"],
+    "rbc": ["red blood cell", "erythrocyte"],
+    "tg": ["triglycerides"],
+    "trig": ["triglycerides"],
+    "tsh": ["thyroid stimulating hormone"],
+    "wbc": ["white blood cell", "leukocyte"],
+}
+
+# Match kinds in rank order
+EXACT, PREFIX, WORD_PREFIX, FUZZY = 0, 1, 2, 3
+MATCH_NAMES = {EXACT: "exact", PREFIX: "prefix", WORD_PREFIX: "word_prefix", FUZZY: "fuzzy"}
+
+
+def normalize(text):
+    return ' '.join(str(text).lower().replace('-', ' ').replace(',', ' ').split())
+
+
+def expand_query(q):
+    # Returns [(variant, is_synonym)] with the literal query first. An
+    # abbreviation matches the whole query, its leading words ("hgb a1c"),
+    # or a partially typed phrase ("alk" -> "alk phos").
+    q = normalize(q)
+    variants = {q: False}
+    for abbreviation, expansions in SYNONYMS.items():
+        if q == abbreviation or q.startswith(abbreviation + ' '):
+            rest = q[len(abbreviation):]
+        elif abbreviation.startswith(q + ' '):
+            rest = ''
+        else:
+            continue
+        for expansion in expansions:
+            variants.setdefault(normalize(expansion + rest), True)
+    return list(variants.items())
+
+
+def _like_escape(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class _TrieNode:
+    __slots__ = ('children', 'ids')
+
+    def __init__(self):
+        self.children = {}
+        self.ids = None
+
+
+class PrefixTrie:
+    # Word-level trie over distinct normalized test names. Each word of a
+    # name is inserted, so "phos" reaches "alkaline phosphatase". Catalogs
+    # repeat the same analyte across departments, so ranking works on names
+    # and only the winners are expanded back to rows.
+
+    def __init__(self, rows=()):
+        self._root = _TrieNode()
+        self._nodes = 1
+        self.names = {}
+        for row in rows:
+            self.add(row)
+
+    def __len__(self):
+        return sum(len(rows) for rows in self.names.values())
+
+    @property
+    def nbytes(self):
+        # Approximate footprint, used by the cache to size entries
+        return 200 * self._nodes + 300 * len(self)
+
+    def add(self, row):
+        name = normalize(row.test_name)
+        rows = self.names.get(name)
+        if rows is not None:
+            rows.append(row)
+            return
+        self.names[name] = [row]
+        for word in set(name.split()):
+            node = self._root
+            for char in word:
+                child = node.children.get(char)
+                if child is None:
+                    child = node.children[char] = _TrieNode()
+                    self._nodes += 1
+                node = child
+            if node.ids is None:
+                node.ids = set()
+            node.ids.add(name)
+
+    def prefix_names(self, prefix):
+        node = self._root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return set()
+        found, stack = set(), [node]
+        while stack:
+            node = stack.pop()
+            if node.ids:
+                found |= node.ids
+            stack.extend(node.children.values())
+        return found
+
+    def search(self, q, limit):
+        best = {}
+        for variant, is_synonym in expand_query(q):
+            tokens = variant.split()
+            if not tokens:
+                continue
+            # Smallest set first keeps the intersection cheap
+            candidate_sets = sorted((self.prefix_names(token) for token in tokens), key=len)
+            for name in set.intersection(*candidate_sets):
+                if name == variant:
+                    kind = EXACT
+                elif name.startswith(variant):
+                    kind = PREFIX
+                else:
+                    kind = WORD_PREFIX
+                key = (kind, is_synonym, len(name), name)
+                if name not in best or key < best[name]:
+                    best[name] = key
+
+        matches = []
+        for kind, _, _, name in heapq.nsmallest(limit, best.values()):
+            for row in sorted(self.names[name], key=lambda r: r.id):
+                matches.append((row, MATCH_NAMES[kind]))
+                if len(matches) == limit:
+                    return matches
+        return matches
+
+
+SEARCH_COLUMNS = (
+    ReferenceRange.id,
+    ReferenceRange.test_name,
+    ReferenceRange.min_value,
+    ReferenceRange.max_value,
+    ReferenceRange.units,
+    ReferenceRange.canonical_units,
+    ReferenceRange.canonical_min,
+    ReferenceRange.canonical_max,
+    ReferenceRange.department_id
+)
+
+
+def load_trie(session, user_id):
+    return PrefixTrie(session.query(*SEARCH_COLUMNS).filter_by(created_by=user_id))
+
+
+def search_postgres(session, user_id, q, limit):
+    # Served by the pg_trgm GIN index on lower(test_name): LIKE for prefix
+    # and word-prefix matches, the % operator for fuzzy ones
+    name = func.lower(ReferenceRange.test_name)
+    variants = [variant for variant, _ in expand_query(q)]
+    patterns = [_like_escape(variant) for variant in variants]
+
+    exact = or_(*(name == variant for variant in variants))
+    prefix = or_(*(name.like(pattern + '%', escape='\\') for pattern in patterns))
+    word_prefix = or_(*(name.like('% ' + pattern + '%', escape='\\') for pattern in patterns))
+    fuzzy = or_(*(name.op('%')(variant) for variant in variants))
+    kind = case((exact, EXACT), (prefix, PREFIX), (word_prefix, WORD_PREFIX), else_=FUZZY).label('kind')
+    score = func.greatest(*(func.similarity(name, variant) for variant in variants), 0).label('score')
+
+    rows = session.query(*SEARCH_COLUMNS, kind, score).filter(
+        ReferenceRange.created_by == user_id, or_(prefix, word_prefix, fuzzy)
+    ).order_by(kind, score.desc(), func.length(ReferenceRange.test_name)).limit(limit).all()
+    return [(row, MATCH_NAMES[row.kind]) for row in rows]
@@ -0,0 +1,139 @@
+import json
+from datetime import date, datetime
+from flask import Response
+from app.config import JSON_BACKEND
+from app.models import ReferenceRange, ReferenceRangeVersion, Department, Source, Study
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _dumps_orjson(obj):
+    return orjson.dumps(obj, default=_json_default)
+
+
+def _dumps_json(obj):
+    return json.dumps(obj, default=_json_default, separators=(',', ':')).encode()
+
+
+# Pluggable encoder: orjson when installed, stdlib json otherwise
+JSON_ENCODERS = {'json': _dumps_json}
+if orjson is not None:
+    JSON_ENCODERS['orjson'] = _dumps_orjson
+
+if JSON_BACKEND == 'auto':
+    dumps = JSON_ENCODERS.get('orjson', _dumps_json)
+elif JSON_BACKEND in JSON_ENCODERS:
+    dumps = JSON_ENCODERS[JSON_BACKEND]
+else:
+    raise RuntimeError(f"JSON_BACKEND {JSON_BACKEND!r} is not available")
+
+
+def json_response(payload, status=200):
+    # payload may be pre-encoded bytes, e.g. a cached body
+    body = payload if isinstance(payload, bytes) else dumps(payload)
+    return Response(body, status=status, mimetype='application/json')
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+class RowSerializer:
+    # Serializes rows selected as plain column tuples (never ORM objects).
+    # dict(zip(...)) builds each dict in C; only the few transformed fields
+    # are touched again in Python.
+
+    def __init__(self, *columns, transforms=None):
+        self.columns = columns
+        self.fields = fields = tuple(column.key for column in columns)
+        self.transforms = transforms = transforms or {}
+        transformed = tuple((field, fields.index(field), fn) for field, fn in transforms.items())
+
+        def to_dict(row):
+            data = dict(zip(fields, row))
+            for field, i, fn in transformed:
+                data[field] = fn(row[i])
+            return data
+
+        self.to_dict = to_dict
+
+    def query(self, session):
+        return session.query(*self.columns)
+
+    def many(self, rows):
+        to_dict = self.to_dict
+        return [to_dict(row) for row in rows]
+
+    def columnar(self, rows):
+        # One array per field instead of one object per row: field names are
+        # sent once and repeated values sit next to each other
+        values = list(zip(*rows)) or [()] * len(self.fields)
+        data = {}
+        for field, column in zip(self.fields, values):
+            transform = self.transforms.get(field)
+            data[field] = [transform(v) for v in column] if transform else list(column)
+        return data
+
+
+reference_range_serializer = RowSerializer(
+    ReferenceRange.id,
+    ReferenceRange.test_name,
+    ReferenceRange.min_value,
+    ReferenceRange.max_value,
+    ReferenceRange.units,
+    ReferenceRange.canonical_units,
+    ReferenceRange.canonical_min,
+    ReferenceRange.canonical_max,
+    ReferenceRange.sex,
+    ReferenceRange.age_min,
+    ReferenceRange.age_max,
+    ReferenceRange.pregnancy,
+    ReferenceRange.department_id,
+    ReferenceRange.source_id,
+    ReferenceRange.study_id,
+    ReferenceRange.created_at,
+    transforms={'created_at': _isoformat}
+)
+
+# A range as it stood at some time; id is the range id, as in the live list
+reference_range_version_serializer = RowSerializer(
+    ReferenceRangeVersion.range_id.label('id'),
+    ReferenceRangeVersion.test_name,
+    ReferenceRangeVersion.min_value,
+    ReferenceRangeVersion.max_value,
+    ReferenceRangeVersion.units,
+    ReferenceRangeVersion.canonical_units,
+    ReferenceRangeVersion.canonical_min,
+    ReferenceRangeVersion.canonical_max,
+    ReferenceRangeVersion.sex,
+    ReferenceRangeVersion.age_min,
+    ReferenceRangeVersion.age_max,
+    ReferenceRangeVersion.pregnancy,
+    ReferenceRangeVersion.department_id,
+    ReferenceRangeVersion.source_id,
+    ReferenceRangeVersion.study_id,
+    ReferenceRangeVersion.valid_from,
+    ReferenceRangeVersion.valid_to,
+    transforms={'valid_from': _isoformat, 'valid_to': _isoformat}
+)
+
+department_serializer = RowSerializer(Department.id, Department.name, Department.description)
+
+source_serializer = RowSerializer(Source.id, Source.name, Source.url, Source.source_type)
+
+study_serializer = RowSerializer(
+    Study.id,
+    Study.title,
+    Study.authors,
+    Study.publication_date,
+    transforms={'publication_date': _isoformat}
+)
@@ -0,0 +1,296 @@
+import csv
+import io
+from datetime import datetime, timedelta
+from sqlalchemy import (
+    Column, DateTime, Float, Integer, MetaData, Table, Text, bindparam, func, insert, select, text, update
+)
+from app.cache import DEPARTMENTS_KEY, invalidate_ranges, range_cache
+from app.config import SYNC_CHUNK_SIZE, SYNC_WATERMARK_LAG_SECONDS
+from app.models import Department, ReferenceRange, Source
+from app.units import canonical_range
+from app.versions import record_versions
+
+# Sync between the go-service reference_ranges table (unit, free-text
+# category and source) and the Python models (units, Department and Source
+# foreign keys).
+#
+# go-service rows are read through yield_per partitions (a server-side
+# cursor where the driver has one); Python rows are walked in id order one
+# chunk at a time, since each chunk commits on that same database. Writes
+# are one transaction per chunk, and new rows go in with COPY on PostgreSQL.
+# Category and source names resolve through lookups loaded once per run.
+# Rows are linked by ReferenceRange.external_id (the go-service id), so
+# re-running a sync updates instead of duplicating, and rows whose mapped
+# values did not change are not written, so a pull followed by a push does
+# not echo every row back.
+#
+# Each run reports a watermark, like export-ranges: pass it as since to the
+# next run to pick up only rows changed after it. Deletes are not synced.
+# Change times are stamped before commit, so the watermark trails the clock
+# by SYNC_WATERMARK_LAG_SECONDS; rows changed within the lag are read again
+# next run and come out unchanged.
+
+go_metadata = MetaData()
+
+# Mirrors go-service/internal/db/migrations/*_create_reference_ranges_table.up.sql
+go_ranges = Table(
+    'reference_ranges', go_metadata,
+    Column('id', Integer, primary_key=True),
+    Column('test_name', Text, nullable=False),
+    Column('min_value', Float, nullable=False),
+    Column('max_value', Float, nullable=False),
+    Column('unit', Text, nullable=False),
+    Column('category', Text, nullable=False),
+    Column('source', Text),
+    Column('created_at', DateTime),
+    Column('updated_at', DateTime),
+)
+
+# Sources created for go-service names that have no Source row yet
+SYNC_SOURCE_TYPE = 'go-service'
+
+GO_CHANGED_AT = func.coalesce(go_ranges.c.updated_at, go_ranges.c.created_at)
+
+_ranges = ReferenceRange.__table__
+
+# Core executemany keyed on the primary key; the SET clause comes from the
+# keys of the parameter dicts
+_PULL_UPDATE = update(_ranges).where(_ranges.c.id == bindparam('range_id'))
+_PUSH_UPDATE = update(go_ranges).where(go_ranges.c.id == bindparam('go_id'))
+
+PULL_FIELDS = ('test_name', 'min_value', 'max_value', 'units', 'department_id', 'source_id')
+PUSH_FIELDS = ('test_name', 'min_value', 'max_value', 'unit', 'category', 'source')
+
+
+class NameLookup:
+    # name -> id for Department or Source, read once per run. Names not in
+    # the table yet are inserted on first use.
+
+    def __init__(self, session, model, **defaults):
+        self.session = session
+        self.table = model.__table__
+        self.defaults = defaults
+        self.ids = dict(session.execute(select(self.table.c.name, self.table.c.id)).all())
+        self.created = 0
+
+    def id_for(self, name):
+        if name is None or not name.strip():
+            return None
+        name = name.strip()
+        ident = self.ids.get(name)
+        if ident is None:
+            ident = self.session.execute(
+                insert(self.table).values(name=name, **self.defaults).returning(self.table.c.id)
+            ).scalar_one()
+            self.ids[name] = ident
+            self.created += 1
+        return ident
+
+
+def iter_chunks(connection, stmt, chunk_size):
+    return connection.execute(stmt.execution_options(yield_per=chunk_size)).partitions()
+
+
+def supports_copy(connection):
+    return connection.dialect.name == 'postgresql' and connection.dialect.driver in ('psycopg2', 'psycopg')
+
+
+def copy_rows(connection, table, columns, rows):
+    # COPY ... FROM STDIN in CSV. QUOTE_NONNUMERIC quotes every string, so
+    # an empty string stays '' while None is written bare and loads as NULL.
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+    quote = connection.dialect.identifier_preparer.quote
+    sql = f"COPY {quote(table.name)} ({', '.join(quote(c) for c in columns)}) FROM STDIN WITH (FORMAT csv)"
+    cursor = connection.connection.dbapi_connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            buffer.seek(0)
+            cursor.copy_expert(sql, buffer)
+        else:
+            with cursor.copy(sql) as copy:
+                copy.write(buffer.getvalue())
+    finally:
+        cursor.close()
+
+
+def lagged(watermark):
+    # The watermark to report: a row stamped before it may still have been
+    # uncommitted when this run read, so hold it back by the lag
+    return min(watermark, datetime.utcnow() - timedelta(seconds=SYNC_WATERMARK_LAG_SECONDS))
+
+
+def _changed(row, current, fields):
+    return any(row[field] != current[field] for field in fields)
+
+
+def pull(session, go_connection, user_id, since=None, chunk_size=SYNC_CHUNK_SIZE):
+    # go-service -> Python, into ranges owned by user_id
+    result = {"read": 0, "inserted": 0, "updated": 0, "unchanged": 0, "watermark": since}
+    watermark = go_connection.execute(select(func.max(GO_CHANGED_AT))).scalar()
+    if watermark is None:
+        return result
+
+    departments = NameLookup(session, Department)
+    sources = NameLookup(session, Source, source_type=SYNC_SOURCE_TYPE)
+    stmt = select(go_ranges, GO_CHANGED_AT.label('changed_at')).where(GO_CHANGED_AT <= watermark)
+    if since is not None:
+        stmt = stmt.where(GO_CHANGED_AT > since)
+    use_copy = supports_copy(session.connection())
+
+    for chunk in iter_chunks(go_connection, stmt.order_by(go_ranges.c.id), chunk_size):
+        # The Python updated_at is the time of this write, not the go-service
+        # one: ETags, exports and the range index all watermark on it
+        now = datetime.utcnow()
+        rows = [{
+            "test_name": row.test_name,
+            "min_value": row.min_value,
+            "max_value": row.max_value,
+            "units": row.unit,
+            **canonical_range(row.test_name, row.unit, row.min_value, row.max_value),
+            "department_id": departments.id_for(row.category),
+            "source_id": sources.id_for(row.source),
+            "created_by": user_id,
+            "created_at": row.created_at or now,
+            "updated_at": now,
+            "external_id": row.id,
+        } for row in chunk]
+        existing = {
+            current.external_id: current for current in session.execute(
+                select(_ranges.c.id, _ranges.c.external_id, *(_ranges.c[field] for field in PULL_FIELDS))
+                .where(_ranges.c.created_by == user_id, _ranges.c.external_id.in_([r["external_id"] for r in rows]))
+            ).mappings()
+        }
+
+        inserts, updates = [], []
+        for row in rows:
+            current = existing.get(row["external_id"])
+            if current is None:
+                inserts.append(row)
+            elif _changed(row, current, PULL_FIELDS):
+                values = {k: v for k, v in row.items() if k not in ('created_by', 'created_at', 'external_id')}
+                updates.append(dict(values, range_id=current["id"]))
+        if inserts:
+            if use_copy:
+                copy_rows(session.connection(), _ranges, list(inserts[0]), inserts)
+            else:
+                session.execute(insert(_ranges), inserts)
+        if updates:
+            session.execute(_PULL_UPDATE, updates)
+        if inserts or updates:
+            record_versions(session, ReferenceRange.created_by == user_id, ReferenceRange.updated_at == now)
+        session.commit()
+
+        result["read"] += len(rows)
+        result["inserted"] += len(inserts)
+        result["updated"] += len(updates)
+        result["unchanged"] += len(rows) - len(inserts) - len(updates)
+
+    if departments.created:
+        range_cache.invalidate(DEPARTMENTS_KEY)
+    invalidate_ranges(user_id, departments.ids.values())
+    result["watermark"] = lagged(watermark)
+    return result
+
+
+def _allocate_go_ids(go_connection, rows):
+    # Inserts new go-service rows and returns their ids in row order. On
+    # PostgreSQL the ids are drawn from the serial sequence up front so the
+    # rows can go in with COPY.
+    if supports_copy(go_connection):
+        ids = go_connection.execute(
+            text("SELECT nextval(pg_get_serial_sequence('reference_ranges', 'id')) FROM generate_series(1, :n)"),
+            {"n": len(rows)}
+        ).scalars().all()
+        copy_rows(go_connection, go_ranges, ['id', *rows[0]], [dict(row, id=ident) for row, ident in zip(rows, ids)])
+        return ids
+    return go_connection.execute(
+        insert(go_ranges).returning(go_ranges.c.id, sort_by_parameter_order=True), rows
+    ).scalars().all()
+
+
+def push(session, go_connection, user_id=None, since=None, chunk_size=SYNC_CHUNK_SIZE):
+    # Python -> go-service. The go-service columns are NOT NULL, so ranges
+    # without both bounds or units are skipped.
+    result = {"read": 0, "inserted": 0, "updated": 0, "unchanged": 0, "skipped": 0, "watermark": since}
+    filters = [ReferenceRange.created_by == user_id] if user_id is not None else []
+    watermark = session.execute(select(func.max(ReferenceRange.updated_at)).where(*filters)).scalar()
+    if watermark is None:
+        return result
+
+    columns = (
+        ReferenceRange.id, ReferenceRange.external_id, ReferenceRange.test_name, ReferenceRange.min_value,
+        ReferenceRange.max_value, ReferenceRange.units, Department.name.label('category'),
+        Source.name.label('source'), ReferenceRange.created_at, ReferenceRange.updated_at
+    )
+    stmt = (
+        select(*columns)
+        .select_from(ReferenceRange)
+        .join(Department, ReferenceRange.department_id == Department.id)
+        .outerjoin(Source, ReferenceRange.source_id == Source.id)
+        .where(*filters, ReferenceRange.updated_at <= watermark)
+        .order_by(ReferenceRange.id)
+        .limit(chunk_size)
+    )
+    if since is not None:
+        stmt = stmt.where(ReferenceRange.updated_at > since)
+
+    after_id = None
+    while True:
+        chunk_stmt = stmt if after_id is None else stmt.where(ReferenceRange.id > after_id)
+        chunk = session.execute(chunk_stmt).all()
+        if not chunk:
+            break
+        after_id = chunk[-1].id
+        result["read"] += len(chunk)
+        valid = [row for row in chunk if None not in (row.min_value, row.max_value, row.units)]
+        result["skipped"] += len(chunk) - len(valid)
+        rows = [({
+            "test_name": row.test_name,
+            "min_value": row.min_value,
+            "max_value": row.max_value,
+            "unit": row.units,
+            "category": row.category,
+            "source": row.source,
+            "updated_at": row.updated_at,
+        }, row) for row in valid]
+        linked = [row.external_id for row in valid if row.external_id is not None]
+        existing = {
+            current["id"]: current for current in go_connection.execute(
+                select(go_ranges.c.id, *(go_ranges.c[field] for field in PUSH_FIELDS))
+                .where(go_ranges.c.id.in_(linked))
+            ).mappings()
+        } if linked else {}
+
+        inserts, updates = [], []
+        for values, row in rows:
+            current = existing.get(row.external_id)
+            # A link to a row deleted on the go-service side is re-created
+            if current is None:
+                inserts.append((dict(values, created_at=row.created_at), row))
+            elif _changed(values, current, PUSH_FIELDS):
+                updates.append(dict(values, go_id=row.external_id))
+        if updates:
+            go_connection.execute(_PUSH_UPDATE, updates)
+        if inserts:
+            ids = _allocate_go_ids(go_connection, [values for values, _ in inserts])
+        go_connection.commit()
+        if inserts:
+            # Linked after the go-service commit: a failure in between leaves
+            # rows that the next push inserts again, never links to missing
+            # rows. updated_at is written back unchanged so linking is not
+            # itself a change.
+            session.execute(_PULL_UPDATE, [
+                {"range_id": row.id, "external_id": ident, "updated_at": row.updated_at}
+                for (_, row), ident in zip(inserts, ids)
+            ])
+            session.commit()
+
+        result["inserted"] += len(inserts)
+        result["updated"] += len(updates)
+        result["unchanged"] += len(valid) - len(inserts) - len(updates)
+
+    result["watermark"] = lagged(watermark)
+    return result
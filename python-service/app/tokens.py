@@ -0,0 +1,294 @@
+import hashlib
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+import flask_jwt_extended
+import jwt
+from flask_jwt_extended import JWTManager, view_decorators
+from sqlalchemy import delete, func, select
+from app.cache import LRUCache
+from app.config import (
+    JWT_ALGORITHM, JWT_PRIVATE_KEY_PATH, JWT_PUBLIC_KEY_PATHS, TOKEN_CACHE_ENABLED, TOKEN_CACHE_MAX_ENTRIES,
+    TOKEN_CACHE_TTL_SECONDS, TOKEN_REVOCATION_CAPACITY, TOKEN_REVOCATION_ERROR_RATE,
+    TOKEN_REVOCATION_REFRESH_SECONDS
+)
+from app.database import SessionLocal
+from app.models import RevokedToken
+
+# JWT verification fast path. Decoded claims are cached by token hash, so
+# a repeat request costs one dict lookup instead of a signature check and
+# claims parse. Revocation is checked on every request, cache hit or not,
+# against an in-memory bloom filter; only a positive goes to the database.
+
+SYMMETRIC_ALGORITHMS = {'HS256', 'HS384', 'HS512'}
+
+# Tokens issued without an exp are recorded as revoked until this date
+NO_EXPIRY = datetime(9999, 12, 31)
+
+token_cache = LRUCache(max_entries=TOKEN_CACHE_MAX_ENTRIES, ttl=TOKEN_CACHE_TTL_SECONDS, enabled=TOKEN_CACHE_ENABLED)
+
+
+def token_key(encoded_token):
+    return hashlib.sha256(encoded_token.encode()).digest()
+
+
+# flask_jwt_extended decodes every token, jwt_required included, through
+# its public decode_token, which view_decorators calls by that name. The
+# cached decode_token below wraps it and is installed in its place there.
+# A release that stops resolving it that way gets the plain, uncached
+# decode rather than a wrapper that is no longer called.
+_decode_token = flask_jwt_extended.decode_token
+
+
+def decode_token(encoded_token, csrf_value=None, allow_expired=False):
+    # CSRF and allow_expired decodes are rare and always take the full path.
+    if csrf_value is not None or allow_expired:
+        return _decode_token(encoded_token, csrf_value, allow_expired)
+    key = token_key(encoded_token)
+    claims = token_cache.get(key)
+    if claims is None:
+        claims = _decode_token(encoded_token)
+        remaining = claims['exp'] - time.time() if 'exp' in claims else token_cache.ttl
+        if remaining > 0:
+            token_cache.set(key, claims, ttl=min(remaining, token_cache.ttl))
+    # Callers get their own copy; the cached claims stay untouched
+    return dict(claims)
+
+
+def supports_decode_cache():
+    return getattr(view_decorators, 'decode_token', None) in (_decode_token, decode_token)
+
+
+class KeyRing:
+    # Parsed keys for the asymmetric algorithms. PyJWT would otherwise parse
+    # the PEM on every encode and decode, which costs more than the
+    # signature check itself.
+
+    def __init__(self, private_key_path=None, public_key_paths=()):
+        from cryptography.hazmat.primitives.serialization import load_pem_private_key, load_pem_public_key
+
+        self.signing_kid = self.private_key = None
+        if private_key_path:
+            with open(private_key_path, 'rb') as f:
+                self.private_key = load_pem_private_key(f.read(), password=None)
+            self.signing_kid = key_id(private_key_path)
+        self.public_keys = {}
+        for path in public_key_paths:
+            with open(path, 'rb') as f:
+                self.public_keys[key_id(path)] = load_pem_public_key(f.read())
+        if self.private_key is not None and self.signing_kid not in self.public_keys:
+            self.public_keys[self.signing_kid] = self.private_key.public_key()
+        if not self.public_keys:
+            raise ValueError("JWT_PUBLIC_KEY_PATHS or JWT_PRIVATE_KEY_PATH is required for asymmetric JWTs")
+
+    def encode_key(self, identity):
+        if self.private_key is None:
+            raise RuntimeError("JWT_PRIVATE_KEY_PATH is required to issue tokens")
+        return self.private_key
+
+    def decode_key(self, headers, claims):
+        kid = headers.get('kid')
+        if kid is None and len(self.public_keys) == 1:
+            return next(iter(self.public_keys.values()))
+        key = self.public_keys.get(kid)
+        if key is None:
+            raise jwt.InvalidSignatureError("Unknown signing key")
+        return key
+
+    def headers(self, identity):
+        return {'kid': self.signing_kid} if self.signing_kid else {}
+
+
+def key_id(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+class BloomFilter:
+    # Fixed-size bit array with k probes from double hashing one blake2b
+    # digest. Sized for capacity items at the given false-positive rate.
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.probes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * step) % self.size for i in range(self.probes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class RevocationList:
+    # Revoked token ids (jti). is_revoked() is a bloom filter probe; a
+    # positive (a revoked token, or a rare false positive) is confirmed
+    # against the table and confirmed revocations are remembered. Every
+    # refresh_seconds the filter picks up rows revoked since its watermark,
+    # which is how revocations made on other workers arrive. It is rebuilt
+    # from the unexpired rows when it fills up. Local revocations made while
+    # a refresh reads its snapshot are re-applied to the filter it swaps in.
+
+    def __init__(self, session_factory=SessionLocal, capacity=TOKEN_REVOCATION_CAPACITY,
+                 error_rate=TOKEN_REVOCATION_ERROR_RATE, refresh_seconds=TOKEN_REVOCATION_REFRESH_SECONDS,
+                 clock=time.monotonic):
+        self.session_factory = session_factory
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh_seconds = refresh_seconds
+        self._clock = clock
+        self._filter = BloomFilter(capacity, error_rate)
+        self._confirmed = LRUCache(max_entries=4096, ttl=3600)
+        # Highest row id read, and how many rows at or below it were read
+        self._watermark = 0
+        self._known = 0
+        self._next_refresh = 0.0
+        self._refresh_lock = threading.Lock()
+        # Guards the filter swap against revoke(), and the jtis revoked here
+        # since the running refresh took its snapshot
+        self._lock = threading.Lock()
+        self._revoked_since = []
+        self.checks = self.positives = self.false_positives = self.refreshes = self.rebuilds = 0
+
+    def needs_refresh(self):
+        return self._clock() >= self._next_refresh
+
+    def refresh(self, force=False):
+        if not (force or self.needs_refresh()):
+            return
+        # One thread refreshes; the rest keep probing the current filter
+        if not self._refresh_lock.acquire(blocking=force):
+            return
+        try:
+            with self._lock:
+                self._revoked_since = []
+            session = self.session_factory()
+            try:
+                # Rows are read past the id watermark. Ids are drawn before
+                # commit, so a revocation can still land below it; that, or
+                # a prune, changes the count at or below the watermark and
+                # forces a full reload, as does a full filter.
+                rebuild = self._filter.count >= self._filter.capacity or self._known != session.scalar(
+                    select(func.count(RevokedToken.id)).where(RevokedToken.id <= self._watermark)
+                )
+                stmt = select(RevokedToken.id, RevokedToken.jti, RevokedToken.expires_at)
+                if not rebuild:
+                    stmt = stmt.where(RevokedToken.id > self._watermark)
+                rows = session.execute(stmt).all()
+            finally:
+                session.close()
+
+            now = datetime.utcnow()
+            target, watermark, known = self._filter, self._watermark, self._known
+            if rebuild:
+                live = sum(1 for row in rows if row.expires_at > now)
+                target = BloomFilter(max(self.capacity, 2 * live), self.error_rate)
+                watermark, known = 0, 0
+                self.rebuilds += 1
+            for ident, jti, expires_at in rows:
+                # Expired rows only count; their tokens are rejected anyway
+                if expires_at > now:
+                    target.add(jti)
+                watermark = max(watermark, ident)
+                known += 1
+            with self._lock:
+                # An incremental refresh keeps the live filter, which has them
+                if rebuild:
+                    for jti in self._revoked_since:
+                        target.add(jti)
+                self._filter, self._watermark, self._known = target, watermark, known
+            self._next_refresh = self._clock() + self.refresh_seconds
+            self.refreshes += 1
+        finally:
+            self._refresh_lock.release()
+
+    def might_be_revoked(self, jti):
+        # Filter probe only, no database access; for the ASGI fast path
+        return jti in self._filter
+
+    def is_revoked(self, jti):
+        self.refresh()
+        self.checks += 1
+        if jti not in self._filter:
+            return False
+        self.positives += 1
+        if self._confirmed.get(jti):
+            return True
+        session = self.session_factory()
+        try:
+            revoked = session.execute(select(RevokedToken.id).filter_by(jti=jti)).first() is not None
+        finally:
+            session.close()
+        if revoked:
+            self._confirmed.set(jti, True)
+        else:
+            self.false_positives += 1
+        return revoked
+
+    def revoke(self, session, claims, user_id=None):
+        exp = claims.get('exp')
+        session.add(RevokedToken(
+            jti=claims['jti'],
+            user_id=user_id,
+            expires_at=datetime.utcfromtimestamp(exp) if exp is not None else NO_EXPIRY
+        ))
+        session.commit()
+        with self._lock:
+            self._filter.add(claims['jti'])
+            self._revoked_since.append(claims['jti'])
+        self._confirmed.set(claims['jti'], True)
+
+    def prune(self, session, grace=timedelta(0)):
+        result = session.execute(delete(RevokedToken).where(RevokedToken.expires_at < datetime.utcnow() - grace))
+        session.commit()
+        return result.rowcount
+
+    def stats(self):
+        return {
+            "entries": self._filter.count,
+            "capacity": self._filter.capacity,
+            "bits": self._filter.size,
+            "probes": self._filter.probes,
+            "checks": self.checks,
+            "positives": self.positives,
+            "false_positives": self.false_positives,
+            "refreshes": self.refreshes,
+            "rebuilds": self.rebuilds
+        }
+
+
+revocations = RevocationList()
+
+
+def init_app(app):
+    app.config['JWT_ALGORITHM'] = JWT_ALGORITHM
+    jwt_manager = JWTManager(app)
+    if supports_decode_cache():
+        view_decorators.decode_token = decode_token
+    else:
+        app.logger.warning("Verified-token cache disabled: unsupported flask-jwt-extended %s",
+                           flask_jwt_extended.__version__)
+
+    if JWT_ALGORITHM not in SYMMETRIC_ALGORITHMS:
+        keys = KeyRing(JWT_PRIVATE_KEY_PATH, JWT_PUBLIC_KEY_PATHS)
+        jwt_manager.encode_key_loader(keys.encode_key)
+        jwt_manager.decode_key_loader(keys.decode_key)
+        jwt_manager.additional_headers_loader(keys.headers)
+
+    @jwt_manager.token_in_blocklist_loader
+    def token_revoked(jwt_header, jwt_payload):
+        return revocations.is_revoked(jwt_payload['jti'])
+
+    return jwt_manager
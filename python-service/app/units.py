@@ -0,0 +1,237 @@
+import re
+from functools import lru_cache
+import numpy as np
+from sqlalchemy import bindparam, event, select, update
+from app.config import UNIT_NORMALIZE_CHUNK_SIZE
+from app.models import ReferenceRange, ReferenceRangeVersion
+from app.search import SYNONYMS
+
+# Unit parsing and conversion. Every unit string is parsed once into a
+# dimension and a factor to that dimension's base unit (g/L, mol/L, eq/L,
+# U/L, cells/L, %). Mass and equivalent concentrations of analytes with a
+# known molar mass / valence are converted to molar, so "Glucose mg/dL"
+# and "Glucose mmol/L" land on the same canonical unit. Unknown units pass
+# through unchanged (normalized) with a factor of 1.
+
+MASS, MOLAR, EQUIVALENT, ACTIVITY, COUNT, PERCENT = 'mass', 'molar', 'equivalent', 'activity', 'count', 'percent'
+
+# Canonical unit per dimension, with its size in the base unit
+CANONICAL_UNITS = {
+    MASS: ('g/L', 1.0),
+    MOLAR: ('mmol/L', 1e-3),
+    EQUIVALENT: ('mEq/L', 1e-3),
+    ACTIVITY: ('U/L', 1.0),
+    COUNT: ('10^9/L', 1e9),
+    PERCENT: ('%', 1.0),
+}
+
+# g/mol, using the conventions labs report in (phosphate as P, urea
+# nitrogen as N2, triglycerides as triolein)
+MOLAR_MASSES = {
+    "ammonia": 17.031,
+    "bicarbonate": 61.017,
+    "bilirubin": 584.66,
+    "direct bilirubin": 584.66,
+    "calcium": 40.078,
+    "ionized calcium": 40.078,
+    "chloride": 35.453,
+    "cholesterol": 386.65,
+    "hdl cholesterol": 386.65,
+    "ldl cholesterol": 386.65,
+    "creatinine": 113.12,
+    "glucose": 180.156,
+    "iron": 55.845,
+    "lactate": 89.07,
+    "magnesium": 24.305,
+    "phosphate": 30.974,
+    "phosphorus": 30.974,
+    "potassium": 39.098,
+    "sodium": 22.990,
+    "triglycerides": 885.7,
+    "urea": 60.06,
+    "urea nitrogen": 28.014,
+    "uric acid": 168.11,
+}
+
+VALENCES = {
+    "bicarbonate": 1,
+    "calcium": 2,
+    "ionized calcium": 2,
+    "chloride": 1,
+    "magnesium": 2,
+    "potassium": 1,
+    "sodium": 1,
+}
+
+# Words that qualify the specimen rather than name the analyte
+QUALIFIERS = {"serum", "plasma", "blood", "whole", "fasting", "random", "total", "level", "s", "p"}
+
+PREFIXES = {'': 1.0, 'k': 1e3, 'd': 1e-1, 'c': 1e-2, 'm': 1e-3, 'u': 1e-6, 'n': 1e-9, 'p': 1e-12, 'f': 1e-15}
+
+_MASS = re.compile(r'^([kdcmunpf]?)g$')
+_MOLAR = re.compile(r'^([munpf]?)mol$')
+_EQUIVALENT = re.compile(r'^([mu]?)eq$')
+_ACTIVITY = re.compile(r'^([kmu]?)i?u$')
+_COUNT = re.compile(r'^(?:x?10(?:\^|\*|e)(\d+)|(k|thou)|(m|mil)|cells|)$')
+_VOLUME = re.compile(r'^([dcmunf]?)l$')
+
+
+def normalize_units(units):
+    return ''.join(str(units or '').split()).lower()
+
+
+@lru_cache(maxsize=None)
+def parse_unit(units):
+    # Returns (dimension, factor to the base unit) or None if not understood
+    text = normalize_units(units).replace('µ', 'u').replace('μ', 'u').replace('×', 'x')
+    if text == '%':
+        return PERCENT, 1.0
+    if text.count('/') != 1:
+        return None
+    numerator, denominator = text.split('/')
+
+    volume = _VOLUME.match(denominator)
+    if volume is None:
+        return None
+    per_litre = 1.0 / PREFIXES[volume.group(1)]
+
+    for dimension, pattern in ((MASS, _MASS), (MOLAR, _MOLAR), (EQUIVALENT, _EQUIVALENT), (ACTIVITY, _ACTIVITY)):
+        match = pattern.match(numerator)
+        if match:
+            return dimension, PREFIXES[match.group(1)] * per_litre
+
+    match = _COUNT.match(numerator)
+    if match:
+        exponent, thousands, millions = match.groups()
+        scale = 10.0 ** int(exponent) if exponent else 1e3 if thousands else 1e6 if millions else 1.0
+        return COUNT, scale * per_litre
+    return None
+
+
+@lru_cache(maxsize=None)
+def analyte_key(test_name):
+    # "Glucose, Fasting (Serum)" -> "glucose"; abbreviations go through the
+    # search synonyms, so "BUN" resolves to "urea nitrogen"
+    name = ' '.join(re.sub(r'[^a-z0-9 ]', ' ', str(test_name).lower()).split())
+    stripped = ' '.join(word for word in name.split() if word not in QUALIFIERS) or name
+    for candidate in (name, stripped):
+        if candidate in MOLAR_MASSES:
+            return candidate
+        for expansion in SYNONYMS.get(candidate, ()):
+            expansion = ' '.join(word for word in expansion.split() if word not in QUALIFIERS)
+            if expansion in MOLAR_MASSES:
+                return expansion
+    return stripped
+
+
+@lru_cache(maxsize=65536)
+def to_canonical(test_name, units):
+    # (canonical units, factor): canonical value = value * factor
+    parsed = parse_unit(units)
+    if parsed is None:
+        return normalize_units(units), 1.0
+    dimension, factor = parsed
+    analyte = analyte_key(test_name)
+    if dimension == MASS and analyte in MOLAR_MASSES:
+        dimension, factor = MOLAR, factor / MOLAR_MASSES[analyte]
+    elif dimension == EQUIVALENT and analyte in VALENCES:
+        dimension, factor = MOLAR, factor / VALENCES[analyte]
+    canonical, size = CANONICAL_UNITS[dimension]
+    return canonical, factor / size
+
+
+@lru_cache(maxsize=65536)
+def conversion_factor(test_name, from_units, to_units):
+    # Factor from one unit to another for this analyte, or None if the two
+    # units measure different things
+    from_canonical, from_factor = to_canonical(test_name, from_units)
+    to_canonical_units, to_factor = to_canonical(test_name, to_units)
+    if from_canonical != to_canonical_units:
+        return None
+    return from_factor / to_factor
+
+
+def convert(value, factor):
+    return None if value is None or factor is None else value * factor
+
+
+def canonical_range(test_name, units, min_value, max_value):
+    canonical, factor = to_canonical(test_name, units)
+    return {
+        "canonical_units": canonical,
+        "canonical_min": convert(min_value, factor),
+        "canonical_max": convert(max_value, factor),
+    }
+
+
+# ORM writes (create_test, update_test) fill the canonical columns here;
+# the bulk paths set them explicitly or call refresh_canonical
+@event.listens_for(ReferenceRange, 'before_insert')
+@event.listens_for(ReferenceRange, 'before_update')
+def _set_canonical_range(mapper, connection, target):
+    for key, value in canonical_range(target.test_name, target.units, target.min_value, target.max_value).items():
+        setattr(target, key, value)
+
+
+CONVERSION_INPUTS = {'test_name', 'units', 'min_value', 'max_value'}
+
+_ranges = ReferenceRange.__table__
+_versions = ReferenceRangeVersion.__table__
+
+# Core executemany keyed on the primary key; skips the ORM bulk-update layer.
+# The canonical columns are derived data, so updated_at is written back
+# unchanged: otherwise the column's onupdate would restamp every row and
+# ETags, export and sync watermarks would see the whole catalog as changed.
+_CANONICAL_UPDATE = (
+    update(_ranges)
+    .where(_ranges.c.id == bindparam('ident'))
+    .values(canonical_units=bindparam('canonical_units'), canonical_min=bindparam('canonical_min'),
+            canonical_max=bindparam('canonical_max'), updated_at=_ranges.c.updated_at)
+)
+
+# The same values for the range's current version (see app.versions)
+_OPEN_VERSION_UPDATE = (
+    update(_versions)
+    .where(_versions.c.range_id == bindparam('ident'), _versions.c.valid_to.is_(None))
+    .values(canonical_units=bindparam('canonical_units'), canonical_min=bindparam('canonical_min'),
+            canonical_max=bindparam('canonical_max'))
+)
+
+
+def refresh_canonical(session, *criteria, chunk_size=UNIT_NORMALIZE_CHUNK_SIZE, commit=False, open_versions=False):
+    # Recomputes the canonical columns for every matching row, walking the
+    # table in id order one chunk at a time. Factors come from the cached
+    # table; the multiply is one NumPy operation per chunk and the write is
+    # one executemany UPDATE by primary key. open_versions also corrects the
+    # rows' current versions in place; leave it off when the caller records
+    # a new version for the write itself.
+    columns = (ReferenceRange.id, ReferenceRange.test_name, ReferenceRange.units,
+               ReferenceRange.min_value, ReferenceRange.max_value)
+    total, after_id = 0, None
+    while True:
+        stmt = select(*columns).where(*criteria).order_by(ReferenceRange.id).limit(chunk_size)
+        if after_id is not None:
+            stmt = stmt.where(ReferenceRange.id > after_id)
+        rows = session.execute(stmt).all()
+        if not rows:
+            return total
+
+        ids, names, units, mins, maxs = zip(*rows)
+        targets = [to_canonical(name, unit) for name, unit in zip(names, units)]
+        factors = np.fromiter((factor for _, factor in targets), dtype=np.float64, count=len(rows))
+        # None bounds become NaN and are written back as NULL
+        low = np.array(mins, dtype=np.float64) * factors
+        high = np.array(maxs, dtype=np.float64) * factors
+        values = [{
+            "ident": range_id,
+            "canonical_units": canonical,
+            "canonical_min": None if np.isnan(lo) else lo,
+            "canonical_max": None if np.isnan(hi) else hi,
+        } for range_id, (canonical, _), lo, hi in zip(ids, targets, low.tolist(), high.tolist())]
+        session.execute(_CANONICAL_UPDATE, values)
+        if open_versions:
+            session.execute(_OPEN_VERSION_UPDATE, values)
+        if commit:
+            session.commit()
+        total += len(rows)
+        after_id = ids[-1]
@@ -0,0 +1,247 @@
+import copy
+import math
+import sys
+from bisect import bisect_right
+import numpy as np
+from sqlalchemy import func, insert, or_, select, update
+from app.classify import UNKNOWN_PATIENT, AnalyteRanges, RangeIndex, range_key
+from app.export import parse_since
+from app.models import ReferenceRange, ReferenceRangeVersion
+from app.units import to_canonical
+
+# Point-in-time reads of reference ranges. Every write appends a version
+# (see ReferenceRangeVersion) in the writing transaction, so the history is
+# exactly what was committed. Lists "as of" a time are one indexed query on
+# the versions table; lookups and classification go through VersionIndex,
+# which holds every version of a user's ranges and answers for any instant
+# from memory.
+
+# Copied from reference_ranges into each version
+VERSIONED_FIELDS = (
+    'test_name', 'min_value', 'max_value', 'units', 'canonical_units', 'canonical_min', 'canonical_max',
+    'sex', 'age_min', 'age_max', 'pregnancy', 'department_id', 'source_id', 'study_id', 'created_by'
+)
+
+_versions = ReferenceRangeVersion.__table__
+_ranges = ReferenceRange.__table__
+
+
+def record_versions(session, *criteria):
+    # Called in the writing transaction once the ranges matching criteria
+    # are inserted or updated: closes their open versions at the write's
+    # updated_at and opens one holding the values just written. Two
+    # set-based statements however many rows matched.
+    written_at = select(_ranges.c.updated_at).where(_ranges.c.id == _versions.c.range_id).scalar_subquery()
+    session.execute(
+        update(_versions)
+        .where(_versions.c.range_id.in_(select(_ranges.c.id).where(*criteria)), _versions.c.valid_to.is_(None))
+        .values(valid_to=written_at)
+    )
+    session.execute(insert(_versions).from_select(
+        ('range_id', *VERSIONED_FIELDS, 'valid_from'),
+        select(_ranges.c.id, *(_ranges.c[field] for field in VERSIONED_FIELDS), _ranges.c.updated_at)
+        .where(*criteria)
+    ))
+
+
+def close_versions(session, at, *criteria):
+    # Called before the ranges matching criteria are deleted
+    session.execute(
+        update(_versions)
+        .where(_versions.c.range_id.in_(select(_ranges.c.id).where(*criteria)), _versions.c.valid_to.is_(None))
+        .values(valid_to=at)
+    )
+
+
+def in_force(as_of):
+    # Versions whose [valid_from, valid_to) contains as_of
+    return (
+        ReferenceRangeVersion.valid_from <= as_of,
+        or_(ReferenceRangeVersion.valid_to.is_(None), ReferenceRangeVersion.valid_to > as_of)
+    )
+
+
+def parse_as_of(value):
+    try:
+        return parse_since(value)
+    except (TypeError, ValueError):
+        raise ValueError("as_of must be an ISO 8601 timestamp")
+
+
+def history_version(session, user_id):
+    # (versions, last id, closed versions, last close): moves whenever a
+    # version is opened or closed
+    return tuple(session.execute(
+        select(
+            func.count(ReferenceRangeVersion.id), func.max(ReferenceRangeVersion.id),
+            func.count(ReferenceRangeVersion.valid_to), func.max(ReferenceRangeVersion.valid_to)
+        ).where(ReferenceRangeVersion.created_by == user_id)
+    ).one())
+
+
+class AnalyteHistory:
+    # Every version of one analyte. Between consecutive boundaries (the
+    # times its versions open or close) the set in force cannot change, so
+    # each such period maps to one AnalyteRanges, built on first use.
+
+    def __init__(self, slots, periods):
+        self.slots = slots
+        self.boundaries = sorted({t for slot in slots for t in periods[slot] if t is not None})
+        self._periods = {}
+
+    def at(self, as_of, periods, strata):
+        period = bisect_right(self.boundaries, as_of)
+        if period not in self._periods:
+            live = [slot for slot in self.slots
+                    if periods[slot][0] <= as_of and (periods[slot][1] is None or as_of < periods[slot][1])]
+            self._periods[period] = AnalyteRanges(live, strata) if live else None
+        return self._periods[period]
+
+
+class VersionIndex:
+    # RangeIndex over versions instead of ranges: one slot per version, the
+    # same parallel arrays of canonical bounds, and one AnalyteHistory per
+    # (normalized test name, canonical units). at() gives a view for one
+    # instant that resolves and classifies like a RangeIndex.
+    #
+    # Versions are append-only and only ever change by being closed, so
+    # refreshed() reads just the versions opened or closed since the last
+    # build and rebuilds only their analytes' histories.
+
+    COLUMNS = (
+        ReferenceRangeVersion.id, ReferenceRangeVersion.range_id, ReferenceRangeVersion.test_name,
+        ReferenceRangeVersion.units, ReferenceRangeVersion.min_value, ReferenceRangeVersion.max_value,
+        ReferenceRangeVersion.sex, ReferenceRangeVersion.age_min, ReferenceRangeVersion.age_max,
+        ReferenceRangeVersion.pregnancy, ReferenceRangeVersion.valid_from, ReferenceRangeVersion.valid_to
+    )
+
+    def __init__(self, rows, version=None):
+        self.version = version
+        self.range_ids = np.empty(0, dtype=np.int64)
+        self.low = np.empty(0, dtype=np.float64)
+        self.high = np.empty(0, dtype=np.float64)
+        self.rows = []
+        self.strata = []
+        self.periods = []
+        self.keys = []
+        self.closed = 0
+        self._slot_by_id = {}
+        self._key_slots = {}
+        self._histories = {}
+        self._extend(rows)
+
+    def _extend(self, rows):
+        changed_keys = set()
+        range_ids, lows, highs = [], [], []
+        for row in rows:
+            (version_id, range_id, test_name, units, min_value, max_value,
+             sex, age_min, age_max, pregnancy, valid_from, valid_to) = row
+            slot = self._slot_by_id.get(version_id)
+            if slot is not None:
+                # Re-read because it was closed since
+                if self.periods[slot][1] is None and valid_to is not None:
+                    self.closed += 1
+                self.periods[slot] = (valid_from, valid_to)
+                changed_keys.add(self.keys[slot])
+                continue
+            slot = len(self.rows)
+            key = range_key(test_name, units)
+            factor = to_canonical(test_name, units)[1]
+            range_ids.append(range_id)
+            lows.append(-math.inf if min_value is None else min_value * factor)
+            highs.append(math.inf if max_value is None else max_value * factor)
+            self.rows.append((range_id, test_name, units, min_value, max_value, sex, age_min, age_max, pregnancy))
+            self.strata.append((sex, age_min, age_max, pregnancy))
+            self.periods.append((valid_from, valid_to))
+            self.keys.append(key)
+            self.closed += valid_to is not None
+            self._slot_by_id[version_id] = slot
+            self._key_slots.setdefault(key, []).append(slot)
+            changed_keys.add(key)
+
+        self.range_ids = np.concatenate([self.range_ids, np.array(range_ids, dtype=np.int64)])
+        self.low = np.concatenate([self.low, np.array(lows, dtype=np.float64)])
+        self.high = np.concatenate([self.high, np.array(highs, dtype=np.float64)])
+        for key in changed_keys:
+            self._histories[key] = AnalyteHistory(self._key_slots[key], self.periods)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def nbytes(self):
+        return (self.range_ids.nbytes + self.low.nbytes + self.high.nbytes
+                + sys.getsizeof(self._histories) + 350 * len(self.rows))
+
+    @classmethod
+    def load(cls, session, user_id, version=None):
+        version = version or history_version(session, user_id)
+        rows = session.query(*cls.COLUMNS).filter(
+            ReferenceRangeVersion.created_by == user_id
+        ).order_by(ReferenceRangeVersion.id)
+        return cls(rows, version)
+
+    @classmethod
+    def current(cls, session, user_id, index=None):
+        version = history_version(session, user_id)
+        if index is None or index.version is None or index.version[1] is None:
+            return cls.load(session, user_id, version)
+        if index.version == version:
+            return index
+        return index.refreshed(session, user_id, version)
+
+    def refreshed(self, session, user_id, version):
+        index = copy.copy(self)
+        index.rows, index.strata, index.keys = list(self.rows), list(self.strata), list(self.keys)
+        index.periods = list(self.periods)
+        index._slot_by_id = dict(self._slot_by_id)
+        index._key_slots = {key: list(slots) for key, slots in self._key_slots.items()}
+        index._histories = dict(self._histories)
+        index.version = version
+
+        _, last_id, _, last_closed = self.version
+        since = [ReferenceRangeVersion.id > last_id]
+        since.append(ReferenceRangeVersion.valid_to.isnot(None) if last_closed is None
+                     else ReferenceRangeVersion.valid_to >= last_closed)
+        index._extend(session.query(*self.COLUMNS).filter(
+            ReferenceRangeVersion.created_by == user_id, or_(*since)
+        ).order_by(ReferenceRangeVersion.id))
+
+        # Ids committed out of order, or a close stamped before last_closed
+        # by a worker with a slower clock, escape the filter above; the
+        # counts catch both
+        if (len(index.rows), index.closed) != (version[0], version[2]):
+            return type(self).load(session, user_id)
+        return index
+
+    def at(self, as_of):
+        return VersionSnapshot(self, as_of)
+
+    def range_for(self, slot):
+        valid_from, valid_to = self.periods[slot]
+        return dict(
+            RangeIndex.range_for(self, slot),
+            valid_from=valid_from.isoformat(),
+            valid_to=valid_to.isoformat() if valid_to is not None else None
+        )
+
+
+class VersionSnapshot:
+    # A VersionIndex as of one instant, with the RangeIndex lookup interface
+
+    def __init__(self, index, as_of):
+        self.index = index
+        self.as_of = as_of
+        self.range_ids, self.low, self.high = index.range_ids, index.low, index.high
+
+    def lookup(self, test_name, units, patient=UNKNOWN_PATIENT):
+        history = self.index._histories.get(range_key(test_name, units))
+        analyte = history.at(self.as_of, self.index.periods, self.index.strata) if history is not None else None
+        if analyte is None:
+            return -1
+        return analyte.resolve(patient, self.index.strata, self.range_ids)
+
+    def range_for(self, slot):
+        return self.index.range_for(slot)
+
+    classify = RangeIndex.classify
@@ -0,0 +1,72 @@
+"""Payload size and encode time per response format and content encoding.
+
+Builds N synthetic range rows shaped like the /api/tests column tuples and
+times serialization (rows, columns, NDJSON) followed by each available
+codec. brotli and zstd rows only appear when their modules are installed.
+
+    python benchmarks/bench_formats.py --rows 1000 10000 100000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.compression import available_codecs  # noqa: E402
+from app.serializers import dumps, reference_range_serializer  # noqa: E402
+
+UNITS = ['mg/dL', 'mmol/L', 'g/dL', 'U/L', '%']
+
+FORMATS = {
+    'json': lambda rows: dumps(reference_range_serializer.many(rows)),
+    'columns': lambda rows: dumps(reference_range_serializer.columnar(rows)),
+    'ndjson': lambda rows: b''.join(dumps(reference_range_serializer.to_dict(row)) + b'\n' for row in rows),
+}
+
+
+def make_rows(count):
+    now = datetime.utcnow()
+    return [
+        (i, f"Analyte {i % 800}", 1.0 + i % 5, 10.0 + i % 7, UNITS[i % len(UNITS)], 1 + i % 12, None, None, now)
+        for i in range(1, count + 1)
+    ]
+
+
+def timed(fn, arg, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(arg)
+        samples.append(time.perf_counter() - start)
+    return result, statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    codecs = available_codecs(['gzip', 'br', 'zstd'])
+    print(f"{'rows':>7} {'format':<8} {'encoding':<9} {'bytes':>10} {'ratio':>6} {'encode ms':>10}")
+    for count in args.rows:
+        rows = make_rows(count)
+        baseline = None
+        for name, serialize in FORMATS.items():
+            body, encode_time = timed(serialize, rows, args.repeat)
+            baseline = baseline or len(body)
+            print(f"{count:>7} {name:<8} {'identity':<9} {len(body):>10} {baseline / len(body):6.1f} "
+                  f"{encode_time * 1000:10.1f}")
+            for codec_name, codec in codecs.items():
+                compressed, compress_time = timed(codec.compress, body, args.repeat)
+                print(f"{count:>7} {name:<8} {codec_name:<9} {len(compressed):>10} "
+                      f"{baseline / len(compressed):6.1f} {(encode_time + compress_time) * 1000:10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Login throughput under concurrency, inline hashing vs the hashing pool.
+
+For each configuration a server is started, a user registered, and a login
+storm driven at /auth/login while a second set of clients reads
+/api/departments. This shows both login throughput and whether the rest of
+the API stays responsive while passwords are being checked.
+
+    DATABASE_URL=sqlite:////tmp/bench.db python benchmarks/bench_login.py -c 32 -d 10
+"""
+import argparse
+import json
+import os
+import threading
+import uuid
+
+from compare_serving import DEFAULT_COMMANDS, free_port, request, start_server
+from loadtest import run_load
+
+CONFIGURATIONS = {
+    'inline': {'PASSWORD_HASH_WORKERS': '0', 'PASSWORD_HASH_MAX_PENDING': '100000'},
+    'pool': {},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('-d', '--duration', type=float, default=10.0)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--server-cmd', default=DEFAULT_COMMANDS['sync'])
+    args = parser.parse_args()
+
+    for name, overrides in CONFIGURATIONS.items():
+        port = free_port()
+        process = start_server(args.server_cmd, port, dict(os.environ, **overrides))
+        try:
+            email = f"login-{uuid.uuid4().hex[:8]}@example.com"
+            request(port, 'POST', '/auth/register', {"email": email, "password": "benchmark"})
+            _, body = request(port, 'POST', '/auth/login', {"email": email, "password": "benchmark"})
+            token = body["access_token"]
+
+            reads = {}
+            reader = threading.Thread(target=lambda: reads.update(run_load(
+                f'http://127.0.0.1:{port}/api/departments', {'Authorization': f'Bearer {token}'},
+                args.readers, args.duration
+            )))
+            reader.start()
+            logins = run_load(
+                f'http://127.0.0.1:{port}/auth/login', {'Content-Type': 'application/json'},
+                args.concurrency, args.duration, method='POST',
+                body=json.dumps({"email": email, "password": "benchmark"})
+            )
+            reader.join()
+        finally:
+            process.terminate()
+            process.wait(timeout=10)
+
+        print(f"[{name}] login: {logins['throughput_rps']:.1f} req/s  p50 {logins['p50_ms']:.1f} ms  "
+              f"p99 {logins['p99_ms']:.1f} ms  rejected/errors {logins['errors']}")
+        print(f"[{name}] reads during storm: {reads['throughput_rps']:.1f} req/s  "
+              f"p50 {reads['p50_ms']:.1f} ms  p99 {reads['p99_ms']:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""pytest-benchmark microbenchmarks for every auth and api route.
+
+Each route is driven in-process through the Flask test client against an
+in-memory SQLite catalog seeded by datagen, so the numbers isolate handler,
+ORM and serialization cost from network and server overhead. Needs the
+pytest-benchmark plugin; the module is skipped without it. Not collected by
+the default test run; pass the file explicitly:
+
+    python -m pytest benchmarks/bench_routes.py --benchmark-autosave
+    python -m pytest benchmarks/bench_routes.py --benchmark-compare --benchmark-compare-fail=median:25%
+
+BENCH_RANGES sets the number of ranges per seeded user (default 2000).
+test_search_p99 fails when warm search p99 exceeds BENCH_SEARCH_P99_MS
+(default 20).
+"""
+import itertools
+import os
+import sys
+from datetime import timedelta
+
+import pytest
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+pytest.importorskip('pytest_benchmark')
+
+from flask_jwt_extended import create_access_token  # noqa: E402
+from datagen import ANALYTES, PASSWORD, seed  # noqa: E402
+from loadtest import percentile  # noqa: E402
+from app.cache import range_cache  # noqa: E402
+from app.database import Base, SessionLocal, engine  # noqa: E402
+from app.main import create_app  # noqa: E402
+from app.models import ReferenceRange  # noqa: E402
+
+RANGES = int(os.getenv('BENCH_RANGES', 2000))
+SEARCH_P99_MS = float(os.getenv('BENCH_SEARCH_P99_MS', 20))
+_unique = itertools.count()
+
+
+@pytest.fixture(scope='module')
+def app():
+    app = create_app()
+    app.config['TESTING'] = True
+    Base.metadata.create_all(bind=engine)
+    yield app
+    Base.metadata.drop_all(bind=engine)
+
+
+@pytest.fixture(scope='module')
+def catalog(app):
+    session = SessionLocal()
+    try:
+        return seed(session, users=2, ranges=RANGES)
+    finally:
+        session.close()
+
+
+@pytest.fixture(scope='module')
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture(scope='module')
+def headers(app, catalog):
+    with app.app_context():
+        token = create_access_token(identity=catalog["user_ids"][0], expires_delta=timedelta(hours=1))
+    return {'Authorization': f'Bearer {token}'}
+
+
+@pytest.fixture(autouse=True)
+def warm_cache():
+    # Every benchmark starts from an empty cache; warm paths fill it on the
+    # first round
+    range_cache.clear()
+
+
+def new_range(catalog, **overrides):
+    name, units, low, high = ANALYTES[next(_unique) % len(ANALYTES)]
+    return {"test_name": name, "min_value": low, "max_value": high, "units": units,
+            "department_id": catalog["department_ids"][0], **overrides}
+
+
+def insert_range(catalog):
+    session = SessionLocal()
+    try:
+        row = ReferenceRange(created_by=catalog["user_ids"][0], **new_range(catalog, test_name="Bench scratch"))
+        session.add(row)
+        session.commit()
+        return row.id
+    finally:
+        session.close()
+
+
+def call(client, method, path, expected=200, **kwargs):
+    response = client.open(path, method=method, **kwargs)
+    assert response.status_code == expected, response.get_data(as_text=True)[:200]
+    return response
+
+
+# -----------------------------
+# /auth
+# -----------------------------
+
+def test_register(benchmark, client):
+    benchmark.pedantic(lambda: call(client, 'POST', '/auth/register', 201, json={
+        "email": f"register{next(_unique)}@example.com", "password": PASSWORD
+    }), rounds=5)
+
+
+def test_login(benchmark, client, catalog):
+    benchmark.pedantic(call, args=(client, 'POST', '/auth/login', 200),
+                       kwargs={"json": {"email": catalog["emails"][0], "password": PASSWORD}}, rounds=5)
+
+
+# -----------------------------
+# Reference range writes
+# -----------------------------
+
+def test_create_range(benchmark, client, catalog, headers):
+    benchmark(lambda: call(client, 'POST', '/api/tests', 201, json=new_range(catalog), headers=headers))
+
+
+def test_bulk_create(benchmark, client, catalog, headers):
+    rows = [new_range(catalog, test_name=f"Bulk {i}") for i in range(100)]
+    benchmark(call, client, 'POST', '/api/tests/bulk', 201, json=rows, headers=headers)
+
+
+def test_update_range(benchmark, client, catalog, headers):
+    test_id = insert_range(catalog)
+    values = itertools.cycle([{"max_value": 10.0}, {"max_value": 11.0}])
+    benchmark(lambda: call(client, 'PUT', f'/api/tests/{test_id}', json=next(values), headers=headers))
+
+
+def test_delete_range(benchmark, client, catalog, headers):
+    def setup():
+        return (client, 'DELETE', f'/api/tests/{insert_range(catalog)}'), {"headers": headers}
+    benchmark.pedantic(call, setup=setup, rounds=50)
+
+
+def test_bulk_update(benchmark, client, headers):
+    values = itertools.cycle([1.0, 2.0])
+    benchmark(lambda: call(client, 'PATCH', '/api/tests/bulk', headers=headers, json={
+        "filter": {"test_name": "Glucose"}, "set": {"min_value": next(values)}
+    }))
+
+
+def test_bulk_delete_dry_run(benchmark, client, headers):
+    benchmark(call, client, 'DELETE', '/api/tests/bulk?dry_run=true', json={"filter": {"test_name": "Sodium"}},
+              headers=headers)
+
+
+# -----------------------------
+# Catalog reads
+# -----------------------------
+
+@pytest.mark.parametrize('query', ['limit=100', 'limit=1000', 'limit=1000&format=columns', 'format=ndjson'])
+def test_list_ranges(benchmark, client, headers, query):
+    benchmark(call, client, 'GET', f'/api/tests?{query}', headers=headers)
+
+
+def test_list_ranges_uncached(benchmark, client, headers):
+    benchmark.pedantic(call, args=(client, 'GET', '/api/tests?limit=1000'), kwargs={"headers": headers},
+                       setup=range_cache.clear, rounds=50)
+
+
+def test_list_ranges_not_modified(benchmark, client, headers):
+    etag = call(client, 'GET', '/api/tests?limit=100', headers=headers).headers['ETag']
+    benchmark(call, client, 'GET', '/api/tests?limit=100', 304, headers=dict(headers, **{'If-None-Match': etag}))
+
+
+def test_export(benchmark, client, headers):
+    pytest.importorskip('pyarrow')
+    benchmark(lambda: call(client, 'GET', '/api/tests/export?format=parquet', headers=headers).get_data())
+
+
+def test_search(benchmark, client, headers):
+    benchmark(call, client, 'GET', '/api/tests/search?q=gluc&units=mmol/L', headers=headers)
+
+
+def test_search_p99(benchmark, client, headers):
+    # The cached trie is checked against the range version on every search;
+    # that round trip plus the lookup has to stay inside the latency budget
+    benchmark.pedantic(call, args=(client, 'GET', '/api/tests/search?q=gluc'), kwargs={"headers": headers},
+                       rounds=500, warmup_rounds=1)
+    if benchmark.stats is None:
+        pytest.skip('benchmarking disabled')
+    p99_ms = percentile(sorted(benchmark.stats.stats.data), 99) * 1000
+    assert p99_ms < SEARCH_P99_MS, f"search p99 {p99_ms:.1f} ms over {SEARCH_P99_MS:g} ms"
+
+
+def test_department_ranges(benchmark, client, catalog, headers):
+    benchmark(call, client, 'GET', f'/api/departments/{catalog["department_ids"][0]}/tests', headers=headers)
+
+
+def test_list_departments(benchmark, client, headers):
+    benchmark(call, client, 'GET', '/api/departments', headers=headers)
+
+
+def test_create_department(benchmark, client, headers):
+    benchmark(lambda: call(client, 'POST', '/api/departments', 201, json={"name": f"Bench {next(_unique)}"},
+                           headers=headers))
+
+
+def test_resolve(benchmark, client, headers):
+    benchmark(call, client, 'GET', '/api/tests/resolve?test_name=Hemoglobin&units=g/dL&age=40&sex=F',
+              headers=headers)
+
+
+def test_classify(benchmark, client, headers):
+    payload = {"patient": {"age": 40, "sex": "F"},
+               "results": [[name, (low + high) / 2, units] for name, units, low, high in ANALYTES] * 50}
+    benchmark(call, client, 'POST', '/api/classify', json=payload, headers=headers)
+
+
+@pytest.mark.parametrize('path', ['/api/cache/stats', '/api/pool/stats'])
+def test_stats(benchmark, client, headers, path):
+    benchmark(call, client, 'GET', path, headers=headers)
@@ -0,0 +1,105 @@
+"""Serialize a user's range list: ORM objects + jsonify vs column tuples + orjson.
+
+Seeds an in-memory SQLite database with N ranges and times the full
+query -> bytes path for the previous implementation (ORM objects, a dict
+comprehension per row, Flask's jsonify) and for app.serializers with each
+available JSON encoder.
+
+    python benchmarks/bench_serialization.py --rows 1000 10000 100000 --repeat 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import jsonify  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+from app.main import create_app  # noqa: E402
+from app.database import SessionLocal, create_db  # noqa: E402
+from app.models import Department, ReferenceRange, User  # noqa: E402
+from app.serializers import JSON_ENCODERS, reference_range_serializer  # noqa: E402
+
+
+def seed(rows):
+    session = SessionLocal()
+    session.query(ReferenceRange).delete()
+    if session.get(User, 1) is None:
+        session.add(User(id=1, email='bench@example.com', password_hash='x'))
+        session.add(Department(id=1, name='Bench'))
+    now = datetime.utcnow()
+    session.execute(insert(ReferenceRange), [{
+        "test_name": f"Analyte {i}",
+        "min_value": 1.0,
+        "max_value": 2.0 + i % 7,
+        "units": "mg/dL",
+        "department_id": 1,
+        "created_by": 1,
+        "created_at": now
+    } for i in range(rows)])
+    session.commit()
+    session.close()
+
+
+def orm_jsonify(session):
+    results = [{
+        "id": t.id,
+        "test_name": t.test_name,
+        "min_value": t.min_value,
+        "max_value": t.max_value,
+        "units": t.units,
+        "department_id": t.department_id,
+        "source_id": t.source_id,
+        "study_id": t.study_id,
+        "created_at": t.created_at.isoformat()
+    } for t in session.query(ReferenceRange).filter_by(created_by=1).all()]
+    return jsonify(results).get_data()
+
+
+def tuples_with(encoder):
+    def run(session):
+        query = reference_range_serializer.query(session).filter_by(created_by=1)
+        return encoder(reference_range_serializer.many(query))
+    return run
+
+
+def time_path(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        session = SessionLocal()
+        start = time.perf_counter()
+        body = fn(session)
+        samples.append(time.perf_counter() - start)
+        session.close()
+    return statistics.median(samples), len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app()
+    create_db()
+    paths = {'orm+jsonify': orm_jsonify}
+    paths.update({f'tuples+{name}': tuples_with(encoder) for name, encoder in JSON_ENCODERS.items()})
+
+    print(f"{'rows':>7} {'path':<16} {'median ms':>10} {'bytes':>10} {'speedup':>8}")
+    with app.app_context():
+        for rows in args.rows:
+            seed(rows)
+            baseline = None
+            for name, fn in paths.items():
+                elapsed, size = time_path(fn, args.repeat)
+                baseline = baseline or elapsed
+                print(f"{rows:>7} {name:<16} {elapsed * 1000:10.1f} {size:10d} {baseline / elapsed:7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Measure worker cold-start time: importing the app and building it.
+
+Each sample runs in a fresh interpreter so import caches do not hide the
+cost, and also reports how many engines/pools the worker ended up with.
+
+    DATABASE_URL=postgresql://... python benchmarks/bench_startup.py --runs 20
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import gc, json, time
+start = time.perf_counter()
+from app.main import create_app
+imported = time.perf_counter()
+app = create_app()
+built = time.perf_counter()
+from sqlalchemy.engine import Engine
+engines = sum(1 for o in gc.get_objects() if isinstance(o, Engine))
+print(json.dumps({"import": imported - start, "create_app": built - imported, "engines": engines}))
+"""
+
+
+def run_once():
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE], cwd=SERVICE_DIR, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    samples = [run_once() for _ in range(args.runs)]
+    for phase in ('import', 'create_app'):
+        times = sorted(s[phase] * 1000 for s in samples)
+        print(f"{phase:>10}: median {statistics.median(times):7.1f} ms  max {times[-1]:7.1f} ms")
+    print(f"{'engines':>10}: {max(s['engines'] for s in samples)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Compare the sync (WSGI) and ASGI serving modes under identical load.
+
+Starts each server against the same database, seeds one user with --rows
+ranges through the API, then drives the same concurrent read load at both.
+The read-through cache is disabled unless --with-cache is given, so the
+numbers reflect time spent waiting on the database.
+
+    DATABASE_URL=postgresql://localhost/refrange python benchmarks/compare_serving.py -c 64 -d 15
+
+Use --sync-cmd to benchmark a production WSGI server instead of the
+threaded dev server, e.g. --sync-cmd "gunicorn -w 4 -b 127.0.0.1:{port} 'app.main:create_app()'".
+"""
+import argparse
+import http.client
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+from loadtest import run_load
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_COMMANDS = {
+    'sync': f"{sys.executable} -m flask --app app.main run --port {{port}} --with-threads",
+    'asgi': f"{sys.executable} -m uvicorn app.asgi:app --port {{port}} --log-level warning",
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def request(port, method, path, payload=None, token=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    conn.request(method, path, body=json.dumps(payload) if payload is not None else None, headers=headers)
+    response = conn.getresponse()
+    data = response.read()
+    conn.close()
+    return response.status, json.loads(data) if data else None
+
+
+def start_server(command, port, env):
+    process = subprocess.Popen(shlex.split(command.format(port=port)), cwd=SERVICE_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"Server did not start: {command}")
+
+
+def seed(port, rows):
+    email = f"bench-{uuid.uuid4().hex[:8]}@example.com"
+    request(port, 'POST', '/auth/register', {"email": email, "password": "benchmark"})
+    _, body = request(port, 'POST', '/auth/login', {"email": email, "password": "benchmark"})
+    token = body["access_token"]
+    _, body = request(port, 'POST', '/api/departments', {"name": f"Bench {uuid.uuid4().hex[:8]}"}, token)
+    dept_id = body["id"]
+    batch = [{
+        "test_name": f"Analyte {i}",
+        "min_value": 1.0,
+        "max_value": 2.0,
+        "units": "mg/dL",
+        "department_id": dept_id
+    } for i in range(rows)]
+    request(port, 'POST', '/api/tests/bulk', batch, token)
+    return token, dept_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('-c', '--concurrency', type=int, default=32)
+    parser.add_argument('-d', '--duration', type=float, default=10.0)
+    parser.add_argument('--with-cache', action='store_true')
+    parser.add_argument('--sync-cmd', default=DEFAULT_COMMANDS['sync'])
+    parser.add_argument('--asgi-cmd', default=DEFAULT_COMMANDS['asgi'])
+    args = parser.parse_args()
+
+    env = dict(os.environ, CACHE_ENABLED='True' if args.with_cache else 'False')
+    commands = {'sync': args.sync_cmd, 'asgi': args.asgi_cmd}
+    token = dept_id = None
+    report = {}
+
+    for mode, command in commands.items():
+        port = free_port()
+        process = start_server(command, port, env)
+        try:
+            if token is None:
+                token, dept_id = seed(port, args.rows)
+            headers = {'Authorization': f'Bearer {token}'}
+            report[mode] = {
+                path: run_load(f'http://127.0.0.1:{port}{path}', headers, args.concurrency, args.duration)
+                for path in ('/api/tests?limit=100', f'/api/departments/{dept_id}/tests')
+            }
+        finally:
+            process.terminate()
+            process.wait(timeout=10)
+
+    print(f"{'mode':<6} {'endpoint':<32} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for mode, endpoints in report.items():
+        for path, stats in endpoints.items():
+            print(f"{mode:<6} {path:<32} {stats['throughput_rps']:9.1f} {stats['p50_ms']:9.1f} "
+                  f"{stats['p95_ms']:9.1f} {stats['p99_ms']:9.1f} {stats['errors']:7d}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Seed a database with synthetic users, departments and reference ranges.
+
+Writes straight through Core inserts, so a large catalog takes seconds
+rather than thousands of POSTs. Every user gets the same password (hashed
+once) so load drivers can log in as any of them. Values are deterministic
+for a given --seed; names carry a run tag so repeated runs can share one
+database.
+
+    DATABASE_URL=sqlite:////tmp/bench.db python benchmarks/datagen.py --users 20 --ranges 5000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert, select  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+from app.config import PASSWORD_HASH_METHOD  # noqa: E402
+from app.database import SessionLocal, create_db  # noqa: E402
+from app.models import Department, ReferenceRange, User  # noqa: E402
+from app.units import canonical_range  # noqa: E402
+
+PASSWORD = 'benchmark'
+
+DEPARTMENTS = ['Chemistry', 'Hematology', 'Immunology', 'Endocrinology', 'Microbiology', 'Toxicology',
+               'Coagulation', 'Urinalysis', 'Serology', 'Blood Bank', 'Molecular', 'Cytology']
+
+# (test name, units, low, high); each user gets these plus numbered variants
+ANALYTES = [
+    ("Glucose", "mg/dL", 70, 99), ("Sodium", "mmol/L", 135, 145), ("Potassium", "mmol/L", 3.5, 5.1),
+    ("Chloride", "mmol/L", 98, 107), ("Calcium", "mg/dL", 8.6, 10.3), ("Creatinine", "mg/dL", 0.7, 1.3),
+    ("Urea Nitrogen", "mg/dL", 7, 20), ("Cholesterol", "mg/dL", 125, 200), ("Triglycerides", "mg/dL", 40, 150),
+    ("Hemoglobin", "g/dL", 12, 17.5), ("Platelets", "10^9/L", 150, 400), ("WBC", "10^9/L", 4, 11),
+    ("ALT", "U/L", 7, 56), ("AST", "U/L", 10, 40), ("Hemoglobin A1c", "%", 4, 5.6), ("Iron", "ug/dL", 60, 170),
+]
+
+# (sex, age_min, age_max, pregnancy) applied to every fifth analyte
+STRATA = [(None, 0, 1, None), (None, 1, 18, None), ('M', 18, None, None), ('F', 18, None, None),
+          ('F', 18, None, True)]
+
+
+def make_ranges(rng, user_id, department_ids, count, now):
+    rows = []
+    for i in range(count):
+        name, units, low, high = ANALYTES[i % len(ANALYTES)]
+        if i >= len(ANALYTES):
+            name = f"{name} {i // len(ANALYTES)}"
+        jitter = rng.uniform(0.9, 1.1)
+        sex, age_min, age_max, pregnancy = STRATA[i % len(STRATA)] if i % 5 == 0 else (None, None, None, None)
+        min_value, max_value = round(low * jitter, 2), round(high * jitter, 2)
+        created_at = now - timedelta(seconds=count - i)
+        rows.append({
+            "test_name": name,
+            "min_value": min_value,
+            "max_value": max_value,
+            "units": units,
+            **canonical_range(name, units, min_value, max_value),
+            "sex": sex,
+            "age_min": age_min,
+            "age_max": age_max,
+            "pregnancy": pregnancy,
+            "department_id": rng.choice(department_ids),
+            "created_by": user_id,
+            "created_at": created_at,
+            "updated_at": created_at,
+        })
+    return rows
+
+
+def seed(session, users=10, departments=len(DEPARTMENTS), ranges=1000, seed=0, chunk_size=5000):
+    # Returns {"emails", "user_ids", "department_ids"} for the rows it added
+    rng = random.Random(seed)
+    tag = f"{seed}-{int(time.time() * 1000):x}"
+    now = datetime.utcnow()
+
+    names = [DEPARTMENTS[i % len(DEPARTMENTS)] + (f" {i // len(DEPARTMENTS)}" if i >= len(DEPARTMENTS) else '')
+             for i in range(departments)]
+    names = [f"{name} ({tag})" for name in names]
+    session.execute(insert(Department), [{"name": name, "description": "Generated"} for name in names])
+    department_ids = session.scalars(select(Department.id).where(Department.name.in_(names))).all()
+
+    password_hash = generate_password_hash(PASSWORD, method=PASSWORD_HASH_METHOD)
+    emails = [f"user{i}-{tag}@example.com" for i in range(users)]
+    session.execute(insert(User), [
+        {"email": email, "password_hash": password_hash, "full_name": f"Benchmark User {i}", "created_at": now}
+        for i, email in enumerate(emails)
+    ])
+    user_ids = session.scalars(select(User.id).where(User.email.in_(emails)).order_by(User.id)).all()
+
+    for user_id in user_ids:
+        rows = make_ranges(rng, user_id, department_ids, ranges, now)
+        for start in range(0, len(rows), chunk_size):
+            session.execute(insert(ReferenceRange), rows[start:start + chunk_size])
+    session.commit()
+    return {"emails": emails, "user_ids": list(user_ids), "department_ids": list(department_ids)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--departments', type=int, default=len(DEPARTMENTS))
+    parser.add_argument('--ranges', type=int, default=1000, help='reference ranges per user')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    create_db()
+    session = SessionLocal()
+    start = time.perf_counter()
+    try:
+        seeded = seed(session, args.users, args.departments, args.ranges, args.seed)
+    finally:
+        session.close()
+    print(f"Seeded {len(seeded['user_ids'])} users x {args.ranges} ranges across "
+          f"{len(seeded['department_ids'])} departments in {time.perf_counter() - start:.1f}s "
+          f"(password: {PASSWORD!r})")
+    for email in seeded['emails'][:3]:
+        print(f"  {email}")
+
+
+if __name__ == '__main__':
+    main()
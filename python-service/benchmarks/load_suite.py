@@ -0,0 +1,187 @@
+"""Concurrent load suite over the auth, CRUD and catalog read routes.
+
+Seeds DATABASE_URL with datagen, starts a server against it (or targets
+--url), logs every seeded user in once, then runs each scenario for
+--duration seconds: login storms, create/update/delete cycles and the read
+paths (lists, departments, search, resolve, classify). Every endpoint is
+reported with p50/p95/p99 and throughput.
+
+With --baseline the run is compared against a stored report and exits 1
+when any endpoint's p95 or p99 grows, or its throughput drops, by more
+than --tolerance, or when it starts failing. Record the baseline on the
+machine that will run the comparison:
+
+    DATABASE_URL=sqlite:////tmp/load.db python benchmarks/load_suite.py --save-baseline baseline.json
+    DATABASE_URL=sqlite:////tmp/load.db python benchmarks/load_suite.py --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from urllib.parse import urlsplit
+
+from compare_serving import DEFAULT_COMMANDS, free_port, start_server
+from datagen import ANALYTES, PASSWORD, SessionLocal, create_db, seed
+from loadtest import Client, run_scenario
+
+LATENCY_KEYS = ('p95_ms', 'p99_ms')
+
+
+def login_scenario(emails):
+    def scenario(client, index):
+        email = emails[random.randrange(len(emails))]
+        client.request('POST /auth/login', 'POST', '/auth/login', {"email": email, "password": PASSWORD})
+    return scenario
+
+
+def crud_scenario(tokens, department_ids):
+    # create -> update -> delete, so the table size stays level over the run
+    def scenario(client, index):
+        headers = {'Authorization': f'Bearer {tokens[index % len(tokens)]}'}
+        name, units, low, high = random.choice(ANALYTES)
+        status, body = client.request('POST /api/tests', 'POST', '/api/tests', {
+            "test_name": f"{name} load {index}",
+            "min_value": low,
+            "max_value": high,
+            "units": units,
+            "department_id": random.choice(department_ids)
+        }, headers=headers)
+        if status != 201:
+            return
+        test_id = json.loads(body)["id"]
+        client.request('PUT /api/tests/<id>', 'PUT', f'/api/tests/{test_id}', {"max_value": high * 1.05},
+                       headers=headers)
+        client.request('DELETE /api/tests/<id>', 'DELETE', f'/api/tests/{test_id}', headers=headers)
+    return scenario
+
+
+def read_scenario(tokens, department_ids):
+    classify = {"patient": {"age": 40, "sex": "F"},
+                "results": [[name, (low + high) / 2, units] for name, units, low, high in ANALYTES]}
+
+    def scenario(client, index):
+        headers = {'Authorization': f'Bearer {tokens[index % len(tokens)]}'}
+        department_id = random.choice(department_ids)
+        client.request('GET /api/tests', 'GET', '/api/tests?limit=100', headers=headers)
+        client.request('GET /api/departments', 'GET', '/api/departments', headers=headers)
+        client.request('GET /api/departments/<id>/tests', 'GET', f'/api/departments/{department_id}/tests',
+                       headers=headers)
+        client.request('GET /api/tests/search', 'GET', '/api/tests/search?q=gluc', headers=headers)
+        client.request('GET /api/tests/resolve', 'GET',
+                       '/api/tests/resolve?test_name=Hemoglobin&units=g/dL&age=40&sex=F', headers=headers)
+        client.request('POST /api/classify', 'POST', '/api/classify', classify, headers=headers)
+    return scenario
+
+
+def compare(report, baseline, tolerance):
+    # Returns one message per regressed endpoint
+    regressions = []
+    for name, base in baseline.get("endpoints", {}).items():
+        current = report["endpoints"].get(name)
+        if current is None or not current["requests"]:
+            regressions.append(f"{name}: no successful requests")
+            continue
+        for key in LATENCY_KEYS:
+            if base[key] and current[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{name}: {key} {current[key]:.1f} > {base[key]:.1f} baseline")
+        if current["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {current['throughput_rps']:.1f} rps < "
+                               f"{base['throughput_rps']:.1f} baseline")
+        if current["errors"] and not base["errors"]:
+            regressions.append(f"{name}: {current['errors']} errors")
+    return regressions
+
+
+def print_report(report, baseline=None):
+    base = (baseline or {}).get("endpoints", {})
+    print(f"{'endpoint':<32} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7} {'p95 vs base':>12}")
+    for name, stats in report["endpoints"].items():
+        delta = ''
+        if base.get(name, {}).get('p95_ms'):
+            delta = f"{(stats['p95_ms'] / base[name]['p95_ms'] - 1) * 100:+.0f}%"
+        print(f"{name:<32} {stats['throughput_rps']:9.1f} {stats['p50_ms']:9.1f} {stats['p95_ms']:9.1f} "
+              f"{stats['p99_ms']:9.1f} {stats['errors']:7d} {delta:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--ranges', type=int, default=2000, help='reference ranges per user')
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help='seconds per scenario')
+    parser.add_argument('--scenarios', nargs='+', default=['login', 'crud', 'read'])
+    parser.add_argument('--url', help='target a running server that uses the same DATABASE_URL')
+    parser.add_argument('--server-cmd', default=DEFAULT_COMMANDS['sync'])
+    parser.add_argument('--baseline', help='fail the run on a regression against this report')
+    parser.add_argument('--save-baseline', help='write this run\'s report to the given path')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    create_db()
+    session = SessionLocal()
+    try:
+        seeded = seed(session, users=args.users, ranges=args.ranges)
+    finally:
+        session.close()
+
+    process = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+    else:
+        port = free_port()
+        process = start_server(args.server_cmd, port, dict(os.environ))
+        base_url = f'http://127.0.0.1:{port}'
+    try:
+        parts = urlsplit(base_url)
+        client = Client(parts.hostname, parts.port or 80)
+        tokens = []
+        for email in seeded["emails"]:
+            status, body = client.request('login', 'POST', '/auth/login', {"email": email, "password": PASSWORD})
+            if status != 200:
+                sys.exit(f"Login failed for {email}: {status} {body}")
+            tokens.append(json.loads(body)["access_token"])
+        client.close()
+
+        scenarios = {
+            'login': login_scenario(seeded["emails"]),
+            'crud': crud_scenario(tokens, seeded["department_ids"]),
+            'read': read_scenario(tokens, seeded["department_ids"]),
+        }
+        endpoints = {}
+        for name in args.scenarios:
+            endpoints.update(run_scenario(base_url, scenarios[name], concurrency=args.concurrency,
+                                          duration=args.duration))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+    report = {
+        "recorded_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "settings": {"users": args.users, "ranges": args.ranges, "concurrency": args.concurrency,
+                     "duration": args.duration, "scenarios": args.scenarios},
+        "endpoints": endpoints,
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline written to {args.save_baseline}")
+    if baseline is not None:
+        regressions = compare(report, baseline, args.tolerance)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} of {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Minimal stdlib HTTP load driver.
+
+Runs N client threads against one URL for a fixed duration and reports
+throughput and latency percentiles. run_scenario drives a multi-step
+scenario instead and reports each step separately (see load_suite.py).
+
+    python benchmarks/loadtest.py http://127.0.0.1:5000/api/tests --token $TOKEN -c 32 -d 10
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+class Client:
+    # One keep-alive connection per worker. request() times the call and
+    # records it under a step name, so one scenario can report several
+    # endpoints separately.
+
+    def __init__(self, host, port, headers=None):
+        self.host, self.port = host, port
+        self.headers = dict(headers or {})
+        self.samples, self.errors = {}, {}
+        self._conn = http.client.HTTPConnection(host, port, timeout=30)
+
+    def request(self, name, method, path, payload=None, body=None, headers=None):
+        request_headers = dict(self.headers, **(headers or {}))
+        if payload is not None:
+            body = json.dumps(payload)
+            request_headers.setdefault('Content-Type', 'application/json')
+        start = time.perf_counter()
+        try:
+            self._conn.request(method, path, body=body, headers=request_headers)
+            response = self._conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.errors[name] = self.errors.get(name, 0) + 1
+            self._conn.close()
+            self._conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            return None, None
+        if response.status >= 400:
+            self.errors[name] = self.errors.get(name, 0) + 1
+        else:
+            self.samples.setdefault(name, []).append(time.perf_counter() - start)
+        return response.status, data
+
+    def close(self):
+        self._conn.close()
+
+
+def run_scenario(base_url, scenario, headers=None, concurrency=16, duration=10.0):
+    # Calls scenario(client, worker_index) in a loop on every worker until
+    # the deadline; returns {step name: summary}
+    parts = urlsplit(base_url)
+    deadline = time.perf_counter() + duration
+    clients = [Client(parts.hostname, parts.port or 80, headers) for _ in range(concurrency)]
+
+    def worker(client, index):
+        while time.perf_counter() < deadline:
+            scenario(client, index)
+        client.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(client, i)) for i, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    names = sorted({name for client in clients for name in (*client.samples, *client.errors)})
+    return {
+        name: summarize(
+            [sample for client in clients for sample in client.samples.get(name, ())],
+            sum(client.errors.get(name, 0) for client in clients),
+            elapsed
+        )
+        for name in names
+    }
+
+
+def run_load(url, headers=None, concurrency=16, duration=10.0, method='GET', body=None):
+    parts = urlsplit(url)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    report = run_scenario(url, lambda client, _: client.request(path, method, path, body=body),
+                          headers, concurrency, duration)
+    return report.get(path, summarize([], 0, duration))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('url')
+    parser.add_argument('--token')
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('-d', '--duration', type=float, default=10.0)
+    args = parser.parse_args()
+
+    headers = {'Authorization': f'Bearer {args.token}'} if args.token else {}
+    print(json.dumps(run_load(args.url, headers, args.concurrency, args.duration), indent=2))
+
+
+if __name__ == '__main__':
+    main()
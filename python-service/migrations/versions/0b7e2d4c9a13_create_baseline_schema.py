@@ -0,0 +1,89 @@
+"""create baseline schema
+
+Revision ID: 0b7e2d4c9a13
+Revises:
+Create Date: 2026-10-18 09:05:12.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b7e2d4c9a13'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# In creation order; foreign keys point backwards only
+BASELINE_TABLES = ['users', 'departments', 'sources', 'studies', 'reference_ranges']
+
+
+def upgrade():
+    # The tables as they stood before the first migration, so an empty
+    # database upgrades to head with no init-db. Databases built by
+    # create_all before migrations existed keep their tables and are only
+    # stamped past this revision.
+    existing = set(sa.inspect(op.get_bind()).get_table_names())
+    if 'users' not in existing:
+        op.create_table(
+            'users',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('email', sa.String(length=120), nullable=False),
+            sa.Column('password_hash', sa.String(length=256), nullable=False),
+            sa.Column('full_name', sa.String(length=255), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('email')
+        )
+    if 'departments' not in existing:
+        op.create_table(
+            'departments',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(length=100), nullable=False),
+            sa.Column('description', sa.Text(), nullable=True),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('name')
+        )
+    if 'sources' not in existing:
+        op.create_table(
+            'sources',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(length=255), nullable=False),
+            sa.Column('url', sa.String(length=255), nullable=True),
+            sa.Column('source_type', sa.String(length=100), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'studies' not in existing:
+        op.create_table(
+            'studies',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(length=255), nullable=False),
+            sa.Column('authors', sa.String(length=500), nullable=True),
+            sa.Column('publication_date', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'reference_ranges' not in existing:
+        op.create_table(
+            'reference_ranges',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('test_name', sa.String(length=255), nullable=False),
+            sa.Column('min_value', sa.Float(), nullable=True),
+            sa.Column('max_value', sa.Float(), nullable=True),
+            sa.Column('units', sa.String(length=50), nullable=True),
+            sa.Column('department_id', sa.Integer(), nullable=False),
+            sa.Column('source_id', sa.Integer(), nullable=True),
+            sa.Column('study_id', sa.Integer(), nullable=True),
+            sa.Column('created_by', sa.Integer(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(['created_by'], ['users.id']),
+            sa.ForeignKeyConstraint(['department_id'], ['departments.id']),
+            sa.ForeignKeyConstraint(['source_id'], ['sources.id']),
+            sa.ForeignKeyConstraint(['study_id'], ['studies.id']),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    for table in reversed(BASELINE_TABLES):
+        op.drop_table(table)
@@ -0,0 +1,45 @@
+"""add reference range indexes
+
+Revision ID: 3f1c2a9b7d10
+Revises: 0b7e2d4c9a13
+Create Date: 2026-10-18 09:12:44.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9b7d10'
+down_revision = '0b7e2d4c9a13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # CONCURRENTLY keeps reference_ranges writable while the indexes build on
+    # PostgreSQL; it has to run outside a transaction. Other dialects ignore it.
+    with op.get_context().autocommit_block():
+        op.create_index('ix_reference_ranges_created_by_id', 'reference_ranges',
+                        ['created_by', 'id'], postgresql_concurrently=True)
+        op.create_index('ix_reference_ranges_department_id_created_by', 'reference_ranges',
+                        ['department_id', 'created_by'], postgresql_concurrently=True)
+        op.create_index('ix_reference_ranges_test_name_lower', 'reference_ranges',
+                        [sa.text('lower(test_name)')], postgresql_concurrently=True)
+
+        if op.get_bind().dialect.name == 'postgresql':
+            op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            op.execute(
+                'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_reference_ranges_test_name_trgm '
+                'ON reference_ranges USING gin (lower(test_name) gin_trgm_ops)'
+            )
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('DROP INDEX IF EXISTS ix_reference_ranges_test_name_trgm')
+    # On SQLite the batch table rebuilds in later downgrades do not carry
+    # expression indexes over, so this one may already be gone
+    op.drop_index('ix_reference_ranges_test_name_lower', table_name='reference_ranges', if_exists=True)
+    op.drop_index('ix_reference_ranges_department_id_created_by', table_name='reference_ranges')
+    op.drop_index('ix_reference_ranges_created_by_id', table_name='reference_ranges')
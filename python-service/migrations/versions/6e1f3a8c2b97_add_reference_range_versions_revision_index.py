@@ -0,0 +1,28 @@
+"""add reference range versions revision index
+
+Revision ID: 6e1f3a8c2b97
+Revises: d8c2f5a17e63
+Create Date: 2026-10-18 19:20:12.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e1f3a8c2b97'
+down_revision = 'd8c2f5a17e63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # List versions count and take the max of versions per user (and
+    # department) on every conditional GET
+    with op.get_context().autocommit_block():
+        op.create_index('ix_reference_range_versions_created_by_department_id', 'reference_range_versions',
+                        ['created_by', 'department_id', 'id'], postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index('ix_reference_range_versions_created_by_department_id', table_name='reference_range_versions')
@@ -0,0 +1,32 @@
+"""add reference range updated_at
+
+Revision ID: 8b2e4d6f1a35
+Revises: 3f1c2a9b7d10
+Create Date: 2026-10-18 10:30:12.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2e4d6f1a35'
+down_revision = '3f1c2a9b7d10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('reference_ranges') as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.execute('UPDATE reference_ranges SET updated_at = created_at WHERE updated_at IS NULL')
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_reference_ranges_created_by_updated_at', 'reference_ranges',
+                        ['created_by', 'updated_at'], postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index('ix_reference_ranges_created_by_updated_at', table_name='reference_ranges')
+    with op.batch_alter_table('reference_ranges') as batch_op:
+        batch_op.drop_column('updated_at')
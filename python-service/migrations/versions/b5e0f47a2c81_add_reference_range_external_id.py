@@ -0,0 +1,31 @@
+"""add reference range external_id
+
+Revision ID: b5e0f47a2c81
+Revises: a7d3c91e5f24
+Create Date: 2026-10-18 15:12:04.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5e0f47a2c81'
+down_revision = 'a7d3c91e5f24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('reference_ranges') as batch_op:
+        batch_op.add_column(sa.Column('external_id', sa.Integer(), nullable=True))
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_reference_ranges_created_by_external_id', 'reference_ranges',
+                        ['created_by', 'external_id'], unique=True, postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index('ix_reference_ranges_created_by_external_id', table_name='reference_ranges')
+    with op.batch_alter_table('reference_ranges') as batch_op:
+        batch_op.drop_column('external_id')
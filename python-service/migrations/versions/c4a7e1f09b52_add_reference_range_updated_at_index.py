@@ -0,0 +1,27 @@
+"""add reference range updated_at index
+
+Revision ID: c4a7e1f09b52
+Revises: 8b2e4d6f1a35
+Create Date: 2026-10-18 11:05:40.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4a7e1f09b52'
+down_revision = '8b2e4d6f1a35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Incremental exports filter the whole catalog on updated_at > watermark
+    with op.get_context().autocommit_block():
+        op.create_index('ix_reference_ranges_updated_at', 'reference_ranges',
+                        ['updated_at'], postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index('ix_reference_ranges_updated_at', table_name='reference_ranges')
@@ -0,0 +1,68 @@
+"""add reference range versions
+
+Revision ID: d8c2f5a17e63
+Revises: b5e0f47a2c81
+Create Date: 2026-10-18 17:40:21.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8c2f5a17e63'
+down_revision = 'b5e0f47a2c81'
+branch_labels = None
+depends_on = None
+
+VERSIONED_COLUMNS = (
+    'test_name, min_value, max_value, units, canonical_units, canonical_min, canonical_max, '
+    'sex, age_min, age_max, pregnancy, department_id, source_id, study_id, created_by'
+)
+
+
+def upgrade():
+    op.create_table(
+        'reference_range_versions',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('range_id', sa.Integer(), nullable=False),
+        sa.Column('test_name', sa.String(length=255), nullable=False),
+        sa.Column('min_value', sa.Float(), nullable=True),
+        sa.Column('max_value', sa.Float(), nullable=True),
+        sa.Column('units', sa.String(length=50), nullable=True),
+        sa.Column('canonical_units', sa.String(length=50), nullable=True),
+        sa.Column('canonical_min', sa.Float(), nullable=True),
+        sa.Column('canonical_max', sa.Float(), nullable=True),
+        sa.Column('sex', sa.String(length=1), nullable=True),
+        sa.Column('age_min', sa.Float(), nullable=True),
+        sa.Column('age_max', sa.Float(), nullable=True),
+        sa.Column('pregnancy', sa.Boolean(), nullable=True),
+        sa.Column('department_id', sa.Integer(), nullable=False),
+        sa.Column('source_id', sa.Integer(), nullable=True),
+        sa.Column('study_id', sa.Integer(), nullable=True),
+        sa.Column('created_by', sa.Integer(), nullable=False),
+        sa.Column('valid_from', sa.DateTime(), nullable=False),
+        sa.Column('valid_to', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+    # Existing ranges start with one open version as of their last write;
+    # earlier history was never recorded
+    op.execute(
+        f"INSERT INTO reference_range_versions (range_id, {VERSIONED_COLUMNS}, valid_from) "
+        f"SELECT id, {VERSIONED_COLUMNS}, COALESCE(updated_at, created_at, CURRENT_TIMESTAMP) "
+        f"FROM reference_ranges"
+    )
+
+    op.create_index('ix_reference_range_versions_created_by_valid_from', 'reference_range_versions',
+                    ['created_by', 'valid_from', 'valid_to'])
+    op.create_index('ix_reference_range_versions_range_id', 'reference_range_versions', ['range_id'])
+    op.create_index('ix_reference_range_versions_open', 'reference_range_versions', ['range_id'], unique=True,
+                    postgresql_where=sa.text('valid_to IS NULL'), sqlite_where=sa.text('valid_to IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_reference_range_versions_open', table_name='reference_range_versions')
+    op.drop_index('ix_reference_range_versions_range_id', table_name='reference_range_versions')
+    op.drop_index('ix_reference_range_versions_created_by_valid_from', table_name='reference_range_versions')
+    op.drop_table('reference_range_versions')
@@ -0,0 +1,32 @@
+"""add reference range canonical units
+
+Revision ID: e93d5b2c7f18
+Revises: c4a7e1f09b52
+Create Date: 2026-10-18 11:40:03.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e93d5b2c7f18'
+down_revision = 'c4a7e1f09b52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Backfill afterwards with `flask normalize-units`; the conversion table
+    # lives in app.units, not in the migration
+    with op.batch_alter_table('reference_ranges') as batch_op:
+        batch_op.add_column(sa.Column('canonical_units', sa.String(length=50), nullable=True))
+        batch_op.add_column(sa.Column('canonical_min', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('canonical_max', sa.Float(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('reference_ranges') as batch_op:
+        batch_op.drop_column('canonical_max')
+        batch_op.drop_column('canonical_min')
+        batch_op.drop_column('canonical_units')
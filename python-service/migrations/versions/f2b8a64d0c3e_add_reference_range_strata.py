@@ -0,0 +1,33 @@
+"""add reference range strata
+
+Revision ID: f2b8a64d0c3e
+Revises: e93d5b2c7f18
+Create Date: 2026-10-18 12:20:51.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b8a64d0c3e'
+down_revision = 'e93d5b2c7f18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # All nullable: existing ranges keep applying to every patient
+    with op.batch_alter_table('reference_ranges') as batch_op:
+        batch_op.add_column(sa.Column('sex', sa.String(length=1), nullable=True))
+        batch_op.add_column(sa.Column('age_min', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('age_max', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('pregnancy', sa.Boolean(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('reference_ranges') as batch_op:
+        batch_op.drop_column('pregnancy')
+        batch_op.drop_column('age_max')
+        batch_op.drop_column('age_min')
+        batch_op.drop_column('sex')
@@ -6,6 +6,7 @@ from flask_jwt_extended import create_access_token
 from app.main import create_app
 from app.database import SessionLocal, Base, engine
 from app.models import User, ReferenceRange, Department, Source, Study
+from app.cache import LRUCache, range_cache
 
 # -----------------------------
 # Fixtures
@@ -25,6 +26,7 @@ def client(app):
 @pytest.fixture(autouse=True)
 def setup_database():
     Base.metadata.create_all(bind=engine)
+    range_cache.clear()
     yield
     Base.metadata.drop_all(bind=engine)
 
@@ -218,3 +220,1674 @@ def test_get_tests_by_department(client, app, test_user, test_department):
     data = response.get_json()
     assert isinstance(data, list)
     assert len(data) >= 2
+
+def test_get_user_tests_paginated(client, app, test_user, test_department):
+    token = get_token(app, identity=test_user)
+    headers = {
+        'Authorization': f'Bearer {token}'
+    }
+    session = SessionLocal()
+    session.add_all([
+        ReferenceRange(
+            test_name=f"Analyte {i}",
+            min_value=1.0,
+            max_value=2.0,
+            units="units",
+            department_id=test_department,
+            created_by=test_user,
+            created_at=datetime.utcnow()
+        ) for i in range(5)
+    ])
+    session.commit()
+    session.close()
+
+    seen = []
+    cursor = None
+    while True:
+        url = '/api/tests?limit=2' + (f'&cursor={cursor}' if cursor else '')
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200, response.get_data(as_text=True)
+        data = response.get_json()
+        assert len(data["items"]) <= 2
+        seen.extend(item["test_name"] for item in data["items"])
+        cursor = data["next_cursor"]
+        if cursor is None:
+            break
+
+    assert seen == [f"Analyte {i}" for i in range(5)]
+
+    response = client.get('/api/tests?cursor=not-a-cursor', headers=headers)
+    assert response.status_code == 400
+
+def test_get_user_tests_ndjson_stream(client, app, test_user, test_department):
+    token = get_token(app, identity=test_user)
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'Accept': 'application/x-ndjson'
+    }
+    session = SessionLocal()
+    session.add_all([
+        ReferenceRange(
+            test_name=f"Analyte {i}",
+            min_value=1.0,
+            max_value=2.0,
+            units="units",
+            department_id=test_department,
+            created_by=test_user,
+            created_at=datetime.utcnow()
+        ) for i in range(3)
+    ])
+    session.commit()
+    session.close()
+
+    response = client.get('/api/tests', headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line)["test_name"] for line in lines] == ["Analyte 0", "Analyte 1", "Analyte 2"]
+
+def test_bulk_create_tests(client, app, test_user, test_department):
+    token = get_token(app, identity=test_user)
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'application/json'
+    }
+    payload = [
+        {"test_name": "Sodium", "min_value": 135.0, "max_value": 145.0, "units": "mmol/L", "department_id": test_department},
+        {"test_name": "Potassium", "min_value": 3.5, "max_value": 5.1, "units": "mmol/L", "department_id": test_department},
+        {"test_name": "Chloride", "units": "mmol/L"}
+    ]
+
+    # Invalid rows reject the whole batch unless skip_invalid is set
+    response = client.post('/api/tests/bulk', headers=headers, data=json.dumps(payload))
+    assert response.status_code == 400
+    data = response.get_json()
+    assert data["inserted"] == 0
+    assert list(data["errors"]) == ["2"]
+
+    response = client.post('/api/tests/bulk?skip_invalid=true&dry_run=true', headers=headers, data=json.dumps(payload))
+    assert response.status_code == 200
+    assert response.get_json()["valid"] == 2
+    session = SessionLocal()
+    assert session.query(ReferenceRange).count() == 0
+    session.close()
+
+    response = client.post('/api/tests/bulk?skip_invalid=true', headers=headers, data=json.dumps(payload))
+    assert response.status_code == 201, response.get_data(as_text=True)
+    assert response.get_json()["inserted"] == 2
+    session = SessionLocal()
+    assert session.query(ReferenceRange).filter_by(created_by=test_user).count() == 2
+    session.close()
+
+def test_bulk_create_tests_csv_and_ndjson(client, app, test_user, test_department):
+    token = get_token(app, identity=test_user)
+    csv_body = (
+        "test_name,min_value,max_value,units,department_id,source_id\n"
+        f"Calcium,8.5,10.2,mg/dL,{test_department},\n"
+        f"Magnesium,1.7,2.2,mg/dL,{test_department},\n"
+    )
+    response = client.post('/api/tests/bulk', data=csv_body, headers={
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'text/csv'
+    })
+    assert response.status_code == 201, response.get_data(as_text=True)
+    assert response.get_json()["inserted"] == 2
+
+    ndjson_body = (
+        json.dumps({"test_name": "Iron", "min_value": 60, "max_value": 170, "units": "ug/dL", "department_id": test_department})
+        + "\n{not json}\n"
+    )
+    response = client.post('/api/tests/bulk?skip_invalid=1', data=ndjson_body, headers={
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'application/x-ndjson'
+    })
+    assert response.status_code == 201, response.get_data(as_text=True)
+    data = response.get_json()
+    assert data["inserted"] == 1
+    assert data["errors"] == {"1": {"_schema": ["Invalid JSON"]}}
+
+def test_classify_results(client, app, test_user, test_department):
+    token = get_token(app, identity=test_user)
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'application/json'
+    }
+    session = SessionLocal()
+    glucose = ReferenceRange(
+        test_name="Glucose",
+        min_value=70.0,
+        max_value=100.0,
+        units="mg/dL",
+        department_id=test_department,
+        created_by=test_user,
+        created_at=datetime.utcnow()
+    )
+    session.add(glucose)
+    session.commit()
+    glucose_id = glucose.id
+    session.close()
+
+    payload = {"results": [
+        {"test_name": "Glucose", "value": 55, "units": "mg/dL"},
+        {"test_name": " glucose ", "value": 85, "units": "MG/DL"},
+        ["Glucose", 140, "mg/dL"],
+        ["Glucose", 5.5, "mmol/L"],
+        ["Glucose", 6.2, "mmol/L"],
+        ["Glucose", 5.5, "mg/24h"]
+    ]}
+    response = client.post('/api/classify', headers=headers, data=json.dumps(payload))
+    assert response.status_code == 200, response.get_data(as_text=True)
+    data = response.get_json()
+    # mmol/L results are compared against the mg/dL range after conversion
+    assert [r["flag"] for r in data["results"]] == ["L", "N", "H", "N", "H", None]
+    assert data["results"][3]["units"] == "mmol/L"
+    assert data["results"][0]["range_id"] == glucose_id
+    assert data["unmatched"] == 1
+
+    response = client.post('/api/classify', headers=headers, data=json.dumps({"results": [["Glucose", "high", "mg/dL"]]}))
+    assert response.status_code == 400
+
+def test_lru_cache_ttl_and_eviction():
+    now = [0.0]
+    cache = LRUCache(max_entries=2, ttl=10, clock=lambda: now[0])
+    cache.set(('a',), 1)
+    cache.set(('b',), 2)
+    assert cache.get(('a',)) == 1
+    cache.set(('c',), 3)
+    # 'b' was least recently used
+    assert cache.get(('b',)) is None
+    now[0] = 11
+    assert cache.get(('a',)) is None
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["expirations"] == 1
+    assert stats["hits"] == 1
+
+    sized = LRUCache(max_entries=10, max_bytes=100, ttl=10)
+    sized.set(('x',), 'x', size=60)
+    sized.set(('y',), 'y', size=60)
+    assert sized.get(('x',)) is None
+    assert sized.stats()["bytes"] == 60
+
+def test_department_tests_cache_invalidated_on_write(client, app, test_user, test_department, monkeypatch):
+    from app import routes
+    token = get_token(app, identity=test_user)
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'application/json'
+    }
+    response = client.get(f'/api/departments/{test_department}/tests', headers=headers)
+    assert response.get_json() == []
+    response = client.get(f'/api/departments/{test_department}/tests', headers=headers)
+    assert response.get_json() == []
+    assert range_cache.stats()["hits"] >= 1
+
+    payload = {
+        "test_name": "Albumin",
+        "min_value": 3.5,
+        "max_value": 5.0,
+        "units": "g/dL",
+        "department_id": test_department
+    }
+    response = client.post('/api/tests', headers=headers, data=json.dumps(payload))
+    assert response.status_code == 201
+    test_id = response.get_json()["id"]
+
+    response = client.get(f'/api/departments/{test_department}/tests', headers=headers)
+    assert [t["test_name"] for t in response.get_json()] == ["Albumin"]
+
+    response = client.delete(f'/api/tests/{test_id}', headers=headers)
+    assert response.status_code == 200, response.get_data(as_text=True)
+    response = client.get(f'/api/departments/{test_department}/tests', headers=headers)
+    assert response.get_json() == []
+
+    response = client.get('/api/departments', headers=headers)
+    assert [d["name"] for d in response.get_json()] == ["Chemistry"]
+    client.post('/api/departments', headers=headers, data=json.dumps({"name": "Hematology"}))
+    response = client.get('/api/departments', headers=headers)
+    assert [d["name"] for d in response.get_json()] == ["Chemistry", "Hematology"]
+
+    # Only the configured admins see cache internals
+    assert client.get('/api/cache/stats', headers=headers).status_code == 403
+    monkeypatch.setattr(routes, 'STATS_ADMIN_IDS', {str(test_user)})
+    response = client.get('/api/cache/stats', headers=headers)
+    assert response.status_code == 200
+    assert response.get_json()["invalidations"] >= 2
+
+def test_request_scoped_session(app):
+    from flask import g
+    from app.database import get_session
+
+    with app.app_context():
+        session = get_session()
+        assert get_session() is session
+    with app.app_context():
+        assert 'db_session' not in g
+
+def test_pool_stats(client, app, test_user, monkeypatch):
+    from app import routes
+    token = get_token(app, identity=test_user)
+    response = client.get('/api/pool/stats', headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 403
+    monkeypatch.setattr(routes, 'STATS_ADMIN_IDS', {str(test_user)})
+    response = client.get('/api/pool/stats', headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200
+    data = response.get_json()
+    assert "checkout_wait_seconds_avg" in data
+    if data["pool_class"] == "InstrumentedQueuePool":
+        assert data["checkouts"] >= 1
+        assert 0.0 <= data["saturation"] <= 1.0
+
+def test_init_db_command(app):
+    Base.metadata.drop_all(bind=engine)
+    result = app.test_cli_runner().invoke(args=['init-db'])
+    assert result.exit_code == 0, result.output
+    from sqlalchemy import inspect
+    assert 'reference_ranges' in inspect(engine).get_table_names()
+
+def test_migrations_round_trip_and_match_models_at_head(app):
+    import os
+    import subprocess
+    import sys
+
+    if engine.url.get_backend_name() == 'sqlite' and engine.url.database in (None, '', ':memory:'):
+        pytest.skip("alembic runs in its own process and cannot see an in-memory database")
+    Base.metadata.drop_all(bind=engine)
+    assert app.test_cli_runner().invoke(args=['init-db']).exit_code == 0
+
+    # A fresh interpreter, like the alembic CLI: env.py alone has to load
+    # the models, or autogenerate sees an empty schema
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def alembic(*args):
+        result = subprocess.run(
+            [sys.executable, '-m', 'alembic', '-c', os.path.join('migrations', 'alembic.ini'), *args],
+            cwd=root, capture_output=True, text=True,
+            env=dict(os.environ, DATABASE_URL=engine.url.render_as_string(hide_password=False))
+        )
+        output = result.stdout + result.stderr
+        assert result.returncode == 0, output
+        return output
+
+    assert "No new upgrade operations detected" in alembic('check')
+    # Every revision also walks back down and up again to the same schema,
+    # and the base revision builds the tables itself: no init-db needed
+    engine.dispose()
+    alembic('downgrade', 'base')
+    from sqlalchemy import inspect
+    assert set(inspect(engine).get_table_names()) <= {'alembic_version'}
+    engine.dispose()
+    alembic('upgrade', 'head')
+    assert "No new upgrade operations detected" in alembic('check')
+
+def test_routes_do_not_scan_reference_ranges(client, app, test_department):
+    from sqlalchemy import event, insert, text
+
+    if engine.dialect.name != 'sqlite':
+        pytest.skip("query plan assertions use SQLite's EXPLAIN QUERY PLAN")
+
+    # Seed a table large enough that a sequential scan would matter
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(insert(User), [
+            {"email": f"user{i}@example.com", "password_hash": "x", "created_at": now} for i in range(1, 51)
+        ])
+        conn.execute(insert(Department), [{"name": f"Dept {i}"} for i in range(10)])
+        conn.execute(insert(ReferenceRange), [{
+            "test_name": f"Analyte {i % 500}",
+            "min_value": 1.0,
+            "max_value": 2.0,
+            "units": "units",
+            "department_id": test_department + i % 10,
+            "created_by": 1 + i % 50,
+            "created_at": now
+        } for i in range(20000)])
+        conn.execute(text("ANALYZE"))
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if 'reference_ranges' in statement and statement.lstrip().split()[0] in ('SELECT', 'UPDATE', 'DELETE'):
+            statements.append((statement, parameters))
+
+    token = get_token(app, identity=1)
+    headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        client.get('/api/tests', headers=headers)
+        first_page = client.get('/api/tests?limit=50', headers=headers).get_json()
+        client.get(f'/api/tests?limit=50&cursor={first_page["next_cursor"]}', headers=headers)
+        client.get('/api/tests?format=ndjson', headers=headers).get_data()
+        client.get(f'/api/departments/{test_department}/tests', headers=headers)
+        client.post('/api/classify', headers=headers, data=json.dumps({"results": [["Analyte 1", 1.5, "units"]]}))
+        test_id = first_page["items"][0]["id"]
+        client.put(f'/api/tests/{test_id}', headers=headers, data=json.dumps({"units": "mg/dL"}))
+        client.delete(f'/api/tests/{test_id}', headers=headers)
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+
+    assert statements
+    with engine.connect() as conn:
+        for statement, parameters in statements:
+            plan = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+            scans = [row[-1] for row in plan if row[-1].startswith('SCAN reference_ranges')]
+            assert not scans, f"{statement!r} scans reference_ranges: {plan}"
+
+def test_search_tests(client, app, test_user, test_department):
+    token = get_token(app, identity=test_user)
+    headers = {
+        'Authorization': f'Bearer {token}'
+    }
+    session = SessionLocal()
+    session.add_all([
+        ReferenceRange(
+            test_name=name,
+            min_value=1.0,
+            max_value=2.0,
+            units="units",
+            department_id=test_department,
+            created_by=test_user,
+            created_at=datetime.utcnow()
+        ) for name in ["Hemoglobin", "Hemoglobin A1c", "Mean Corpuscular Hemoglobin", "Alkaline Phosphatase", "Sodium"]
+    ])
+    session.commit()
+    session.close()
+
+    response = client.get('/api/tests/search?q=hemo', headers=headers)
+    assert response.status_code == 200, response.get_data(as_text=True)
+    results = response.get_json()["results"]
+    assert [r["test_name"] for r in results] == ["Hemoglobin", "Hemoglobin A1c", "Mean Corpuscular Hemoglobin"]
+    assert [r["match"] for r in results] == ["prefix", "prefix", "word_prefix"]
+
+    response = client.get('/api/tests/search?q=hgb', headers=headers)
+    assert response.get_json()["results"][0]["test_name"] == "Hemoglobin"
+    assert response.get_json()["results"][0]["match"] == "exact"
+
+    response = client.get('/api/tests/search?q=alk%20phos', headers=headers)
+    assert [r["test_name"] for r in response.get_json()["results"]] == ["Alkaline Phosphatase"]
+
+    response = client.get('/api/tests/search?q=hemo&limit=1', headers=headers)
+    assert len(response.get_json()["results"]) == 1
+
+    response = client.get('/api/tests/search', headers=headers)
+    assert response.status_code == 400
+
+    # A write from another worker, which cannot invalidate this one's cached
+    # trie, is found on the next search
+    session = SessionLocal()
+    session.add(ReferenceRange(test_name="Potassium", min_value=3.5, max_value=5.1, units="mmol/L",
+                               department_id=test_department, created_by=test_user, created_at=datetime.utcnow()))
+    session.commit()
+    session.close()
+    response = client.get('/api/tests/search?q=potas', headers=headers)
+    assert [r["test_name"] for r in response.get_json()["results"]] == ["Potassium"]
+
+async def call_asgi(asgi_app, path, query='', headers=None, method='GET', body=b'', raw=False, text=False):
+    import asyncio
+
+    scope = {
+        'type': 'http', 'method': method, 'path': path, 'root_path': '', 'scheme': 'http',
+        'query_string': query.encode(), 'server': ('testserver', 80), 'http_version': '1.1',
+        'headers': [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+        + [(b'content-length', str(len(body)).encode())]
+    }
+    messages = []
+    received = False
+
+    async def receive():
+        nonlocal received
+        if received:
+            await asyncio.sleep(3600)
+        received = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi_app(scope, receive, send)
+    status = messages[0]['status']
+    if raw:
+        return status, {k.decode(): v.decode() for k, v in messages[0]['headers']}
+    data = b''.join(m.get('body', b'') for m in messages[1:])
+    if text:
+        return status, data.decode()
+    return status, json.loads(data) if data else None
+
+def test_asgi_mode_matches_sync_payloads(client, app, test_user, test_department):
+    import asyncio
+    pytest.importorskip('aiosqlite')
+    pytest.importorskip('greenlet')
+    from app.asgi import AsyncAPI
+
+    token = get_token(app, identity=test_user)
+    session = SessionLocal()
+    session.add_all([
+        ReferenceRange(
+            test_name=f"Analyte {i}",
+            min_value=1.0,
+            max_value=2.0,
+            units="units",
+            department_id=test_department,
+            created_by=test_user,
+            created_at=datetime.utcnow()
+        ) for i in range(3)
+    ])
+    session.commit()
+    session.close()
+
+    asgi_app = AsyncAPI(app, max_threads=2)
+    auth = {'Authorization': f'Bearer {token}'}
+    etag = client.get('/api/tests', headers=auth).headers['ETag']
+
+    async def scenario():
+        results = []
+        results.append(await call_asgi(asgi_app, '/api/tests', headers=auth))
+        results.append(await call_asgi(asgi_app, '/api/tests', query='limit=2', headers=auth))
+        results.append(await call_asgi(asgi_app, f'/api/departments/{test_department}/tests', headers=auth))
+        # Served by the Flask fallback
+        results.append(await call_asgi(asgi_app, '/api/tests'))
+        results.append(await call_asgi(
+            asgi_app, '/api/departments', method='POST', body=json.dumps({"name": "Hematology"}).encode(),
+            headers={**auth, 'Content-Type': 'application/json'}
+        ))
+        results.append(await call_asgi(asgi_app, '/api/tests', headers={**auth, 'If-None-Match': etag}))
+        # as_of reads are served from the version history by the Flask fallback
+        results.append(await call_asgi(asgi_app, '/api/tests', query=f'as_of={before}', headers=auth))
+        results.append(await call_asgi(asgi_app, f'/api/departments/{test_department}/tests', headers={
+            **auth, 'If-None-Match': department_etag
+        }))
+        return results
+
+    before = (datetime.utcnow() - timedelta(days=1)).isoformat()
+    department_etag = client.get(f'/api/departments/{test_department}/tests', headers=auth).headers['ETag']
+    range_cache.clear()
+    listing, page, by_department, unauthorized, created, not_modified, as_of, department_not_modified = \
+        asyncio.run(scenario())
+    range_cache.clear()
+    assert listing == (200, client.get('/api/tests', headers=auth).get_json())
+    assert page == (200, client.get('/api/tests?limit=2', headers=auth).get_json())
+    assert by_department[1] == client.get(f'/api/departments/{test_department}/tests', headers=auth).get_json()
+    assert unauthorized[0] == 401
+    assert created[0] == 201
+    assert not_modified == (304, None)
+    assert as_of == (200, [])
+    assert department_not_modified == (304, None)
+
+def test_register_and_login_rehashes_legacy_hash(client):
+    from werkzeug.security import generate_password_hash
+    from app.passwords import password_hasher
+
+    response = client.post('/auth/register', json={"email": "new@example.com", "password": "secret123"})
+    assert response.status_code == 201, response.get_data(as_text=True)
+    response = client.post('/auth/login', json={"email": "new@example.com", "password": "secret123"})
+    assert response.status_code == 200
+    assert "access_token" in response.get_json()
+    response = client.post('/auth/login', json={"email": "new@example.com", "password": "wrong"})
+    assert response.status_code == 401
+
+    session = SessionLocal()
+    legacy = User(email='legacy@example.com', password_hash=generate_password_hash('secret123', method='pbkdf2:sha256:1000'))
+    session.add(legacy)
+    session.commit()
+    session.close()
+
+    response = client.post('/auth/login', json={"email": "legacy@example.com", "password": "secret123"})
+    assert response.status_code == 200
+    session = SessionLocal()
+    upgraded = session.query(User).filter_by(email='legacy@example.com').one().password_hash
+    session.close()
+    assert not password_hasher.needs_rehash(upgraded)
+    response = client.post('/auth/login', json={"email": "legacy@example.com", "password": "secret123"})
+    assert response.status_code == 200
+
+def test_login_backpressure(client, monkeypatch):
+    from app import auth_routes
+    from app.passwords import PasswordHasher
+
+    session = SessionLocal()
+    session.add(User(email='busy@example.com', password_hash='scrypt:32768:8:1$salt$hash'))
+    session.commit()
+    session.close()
+
+    hasher = PasswordHasher(workers=0, max_pending=1)
+    monkeypatch.setattr(auth_routes, 'password_hasher', hasher)
+    hasher._slots.acquire()
+    response = client.post('/auth/login', json={"email": "busy@example.com", "password": "secret123"})
+    hasher._slots.release()
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+    # max_pending=0 is no limit, not "reject everything"
+    monkeypatch.setattr(auth_routes, 'password_hasher', PasswordHasher(workers=0, max_pending=0))
+    response = client.post('/auth/login', json={"email": "busy@example.com", "password": "secret123"})
+    assert response.status_code == 401
+
+def test_timed_out_hashes_keep_their_slot():
+    import time
+    from app.passwords import HashingBusy, PasswordHasher, pool_context
+
+    # Pool processes are never forked from the threaded worker
+    assert pool_context().get_start_method() in ('forkserver', 'spawn')
+    hasher = PasswordHasher(workers=1, max_pending=1, timeout=10)
+    try:
+        hasher._run(time.sleep, 0)
+        hasher.timeout = 0.2
+        # The caller gives up, but the pool is still busy with the work
+        with pytest.raises(HashingBusy):
+            hasher._run(time.sleep, 1)
+        assert hasher.stats()["pending"] == 1
+        with pytest.raises(HashingBusy):
+            hasher._run(time.sleep, 0)
+        assert hasher.stats()["rejected"] == 1
+        deadline = time.monotonic() + 10
+        while hasher.stats()["pending"] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        hasher.timeout = 10
+        hasher._run(time.sleep, 0)
+        assert hasher.stats()["pending"] == 0
+    finally:
+        hasher.shutdown()
+
+def test_row_serializers_match_across_encoders(client, app, test_user, test_department):
+    import json
+    from app.serializers import JSON_ENCODERS, reference_range_serializer
+
+    token = get_token(app, identity=test_user)
+    headers = {'Authorization': f'Bearer {token}'}
+    client.post('/api/tests', json={
+        "test_name": "Sodium", "min_value": 135, "max_value": 145, "units": "mmol/L",
+        "department_id": test_department
+    }, headers=headers)
+
+    response = client.get('/api/tests', headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/json'
+    [item] = response.get_json()
+    assert set(item) == set(reference_range_serializer.fields)
+    assert item["test_name"] == "Sodium"
+
+    session = SessionLocal()
+    rows = reference_range_serializer.query(session).all()
+    session.close()
+    encoded = {name: json.loads(encoder(reference_range_serializer.many(rows))) for name, encoder in JSON_ENCODERS.items()}
+    assert all(payload == [item] for payload in encoded.values())
+
+def test_conditional_get_returns_304_until_ranges_change(client, app, test_user, test_department):
+    token = get_token(app, identity=test_user)
+    headers = {'Authorization': f'Bearer {token}'}
+    payload = {"test_name": "Potassium", "min_value": 3.5, "max_value": 5.1, "units": "mmol/L",
+               "department_id": test_department}
+    test_id = client.post('/api/tests', json=payload, headers=headers).get_json()["id"]
+
+    paths = ['/api/tests', '/api/tests?limit=1', f'/api/departments/{test_department}/tests']
+    etags = {}
+    for path in paths:
+        response = client.get(path, headers=headers)
+        assert response.status_code == 200
+        assert response.headers['Last-Modified']
+        etags[path] = response.headers['ETag']
+        response = client.get(path, headers={**headers, 'If-None-Match': etags[path]})
+        assert response.status_code == 304
+        assert response.get_data() == b''
+    assert etags['/api/tests'] != etags['/api/tests?limit=1']
+
+    # Every kind of write invalidates the ETag
+    writes = [
+        lambda: client.post('/api/tests', json=payload, headers=headers),
+        lambda: client.put(f'/api/tests/{test_id}', json={"max_value": 5.2}, headers=headers),
+        lambda: client.delete(f'/api/tests/{test_id}', headers=headers),
+    ]
+    for write in writes:
+        assert write().status_code in (200, 201)
+        for path in paths:
+            response = client.get(path, headers={**headers, 'If-None-Match': etags[path]})
+            assert response.status_code == 200
+            assert response.headers['ETag'] != etags[path]
+            etags[path] = response.headers['ETag']
+
+def test_compression_and_columnar_format(client, app, test_user, test_department):
+    import gzip
+    from app.compression import COMPRESS_MIN_SIZE
+
+    token = get_token(app, identity=test_user)
+    headers = {'Authorization': f'Bearer {token}'}
+    gzip_headers = {**headers, 'Accept-Encoding': 'gzip'}
+
+    # Below the threshold the body goes out as-is
+    response = client.get('/api/tests', headers=gzip_headers)
+    assert 'Content-Encoding' not in response.headers
+    assert 'Accept-Encoding' in response.headers['Vary']
+
+    rows = [{"test_name": f"Analyte {i}", "min_value": 1.0, "max_value": 2.0, "units": "mg/dL",
+             "department_id": test_department} for i in range(50)]
+    assert client.post('/api/tests/bulk', json=rows, headers=headers).status_code == 201
+    plain = client.get('/api/tests', headers=headers)
+    assert len(plain.get_data()) >= COMPRESS_MIN_SIZE
+
+    response = client.get('/api/tests', headers=gzip_headers)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'] == 'W/' + plain.headers['ETag']
+    assert json.loads(gzip.decompress(response.get_data())) == plain.get_json()
+    assert client.get('/api/tests', headers={**gzip_headers, 'If-None-Match': response.headers['ETag']}).status_code == 304
+    assert 'Content-Encoding' not in client.get('/api/tests', headers={**headers, 'Accept-Encoding': 'gzip;q=0'}).headers
+
+    # NDJSON is compressed as it streams
+    response = client.get('/api/tests?format=ndjson', headers=gzip_headers)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    lines = gzip.decompress(response.get_data()).decode().splitlines()
+    assert [json.loads(line) for line in lines] == sorted(plain.get_json(), key=lambda item: item["id"])
+
+    # Columnar: one array per field, same values as the row format
+    columns = client.get('/api/tests?format=columns', headers=headers).get_json()
+    assert set(columns) == set(plain.get_json()[0])
+    assert columns["test_name"] == [item["test_name"] for item in plain.get_json()]
+    page = client.get('/api/tests?format=columns&limit=10', headers=headers).get_json()
+    assert len(page["items"]["id"]) == 10 and page["next_cursor"]
+    by_department = client.get(f'/api/departments/{test_department}/tests?format=columns', headers=headers).get_json()
+    assert len(by_department["id"]) == 50
+
+def test_columnar_export(client, app, test_user, test_department, test_source, test_study, tmp_path, monkeypatch):
+    import io
+    from app import export
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+
+    token = get_token(app, identity=test_user)
+    headers = {'Authorization': f'Bearer {token}'}
+    rows = [{"test_name": f"Analyte {i}", "min_value": 1.0, "max_value": 2.0, "units": "mg/dL",
+             "department_id": test_department, "source_id": test_source, "study_id": test_study} for i in range(25)]
+    assert client.post('/api/tests/bulk', json=rows, headers=headers).status_code == 201
+
+    response = client.get('/api/tests/export?format=parquet', headers=headers)
+    assert response.status_code == 200
+    table = pq.read_table(io.BytesIO(response.get_data()))
+    assert table.num_rows == 25
+    assert set(table.column('department_name').to_pylist()) == {"Chemistry"}
+    assert set(table.column('study_title').to_pylist()) == {"Test Study"}
+    assert not any(table.column('deleted').to_pylist())
+    watermark = response.headers['X-Export-Watermark']
+    assert table.schema.metadata[b'watermark'].decode() == watermark
+
+    # The watermark trails the clock, so rows written within the lag (which
+    # may still have been uncommitted) are exported again next time
+    response = client.get(f'/api/tests/export?format=arrow&since={watermark}', headers=headers)
+    assert pa.ipc.open_stream(response.get_data()).read_all().num_rows == 25
+
+    # Incremental: nothing new since the watermark until a range changes
+    monkeypatch.setattr(export, 'EXPORT_WATERMARK_LAG_SECONDS', 0)
+    watermark = client.get('/api/tests/export?format=arrow', headers=headers).headers['X-Export-Watermark']
+    response = client.get(f'/api/tests/export?format=arrow&since={watermark}', headers=headers)
+    assert pa.ipc.open_stream(response.get_data()).read_all().num_rows == 0
+    first_id, second_id = table.column('id')[0].as_py(), table.column('id')[1].as_py()
+    client.put(f'/api/tests/{first_id}', json={"max_value": 3.0}, headers=headers)
+    response = client.get(f'/api/tests/export?format=arrow&since={watermark}', headers=headers)
+    changed = pa.ipc.open_stream(response.get_data()).read_all()
+    assert changed.column('id').to_pylist() == [first_id]
+    assert changed.column('max_value').to_pylist() == [3.0]
+
+    # Deletes come through as tombstones
+    assert client.delete(f'/api/tests/{second_id}', headers=headers).status_code == 200
+    response = client.get(f'/api/tests/export?format=arrow&since={watermark}', headers=headers)
+    changed = pa.ipc.open_stream(response.get_data()).read_all()
+    assert changed.column('id').to_pylist() == [first_id, second_id]
+    assert changed.column('deleted').to_pylist() == [False, True]
+    assert changed.column('test_name').to_pylist() == ["Analyte 0", None]
+
+    assert client.get('/api/tests/export?format=csv', headers=headers).status_code == 400
+    assert client.get('/api/tests/export?since=yesterday', headers=headers).status_code == 400
+
+    output = tmp_path / 'catalog.arrow'
+    result = app.test_cli_runner().invoke(args=['export-ranges', str(output), '--chunk-size', '10'])
+    assert result.exit_code == 0, result.output
+    assert pa.ipc.open_file(str(output)).read_all().num_rows == 24
+
+def test_bulk_update_and_delete_by_filter(client, app, test_user, test_department):
+    token = get_token(app, identity=test_user)
+    headers = {'Authorization': f'Bearer {token}'}
+    rows = [{"test_name": name, "min_value": 1.0, "max_value": 2.0, "units": "mg/dL",
+             "department_id": test_department} for name in ["Glucose", "Urea", "Creatinine"] * 4]
+    assert client.post('/api/tests/bulk', json=rows, headers=headers).status_code == 201
+
+    # Another user's ranges are never touched
+    other_token = get_token(app, identity=test_user + 1000)
+    other = {'Authorization': f'Bearer {other_token}'}
+    session = SessionLocal()
+    session.add(User(id=test_user + 1000, email='other@example.com', password_hash='x'))
+    session.add(ReferenceRange(test_name="Glucose", min_value=1.0, max_value=2.0, units="mg/dL",
+                               department_id=test_department, created_by=test_user + 1000))
+    session.commit()
+    session.close()
+
+    client.get(f'/api/departments/{test_department}/tests', headers=headers)
+    change = {"filter": {"department_id": test_department, "test_name": ["Glucose", "Urea"]},
+              "set": {"units": "mmol/L"}}
+    response = client.patch('/api/tests/bulk?dry_run=true', json=change, headers=headers)
+    assert response.get_json() == {"matched": 8, "updated": 0, "dry_run": True}
+    response = client.patch('/api/tests/bulk', json=change, headers=headers)
+    assert response.status_code == 200
+    assert response.get_json() == {"matched": 8, "updated": 8, "dry_run": False}
+    units = [t["units"] for t in client.get(f'/api/departments/{test_department}/tests', headers=headers).get_json()]
+    assert sorted(units) == ["mg/dL"] * 4 + ["mmol/L"] * 8
+    assert client.get('/api/tests', headers=other).get_json()[0]["units"] == "mg/dL"
+
+    assert client.patch('/api/tests/bulk', json={"filter": {}, "set": {"units": "x"}}, headers=headers).status_code == 400
+    assert client.patch('/api/tests/bulk', json={"filter": {"test_name": "Urea"}, "set": {}}, headers=headers).status_code == 400
+    assert client.patch('/api/tests/bulk', json={"filter": {"colour": "red"}, "set": {"units": "x"}},
+                        headers=headers).status_code == 400
+
+    response = client.delete('/api/tests/bulk', json={"filter": {"test_name": "Glucose"}}, headers=headers)
+    assert response.get_json() == {"matched": 4, "deleted": 4, "dry_run": False}
+    assert len(client.get('/api/tests', headers=headers).get_json()) == 8
+    assert len(client.get('/api/tests', headers=other).get_json()) == 1
+    response = client.delete('/api/tests/bulk', json={"filter": {"test_name": "Glucose"}}, headers=headers)
+    assert response.get_json() == {"matched": 0, "deleted": 0, "dry_run": False}
+
+def test_unit_conversion_table():
+    from app.units import conversion_factor, to_canonical
+
+    assert to_canonical("Glucose", "mg/dL")[0] == to_canonical("glucose, fasting", "mmol/L")[0] == "mmol/L"
+    assert conversion_factor("Glucose", "mg/dL", "mmol/L") == pytest.approx(0.0555, rel=1e-3)
+    assert conversion_factor("Creatinine", "mg/dL", "µmol/L") == pytest.approx(88.4, rel=1e-3)
+    assert conversion_factor("BUN", "mg/dL", "mmol/L") == pytest.approx(0.357, rel=1e-3)
+    assert conversion_factor("Calcium", "mEq/L", "mmol/L") == pytest.approx(0.5)
+    assert conversion_factor("WBC", "K/uL", "10^9/L") == pytest.approx(1.0)
+    assert conversion_factor("Albumin", "g/dL", "g/L") == pytest.approx(10.0)
+    # Mass and molar units only convert for analytes with a known molar mass
+    assert conversion_factor("Albumin", "g/dL", "mmol/L") is None
+    assert to_canonical("MCV", "fL") == ("fl", 1.0)
+
+def test_canonical_units_are_maintained_on_every_write(client, app, test_user, test_department):
+    from sqlalchemy import insert
+
+    token = get_token(app, identity=test_user)
+    headers = {'Authorization': f'Bearer {token}'}
+    client.post('/api/tests', json={"test_name": "Glucose", "min_value": 70, "max_value": 100, "units": "mg/dL",
+                                    "department_id": test_department}, headers=headers)
+    client.post('/api/tests/bulk', json=[{"test_name": "Creatinine", "min_value": 0.6, "max_value": 1.2,
+                                          "units": "mg/dL", "department_id": test_department}], headers=headers)
+    by_name = {t["test_name"]: t for t in client.get('/api/tests', headers=headers).get_json()}
+    assert by_name["Glucose"]["canonical_units"] == "mmol/L"
+    assert by_name["Glucose"]["canonical_max"] == pytest.approx(5.55, rel=1e-3)
+    assert by_name["Creatinine"]["canonical_min"] == pytest.approx(0.053, rel=1e-2)
+
+    client.put(f'/api/tests/{by_name["Glucose"]["id"]}', json={"units": "mmol/L", "min_value": 3.9, "max_value": 5.6},
+               headers=headers)
+    client.patch('/api/tests/bulk', json={"filter": {"test_name": "Creatinine"},
+                                          "set": {"units": "umol/L", "min_value": 53, "max_value": 106}}, headers=headers)
+    by_name = {t["test_name"]: t for t in client.get('/api/tests', headers=headers).get_json()}
+    assert by_name["Glucose"]["canonical_max"] == pytest.approx(5.6)
+    assert by_name["Creatinine"]["canonical_max"] == pytest.approx(0.106)
+
+    # Rows written around the app (e.g. before the migration) are filled by the CLI
+    from sqlalchemy import select, update
+    from app.models import ReferenceRangeVersion
+    with engine.begin() as conn:
+        conn.execute(insert(ReferenceRange), [{"test_name": "Sodium", "min_value": 135, "max_value": 145,
+                                               "units": "mEq/L", "department_id": test_department,
+                                               "created_by": test_user}])
+        glucose = ReferenceRangeVersion.range_id == by_name["Glucose"]["id"]
+        conn.execute(update(ReferenceRange).where(ReferenceRange.id == by_name["Glucose"]["id"])
+                     .values(canonical_units=None, updated_at=datetime(2020, 1, 1)))
+        conn.execute(update(ReferenceRangeVersion).where(glucose).values(canonical_units=None))
+    etag = client.get('/api/tests', headers=headers).headers['ETag']
+    result = app.test_cli_runner().invoke(args=['normalize-units', '--missing-only'])
+    assert result.exit_code == 0, result.output
+    assert "2 reference ranges" in result.output
+    range_cache.clear()
+    by_name = {t["test_name"]: t for t in client.get('/api/tests', headers=headers).get_json()}
+    assert by_name["Sodium"]["canonical_units"] == "mmol/L"
+    assert by_name["Glucose"]["canonical_units"] == "mmol/L"
+    # Derived columns only: no row is restamped, and the current version is
+    # corrected in place while older ones keep their values
+    assert client.get('/api/tests', headers=headers).headers['ETag'] == etag
+    with engine.connect() as conn:
+        versions = conn.execute(select(ReferenceRangeVersion.canonical_units, ReferenceRangeVersion.valid_to)
+                                .where(glucose).order_by(ReferenceRangeVersion.id)).all()
+    assert [units for units, _ in versions] == [None, "mmol/L"] and versions[-1].valid_to is None
+
+    response = client.get('/api/tests/search?q=creat&units=mg/dL', headers=headers)
+    converted = response.get_json()["results"][0]["converted"]
+    assert converted["units"] == "mg/dL"
+    assert converted["max_value"] == pytest.approx(1.2, rel=1e-2)
+
+def test_interval_tree_matches_linear_scan():
+    import random
+    from app.intervals import IntervalTree
+
+    rng = random.Random(7)
+    intervals = []
+    for item in range(200):
+        low = rng.choice([None, rng.uniform(0, 90)])
+        high = rng.choice([None, (low or 0) + rng.uniform(0.1, 40)])
+        intervals.append((low, high, item))
+    tree = IntervalTree(intervals)
+    for point in [0, 0.5, 1, 17.99, 18, 45, 64.5, 90, 120] + [rng.uniform(0, 130) for _ in range(200)]:
+        expected = {item for low, high, item in intervals
+                    if (low is None or low <= point) and (high is None or point < high)}
+        assert set(tree.query(point)) == expected
+
+def test_stratified_ranges_resolve_per_patient(client, app, test_user, test_department):
+    from app.cache import range_index_key
+    from app.classify import Patient
+
+    token = get_token(app, identity=test_user)
+    headers = {'Authorization': f'Bearer {token}'}
+    hgb = {"test_name": "Hemoglobin", "units": "g/dL", "department_id": test_department}
+    rows = [
+        {**hgb, "min_value": 9.5, "max_value": 13.0, "age_min": 0, "age_max": 1},
+        {**hgb, "min_value": 11.0, "max_value": 14.0, "age_min": 1, "age_max": 18},
+        {**hgb, "min_value": 13.5, "max_value": 17.5, "age_min": 18, "sex": "M"},
+        {**hgb, "min_value": 12.0, "max_value": 15.5, "age_min": 18, "sex": "F"},
+        {**hgb, "min_value": 11.0, "max_value": 15.0, "age_min": 18, "sex": "F", "pregnancy": True},
+    ]
+    sodium = {"test_name": "Sodium", "units": "mmol/L", "department_id": test_department, "min_value": 135, "max_value": 145}
+    assert client.post('/api/tests', json=sodium, headers=headers).status_code == 201
+    assert client.post('/api/tests/bulk', json=rows, headers=headers).status_code == 201
+    bad = {**hgb, "min_value": 1, "max_value": 2, "age_min": 30, "age_max": 20}
+    assert client.post('/api/tests', json=bad, headers=headers).status_code == 400
+
+    def resolve(**params):
+        response = client.get('/api/tests/resolve', query_string={"test_name": "hemoglobin", "units": "g/dL", **params},
+                              headers=headers)
+        return response.get_json().get("min_value") if response.status_code == 200 else response.status_code
+
+    assert resolve(age=0.5) == 9.5
+    assert resolve(age=1, sex="F") == 11.0
+    assert resolve(age=40, sex="M") == 13.5
+    assert resolve(age=40, sex="F") == 12.0
+    assert resolve(age=30, sex="F", pregnant="true") == 11.0
+    # No adult range applies without a sex, and nothing without an age
+    assert resolve(age=40) == 404
+    assert resolve() == 404
+    assert resolve(age=-1) == 400
+
+    payload = {"patient": {"age": 40, "sex": "F"}, "results": [["Hemoglobin", 12.5, "g/dL"], ["Sodium", 150, "mmol/L"]]}
+    data = client.post('/api/classify', json=payload, headers=headers).get_json()
+    assert [r["flag"] for r in data["results"]] == ["N", "H"]
+    payload["patient"] = {"age": 40, "sex": "M"}
+    assert client.post('/api/classify', json=payload, headers=headers).get_json()["results"][0]["flag"] == "L"
+
+    # A write re-reads only rows at or past the index watermark, so the
+    # older Sodium entry is carried over untouched
+    before = range_cache.get(range_index_key(test_user))
+    male_id = before.range_for(before.lookup("Hemoglobin", "g/dL", Patient(age=40, sex="M")))["id"]
+    client.put(f'/api/tests/{male_id}', json={"min_value": 12.0}, headers=headers)
+    assert client.post('/api/classify', json=payload, headers=headers).get_json()["results"][0]["flag"] == "N"
+    after = range_cache.get(range_index_key(test_user))
+    assert after is not before
+    sodium_key = ("sodium", "mmol/L")
+    assert after._analytes[sodium_key] is before._analytes[sodium_key]
+
+    client.delete(f'/api/tests/{male_id}', headers=headers)
+    assert resolve(age=40, sex="M") == 404
+
+def test_out_of_order_commits_move_the_list_version(client, app, test_user, test_department):
+    from sqlalchemy import update
+    from app.models import ReferenceRangeVersion
+    from app.versions import record_versions
+
+    token = get_token(app, identity=test_user)
+    headers = {'Authorization': f'Bearer {token}'}
+    ids = [client.post('/api/tests', json={"test_name": name, "min_value": 135, "max_value": 145, "units": "mmol/L",
+                                           "department_id": test_department}, headers=headers).get_json()["id"]
+           for name in ("Sodium", "Chloride")]
+    classify = lambda: client.post('/api/classify', json={"results": [["Chloride", 148, "mmol/L"]]},
+                                   headers=headers).get_json()["results"][0]["flag"]
+    assert classify() == "H"
+
+    # Two writes stamped in one order that commit in the other; the version
+    # each opens gets its id out of order too
+    def write(range_id, max_value, updated_at, version_id):
+        session = SessionLocal()
+        session.execute(update(ReferenceRange).where(ReferenceRange.id == range_id)
+                        .values(max_value=max_value, updated_at=updated_at))
+        record_versions(session, ReferenceRange.id == range_id)
+        session.execute(update(ReferenceRangeVersion).where(
+            ReferenceRangeVersion.range_id == range_id, ReferenceRangeVersion.valid_to.is_(None)
+        ).values(id=version_id))
+        session.commit()
+        session.close()
+
+    now = datetime.utcnow()
+    write(ids[0], 150, now + timedelta(seconds=5), 100)
+    etag = client.get('/api/tests', headers=headers).headers['ETag']
+    assert classify() == "H"
+    write(ids[1], 150, now, 50)
+    response = client.get('/api/tests', headers={**headers, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert {t["test_name"]: t["max_value"] for t in response.get_json()}["Chloride"] == 150
+    assert classify() == "N"
+
+def test_metrics_endpoint_and_sql_instrumentation(client, app, test_user, test_department, monkeypatch, tmp_path, caplog):
+    import pstats
+    import app.metrics as app_metrics
+    from app.database import get_session
+
+    # Eleven identical SELECTs in one request trip the N+1 detector
+    def lookup_each():
+        session = get_session()
+        for user_id in range(1, 12):
+            session.query(User).filter_by(id=user_id).first()
+        return {"ok": True}
+    app.add_url_rule('/lookup-each', 'lookup_each', lookup_each)
+
+    app_metrics.metrics.reset()
+    token = get_token(app, identity=test_user)
+    headers = {'Authorization': f'Bearer {token}'}
+    client.post('/api/tests', json={"test_name": "Glucose", "min_value": 70, "max_value": 100, "units": "mg/dL",
+                                    "department_id": test_department}, headers=headers)
+    for _ in range(2):
+        assert client.get('/api/tests', headers=headers).status_code == 200
+    client.put('/api/tests/999', json={"min_value": 1}, headers=headers)
+    # init-db runs alembic in-process (test_init_db_command), and alembic's
+    # logging config disables loggers that already exist
+    monkeypatch.setattr(app.logger, 'disabled', False)
+    with caplog.at_level('WARNING'):
+        client.get('/lookup-each')
+    assert any("Possible N+1 in GET /lookup-each: 11 identical SELECTs" in r.getMessage() for r in caplog.records)
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    text = response.get_data(as_text=True)
+    assert 'http_requests_total{method="GET",endpoint="/api/tests",status="200"} 2' in text
+    assert 'http_requests_total{method="PUT",endpoint="/api/tests/<int:test_id>",status="404"} 1' in text
+    assert 'http_request_duration_seconds_count{method="GET",endpoint="/api/tests"} 2' in text
+    assert 'http_request_duration_seconds_bucket{method="GET",endpoint="/api/tests",le="+Inf"} 2' in text
+    assert 'db_statements_per_request_bucket{method="GET",endpoint="/lookup-each",le="10"} 0' in text
+    assert 'db_statements_per_request_bucket{method="GET",endpoint="/lookup-each",le="20"} 1' in text
+    assert 'db_n_plus_one_total{method="GET",endpoint="/lookup-each"} 1' in text
+    assert 'db_n_plus_one_total{method="GET",endpoint="/api/tests"}' not in text
+    for name in ('cache_hits_total', 'cache_entries', 'db_pool_checkouts_total', 'password_hash_pending'):
+        assert f'\n{name} ' in text
+
+    # Without a token only allowlisted addresses may scrape
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.7'}).status_code == 403
+    monkeypatch.setattr(app_metrics, 'METRICS_TOKEN', 'scrape-secret')
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer scrape-secret'}).status_code == 200
+
+    # Profiling is opt-in; the header alone does nothing until it is enabled
+    assert 'X-Profile-Path' not in client.get('/api/tests', headers=dict(headers, **{'X-Profile': '1'})).headers
+    monkeypatch.setattr(app_metrics, 'PROFILE_ENABLED', True)
+    monkeypatch.setattr(app_metrics, 'PROFILE_DIR', str(tmp_path))
+    response = client.get('/api/tests', headers=dict(headers, **{'X-Profile': '1'}))
+    path = response.headers['X-Profile-Path']
+    assert path.startswith(str(tmp_path)) and path.endswith('.prof')
+    assert pstats.Stats(path).total_calls > 0
+    assert 'X-Profile-Path' not in client.get('/api/tests', headers=headers).headers
+
+def test_verified_token_cache_respects_exp(client, app, test_user):
+    import time
+    from app.tokens import token_cache
+
+    token = get_token(app, identity=test_user)
+    headers = {'Authorization': f'Bearer {token}'}
+    hits = token_cache.hits
+    for _ in range(3):
+        assert client.get('/api/tests', headers=headers).status_code == 200
+    assert token_cache.hits - hits == 2
+
+    with app.app_context():
+        short = create_access_token(identity=test_user, expires_delta=timedelta(seconds=1))
+    headers = {'Authorization': f'Bearer {short}'}
+    assert client.get('/api/tests', headers=headers).status_code == 200
+    time.sleep(1.1)
+    response = client.get('/api/tests', headers=headers)
+    assert response.status_code == 401
+    assert response.get_json()["msg"] == "Token has expired"
+
+def test_logout_revokes_token_across_workers(client, app, test_user):
+    import time
+    from types import SimpleNamespace
+    from app.tokens import BloomFilter, RevocationList
+
+    token, other = get_token(app, identity=test_user), get_token(app, identity=test_user)
+    with app.app_context():
+        from flask_jwt_extended import decode_token
+        jti = decode_token(token)['jti']
+    # Another worker's list, already refreshed before the logout
+    worker = RevocationList(refresh_seconds=3600)
+    worker.refresh(force=True)
+
+    assert client.post('/auth/logout', headers={'Authorization': f'Bearer {token}'}).status_code == 200
+    response = client.get('/api/tests', headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 401
+    assert response.get_json()["msg"] == "Token has been revoked"
+    assert client.get('/api/tests', headers={'Authorization': f'Bearer {other}'}).status_code == 200
+
+    # The other worker learns of it on its next refresh
+    from app.models import RevokedToken
+    session = SessionLocal()
+    revoked = session.query(RevokedToken).filter_by(jti=jti).one()
+    revoked.id = 10
+    session.commit()
+    assert not worker.is_revoked(jti)
+    worker.refresh(force=True)
+    assert worker.is_revoked(jti)
+    assert worker.stats()["entries"] == 1
+
+    # A revocation that commits below the id the worker has read past (and
+    # is stamped earlier, by a slower clock) is still picked up, by a full
+    # reload
+    session.add(RevokedToken(id=5, jti='late', user_id=test_user, expires_at=revoked.expires_at,
+                             revoked_at=revoked.revoked_at - timedelta(minutes=5)))
+    session.commit()
+    session.close()
+    worker.refresh(force=True)
+    assert worker.is_revoked('late') and worker.is_revoked(jti)
+    assert worker.stats()["rebuilds"] == 1
+    worker.refresh(force=True)
+    assert worker.stats()["rebuilds"] == 1
+
+    # A logout on this worker that lands while a full reload reads its
+    # snapshot survives the swap to the rebuilt filter
+    def racing_session():
+        session = SessionLocal()
+        execute = session.execute
+
+        def snapshot_then_logout(stmt):
+            rows = execute(stmt).all()
+            logout = SessionLocal()
+            local.revoke(logout, {'jti': 'mid-refresh', 'exp': time.time() + 60}, user_id=test_user)
+            logout.close()
+            session.execute = execute
+            return SimpleNamespace(all=lambda: rows)
+
+        session.execute = snapshot_then_logout
+        return session
+
+    local = RevocationList(session_factory=racing_session, capacity=2, refresh_seconds=3600)
+    local._filter.add('filler')
+    local._filter.add('filler-2')
+    local.refresh(force=True)
+    assert local.stats()["rebuilds"] == 1
+    assert local.might_be_revoked('mid-refresh') and local.is_revoked('mid-refresh')
+
+    bloom = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom.add(f"revoked-{i}")
+    assert all(f"revoked-{i}" in bloom for i in range(1000))
+    assert sum(f"live-{i}" in bloom for i in range(10000)) < 300
+
+def test_token_cache_requires_a_supported_jwt_manager(monkeypatch, test_user, caplog):
+    from flask_jwt_extended import view_decorators
+    import app.tokens as tokens
+
+    # jwt_required decodes through the cached wrapper of the public decode_token
+    assert tokens.supports_decode_cache()
+    create_app()
+    assert view_decorators.decode_token is tokens.decode_token
+
+    # A release that decodes some other way is left alone, uncached
+    def other_decode(*args, **kwargs):
+        return tokens._decode_token(*args, **kwargs)
+
+    monkeypatch.setattr(view_decorators, 'decode_token', other_decode)
+    assert not tokens.supports_decode_cache()
+    fallback_app = create_app()
+    assert view_decorators.decode_token is other_decode
+    token = get_token(fallback_app, identity=test_user)
+    assert fallback_app.test_client().get('/api/tests', headers={'Authorization': f'Bearer {token}'}).status_code == 200
+
+def test_asymmetric_tokens_use_cached_keys(monkeypatch, tmp_path, test_user):
+    pytest.importorskip('cryptography')
+    import jwt
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    import app.tokens as tokens
+
+    public_paths = []
+    for name in ('signing-2026', 'retired-2025'):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        (tmp_path / f'{name}.pem').write_bytes(key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+        (tmp_path / f'{name}.pub').write_bytes(key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo))
+        public_paths.append(str(tmp_path / f'{name}.pub'))
+    monkeypatch.setattr(tokens, 'JWT_ALGORITHM', 'RS256')
+    monkeypatch.setattr(tokens, 'JWT_PRIVATE_KEY_PATH', str(tmp_path / 'signing-2026.pem'))
+    monkeypatch.setattr(tokens, 'JWT_PUBLIC_KEY_PATHS', public_paths)
+
+    rs_app = create_app()
+    client = rs_app.test_client()
+    token = get_token(rs_app, identity=test_user)
+    assert jwt.get_unverified_header(token) == {'alg': 'RS256', 'kid': 'signing-2026', 'typ': 'JWT'}
+    assert client.get('/api/tests', headers={'Authorization': f'Bearer {token}'}).status_code == 200
+
+    # A token signed by a key we do not hold is rejected
+    forged_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    forged = jwt.encode(jwt.decode(token, options={"verify_signature": False}), forged_key, algorithm='RS256',
+                        headers={'kid': 'signing-2026'})
+    assert client.get('/api/tests', headers={'Authorization': f'Bearer {forged}'}).status_code == 422
+    unknown = jwt.encode({"sub": str(test_user)}, forged_key, algorithm='RS256', headers={'kid': 'other'})
+    assert client.get('/api/tests', headers={'Authorization': f'Bearer {unknown}'}).status_code == 422
+
+def test_sync_ranges_with_go_service(client, app, test_user, test_department, tmp_path, monkeypatch):
+    from sqlalchemy import create_engine, insert, select, update
+    from app import sync as sync_module
+    from app.sync import go_metadata, go_ranges
+
+    # Exact counts below; the lag is covered at the end
+    monkeypatch.setattr(sync_module, 'SYNC_WATERMARK_LAG_SECONDS', 0)
+
+    go_url = f"sqlite:///{tmp_path / 'go.db'}"
+    go_engine = create_engine(go_url)
+    go_metadata.create_all(go_engine)
+    created = datetime(2024, 1, 1)
+    with go_engine.begin() as conn:
+        conn.execute(insert(go_ranges), [
+            {"test_name": "Glucose", "min_value": 70, "max_value": 100, "unit": "mg/dL", "category": "Chemistry",
+             "source": "WHO", "created_at": created, "updated_at": created},
+            {"test_name": "Hemoglobin", "min_value": 12, "max_value": 16, "unit": "g/dL", "category": "Hematology",
+             "source": None, "created_at": created, "updated_at": None},
+        ])
+
+    runner = app.test_cli_runner()
+    sync = lambda *args: runner.invoke(args=['sync-ranges', *args, '--go-url', go_url])
+    assert sync('pull').exit_code != 0
+    result = sync('pull', '--user-id', str(test_user), '--chunk-size', '1')
+    assert result.exit_code == 0, result.output
+    assert "2 inserted" in result.output
+    watermark = result.output.split("Watermark: ")[1].split()[0]
+
+    token = get_token(app, identity=test_user)
+    headers = {'Authorization': f'Bearer {token}'}
+    by_name = {t["test_name"]: t for t in client.get('/api/tests', headers=headers).get_json()}
+    departments = {d["name"]: d["id"] for d in client.get('/api/departments', headers=headers).get_json()}
+    # Existing names map onto their rows; new ones are created once
+    assert by_name["Glucose"]["department_id"] == test_department
+    assert by_name["Hemoglobin"]["department_id"] == departments["Hematology"]
+    assert by_name["Glucose"]["canonical_units"] == "mmol/L"
+    session = SessionLocal()
+    assert session.get(Source, by_name["Glucose"]["source_id"]).name == "WHO"
+    assert by_name["Hemoglobin"]["source_id"] is None
+    session.close()
+
+    # Incremental: one changed and one new go-service row, nothing duplicated
+    later = datetime(2024, 2, 1)
+    with go_engine.begin() as conn:
+        conn.execute(update(go_ranges).where(go_ranges.c.test_name == "Glucose").values(max_value=110, updated_at=later))
+        conn.execute(insert(go_ranges).values(test_name="Sodium", min_value=135, max_value=145, unit="mEq/L",
+                                              category="Chemistry", created_at=later))
+    result = sync('pull', '--user-id', str(test_user), '--since', watermark)
+    assert result.exit_code == 0, result.output
+    assert "2 read, 1 inserted, 1 updated" in result.output
+    range_cache.clear()
+    tests = client.get('/api/tests', headers=headers).get_json()
+    assert sorted(t["test_name"] for t in tests) == ["Glucose", "Hemoglobin", "Sodium"]
+    assert {t["test_name"]: t for t in tests}["Glucose"]["max_value"] == 110
+
+    # Pulled rows go back unchanged, so a push does not echo them
+    result = sync('push', '--user-id', str(test_user))
+    assert result.exit_code == 0, result.output
+    assert "3 read, 0 inserted, 0 updated, 3 unchanged" in result.output
+    push_watermark = result.output.split("Watermark: ")[1].split()[0]
+
+    created = client.post('/api/tests', json={"test_name": "Urea", "min_value": 2.5, "max_value": 7.8,
+                                              "units": "mmol/L", "department_id": test_department},
+                          headers=headers).get_json()
+    # The go-service requires both bounds and units; open-ended ranges stay behind
+    session = SessionLocal()
+    session.add(ReferenceRange(test_name="CRP", max_value=5.0, units="mg/L", department_id=test_department,
+                               created_by=test_user))
+    session.commit()
+    session.close()
+    result = sync('push', '--user-id', str(test_user), '--since', push_watermark)
+    assert result.exit_code == 0, result.output
+    assert "2 read, 1 inserted, 0 updated, 0 unchanged, 1 skipped" in result.output
+    with go_engine.connect() as conn:
+        urea = conn.execute(select(go_ranges).where(go_ranges.c.test_name == "Urea")).one()
+    assert (urea.unit, urea.category, urea.source) == ("mmol/L", "Chemistry", None)
+    session = SessionLocal()
+    assert session.get(ReferenceRange, created["id"]).external_id == urea.id
+    session.close()
+
+    push_watermark = result.output.split("Watermark: ")[1].split()[0]
+    client.put(f'/api/tests/{created["id"]}', json={"max_value": 8.0}, headers=headers)
+    result = sync('push', '--user-id', str(test_user), '--since', push_watermark)
+    assert "1 read, 0 inserted, 1 updated" in result.output
+    with go_engine.connect() as conn:
+        assert conn.execute(select(go_ranges.c.max_value).where(go_ranges.c.id == urea.id)).scalar() == 8.0
+        assert len(conn.execute(select(go_ranges.c.id)).all()) == 4
+
+    # Rows stamped before a watermark but committed after the run that
+    # reported it are still picked up: the watermark trails the clock
+    monkeypatch.setattr(sync_module, 'SYNC_WATERMARK_LAG_SECONDS', 60)
+    stamped = lambda seconds_ago: datetime.utcnow() - timedelta(seconds=seconds_ago)
+    with go_engine.begin() as conn:
+        conn.execute(insert(go_ranges).values(test_name="Potassium", min_value=3.5, max_value=5.1, unit="mEq/L",
+                                              category="Chemistry", created_at=stamped(5)))
+    result = sync('pull', '--user-id', str(test_user))
+    watermark = result.output.split("Watermark: ")[1].split()[0]
+    with go_engine.begin() as conn:
+        conn.execute(insert(go_ranges).values(test_name="Chloride", min_value=98, max_value=107, unit="mEq/L",
+                                              category="Chemistry", created_at=stamped(10)))
+    result = sync('pull', '--user-id', str(test_user), '--since', watermark)
+    assert "1 inserted, 0 updated" in result.output
+    range_cache.clear()
+    assert "Chloride" in [t["test_name"] for t in client.get('/api/tests', headers=headers).get_json()]
+
+    result = sync('push', '--user-id', str(test_user))
+    push_watermark = result.output.split("Watermark: ")[1].split()[0]
+    session = SessionLocal()
+    session.add(ReferenceRange(test_name="Calcium", min_value=8.6, max_value=10.3, units="mg/dL",
+                               department_id=test_department, created_by=test_user, updated_at=stamped(10)))
+    session.commit()
+    session.close()
+    result = sync('push', '--user-id', str(test_user), '--since', push_watermark)
+    assert "1 inserted" in result.output
+    with go_engine.connect() as conn:
+        assert conn.execute(select(go_ranges.c.id).where(go_ranges.c.test_name == "Calcium")).all()
+    go_engine.dispose()
+
+def test_reads_route_to_replicas_with_read_your_writes(client, app, test_user, test_department, monkeypatch, tmp_path):
+    from app import database, routes
+    from app.database import SessionRouter
+
+    replica_url = f"sqlite:///{tmp_path / 'replica.db'}"
+    down_url = f"sqlite:///{tmp_path / 'missing' / 'replica.db'}"
+    now = [1000.0]
+    router = SessionRouter([down_url, replica_url], check_seconds=30, read_your_writes=5, clock=lambda: now[0])
+    monkeypatch.setattr(database, 'router', router)
+    monkeypatch.setattr(routes, 'STATS_ADMIN_IDS', {str(test_user)})
+    replica = router.replicas[1].engine
+    Base.metadata.create_all(bind=replica)
+    # The replica has not caught up: it holds a different row than the primary
+    with replica.begin() as conn:
+        conn.execute(Department.__table__.insert(), [{"id": test_department, "name": "Chemistry"}])
+        conn.execute(ReferenceRange.__table__.insert(), [{
+            "test_name": "Replica Glucose", "min_value": 70, "max_value": 100, "units": "mg/dL",
+            "department_id": test_department, "created_by": test_user, "updated_at": datetime(2024, 1, 1)
+        }])
+
+    token = get_token(app, identity=test_user)
+    headers = {'Authorization': f'Bearer {token}'}
+    names = lambda path: [t["test_name"] for t in client.get(path, headers=headers).get_json()]
+    assert names('/api/tests') == ["Replica Glucose"]
+
+    # The writer reads its own write from the primary until the window passes
+    client.post('/api/tests', json={"test_name": "Glucose", "min_value": 70, "max_value": 100, "units": "mg/dL",
+                                    "department_id": test_department}, headers=headers)
+    assert names('/api/tests') == ["Glucose"]
+    assert names(f'/api/departments/{test_department}/tests') == ["Glucose"]
+    now[0] += 6
+    assert names('/api/tests') == ["Replica Glucose"]
+    assert names(f'/api/departments/{test_department}/tests') == ["Replica Glucose"]
+
+    stats = client.get('/api/pool/stats', headers=headers).get_json()["router"]
+    # The unreachable replica failed its check and is skipped
+    assert stats["healthy_replicas"] == 1
+    assert stats["replica_check_failures"] == 1
+    assert stats["replica_reads"] == 3
+    assert stats["sticky_reads"] == 2
+
+    # With no usable replica, reads fall back to the primary
+    router.replicas[1].healthy = False
+    router.replicas[1].next_check = now[0] + 30
+    assert names('/api/tests') == ["Glucose"]
+    assert router.stats()["fallback_reads"] == 1
+    for entry in router.replicas:
+        entry.engine.dispose()
+
+def test_asgi_reads_route_to_replicas(client, app, test_user, test_department, monkeypatch, tmp_path):
+    import asyncio
+    pytest.importorskip('aiosqlite')
+    pytest.importorskip('greenlet')
+    from app import async_database, database
+    from app.asgi import AsyncAPI
+    from app.database import SessionRouter
+
+    now = [1000.0]
+    router = SessionRouter([f"sqlite:///{tmp_path / 'replica.db'}"], read_your_writes=5, clock=lambda: now[0])
+    monkeypatch.setattr(database, 'router', router)
+    replica = router.replicas[0].engine
+    Base.metadata.create_all(bind=replica)
+    with replica.begin() as conn:
+        conn.execute(ReferenceRange.__table__.insert(), [{
+            "test_name": "Replica Glucose", "min_value": 70, "max_value": 100, "units": "mg/dL",
+            "department_id": test_department, "created_by": test_user, "updated_at": datetime(2024, 1, 1)
+        }])
+
+    asgi_app = AsyncAPI(app, max_threads=2)
+    auth = {'Authorization': f'Bearer {get_token(app, identity=test_user)}'}
+    names = lambda response: [t["test_name"] for t in response[1]]
+
+    async def scenario():
+        results = [await call_asgi(asgi_app, '/api/tests', headers=auth)]
+        # A write through the Flask fallback pins this user to the primary
+        await call_asgi(asgi_app, '/api/tests', method='POST', body=json.dumps({
+            "test_name": "Glucose", "min_value": 70, "max_value": 100, "units": "mg/dL",
+            "department_id": test_department
+        }).encode(), headers={**auth, 'Content-Type': 'application/json'})
+        results.append(await call_asgi(asgi_app, '/api/tests', headers=auth))
+        results.append(await call_asgi(asgi_app, f'/api/departments/{test_department}/tests', headers=auth))
+        now[0] += 6
+        results.append(await call_asgi(asgi_app, '/api/tests', query='limit=5', headers=auth))
+        await async_database.dispose_engines()
+        return results
+
+    replicated, own_write, by_department, later = asyncio.run(scenario())
+    assert names(replicated) == ["Replica Glucose"]
+    assert names(own_write) == names(by_department) == ["Glucose"]
+    assert [t["test_name"] for t in later[1]["items"]] == ["Replica Glucose"]
+    assert (router.stats()["replica_reads"], router.stats()["sticky_reads"]) == (2, 2)
+    replica.dispose()
+
+def test_rate_limits_and_concurrency_cap(monkeypatch, test_user, test_department):
+    from app import ratelimit
+    from app.ratelimit import AdmissionControl, MemoryStore
+
+    now = [0.0]
+    admission = AdmissionControl(
+        store=MemoryStore(clock=lambda: now[0]),
+        blueprint_limits={'auth_bp': (2, 2 / 60), 'test_bp': (3, 3 / 60)},
+        route_limits={('POST', '/api/tests'): (1, 1 / 60)},
+        concurrency_limit=1, queue_timeout=0.05, retry_after=2
+    )
+    monkeypatch.setattr(ratelimit, 'admission', admission)
+    app = create_app()
+    app.config['TESTING'] = True
+    client = app.test_client()
+
+    # /auth is limited per client IP
+    login = {"email": "nobody@example.com", "password": "secret"}
+    assert [client.post('/auth/login', json=login).status_code for _ in range(2)] == [401, 401]
+    response = client.post('/auth/login', json=login)
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '30'
+
+    # /api per JWT identity: one user's burst does not spend another's budget
+    session = SessionLocal()
+    session.add(User(id=test_user + 1, email='other@example.com', password_hash='x'))
+    session.commit()
+    session.close()
+    first = {'Authorization': f'Bearer {get_token(app, identity=test_user)}'}
+    second = {'Authorization': f'Bearer {get_token(app, identity=test_user + 1)}'}
+    statuses = [client.get('/api/tests', headers=first).status_code for _ in range(4)]
+    assert statuses == [200, 200, 200, 429]
+    response = client.get('/api/tests', headers=second)
+    assert response.status_code == 200
+    assert response.headers['X-RateLimit-Remaining'] == '2'
+
+    # A route with its own limit has its own bucket
+    payload = {"test_name": "Glucose", "min_value": 70, "max_value": 100, "units": "mg/dL",
+               "department_id": test_department}
+    assert client.post('/api/tests', json=payload, headers=second).status_code == 201
+    assert client.post('/api/tests', json=payload, headers=second).status_code == 429
+    assert client.get('/api/tests', headers=second).status_code == 200
+
+    # Buckets refill over time
+    now[0] += 20
+    assert client.get('/api/tests', headers=first).status_code == 200
+
+    # With every slot taken, requests wait out the queue timeout and are shed
+    admission._slots.acquire()
+    response = client.get('/api/tests', headers=second)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '2'
+    admission._slots.release()
+
+    # Streamed bodies hold their slot until sent
+    response = client.get('/api/tests?format=ndjson', headers=second, buffered=False)
+    assert admission.in_flight == 1
+    response.get_data()
+    response.close()
+    assert admission.in_flight == 0
+    stats = admission.stats()
+    assert (stats["limited"], stats["shed"]) == (3, 1)
+
+def test_asgi_routes_pass_admission_control(monkeypatch, test_user, test_department):
+    import asyncio
+    pytest.importorskip('aiosqlite')
+    pytest.importorskip('greenlet')
+    from app import ratelimit
+    from app.asgi import AsyncAPI
+    from app.ratelimit import AdmissionControl, MemoryStore
+
+    admission = AdmissionControl(
+        store=MemoryStore(clock=lambda: 0.0), blueprint_limits={'test_bp': (2, 2 / 60)}, route_limits={},
+        concurrency_limit=1, queue_timeout=0.05, retry_after=2
+    )
+    monkeypatch.setattr(ratelimit, 'admission', admission)
+    app = create_app()
+    app.config['TESTING'] = True
+    asgi_app = AsyncAPI(app, max_threads=2)
+    auth = {'Authorization': f'Bearer {get_token(app, identity=test_user)}'}
+
+    async def scenario():
+        # Native routes and the Flask fallback (NDJSON) share one bucket
+        responses = [await call_asgi(asgi_app, '/api/tests', headers=auth, raw=True) for _ in range(2)]
+        responses.append(await call_asgi(asgi_app, '/api/tests', query='format=ndjson', headers=auth, raw=True))
+        responses.append(await call_asgi(asgi_app, f'/api/departments/{test_department}/tests', headers=auth,
+                                         raw=True))
+        return responses
+
+    first, second, streamed, department = asyncio.run(scenario())
+    assert [r[0] for r in (first, second, streamed, department)] == [200, 200, 429, 429]
+    assert (first[1]['x-ratelimit-remaining'], department[1]['retry-after']) == ('1', '30')
+    assert admission.in_flight == 0
+
+    # Native routes hold a concurrency slot too
+    admission.store = None
+    admission._slots.acquire()
+    status, headers = asyncio.run(call_asgi(asgi_app, '/api/departments', headers=auth, raw=True))
+    admission._slots.release()
+    assert (status, headers['retry-after']) == (503, '2')
+    assert asyncio.run(call_asgi(asgi_app, '/api/departments', headers=auth))[0] == 200
+    assert admission.in_flight == 0
+    assert (admission.stats()["limited"], admission.stats()["shed"]) == (2, 1)
+
+def test_asgi_requests_queued_for_a_slot_do_not_starve_admitted_ones(monkeypatch, test_user, test_department):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    pytest.importorskip('aiosqlite')
+    pytest.importorskip('greenlet')
+    from app import ratelimit
+    from app.asgi import AsyncAPI
+    from app.ratelimit import AdmissionControl
+
+    admission = AdmissionControl(rate_limits_enabled=False, concurrency_limit=1, queue_timeout=2, retry_after=1)
+    monkeypatch.setattr(ratelimit, 'admission', admission)
+    session = SessionLocal()
+    session.add_all([ReferenceRange(test_name=f"Analyte {i}", min_value=1.0, max_value=2.0, units="mg/dL",
+                                    department_id=test_department, created_by=test_user) for i in range(40)])
+    session.commit()
+    session.close()
+    app = create_app()
+    app.config['TESTING'] = True
+    asgi_app = AsyncAPI(app, max_threads=2)
+    # Compressed, so every admitted request needs the loop's executor
+    auth = {'Authorization': f'Bearer {get_token(app, identity=test_user)}', 'Accept-Encoding': 'gzip'}
+
+    async def scenario():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=1))
+        return await asyncio.gather(*(
+            call_asgi(asgi_app, f'/api/departments/{test_department}/tests', headers=auth, raw=True)
+            for _ in range(4)
+        ))
+
+    responses = asyncio.run(scenario())
+    assert [status for status, _ in responses] == [200] * 4
+    assert all(headers['content-encoding'] == 'gzip' for _, headers in responses)
+    assert (admission.stats()["shed"], admission.in_flight) == (0, 0)
+
+def test_change_feed_long_poll_and_sse(client, app, test_user, test_department, monkeypatch):
+    import threading
+    from sqlalchemy import insert
+    from app import changes
+    from app.changes import change_bus
+
+    token = get_token(app, identity=test_user)
+    headers = {'Authorization': f'Bearer {token}'}
+    session = SessionLocal()
+    other_department = Department(name="Hematology")
+    session.add(other_department)
+    session.commit()
+    other_department_id = other_department.id
+    session.close()
+
+    start = client.get('/api/tests/changes', headers=headers).get_json()
+    assert start["events"] == [] and not start["reset"]
+    cursor = {'Last-Event-ID': start["last_event_id"]}
+
+    payload = {"test_name": "Glucose", "min_value": 70, "max_value": 100, "units": "mg/dL",
+               "department_id": test_department}
+    test_id = client.post('/api/tests', json=payload, headers=headers).get_json()["id"]
+    client.put(f'/api/tests/{test_id}', json={"department_id": other_department_id}, headers=headers)
+    client.post('/api/tests/bulk', json=[dict(payload, test_name="Urea")] * 3, headers=headers)
+    client.delete(f'/api/tests/{test_id}', headers=headers)
+    # Another user's writes are never delivered
+    change_bus.publish(test_user + 1, 'insert', [test_department], [999])
+
+    feed = client.get('/api/tests/changes', headers=dict(headers, **cursor)).get_json()
+    assert [(e["type"], e["ids"], e["count"]) for e in feed["events"]] == [
+        ('insert', [test_id], 1), ('update', [test_id], 1), ('insert', None, 3), ('delete', [test_id], 1)
+    ]
+    assert feed["events"][1]["department_ids"] == sorted([test_department, other_department_id])
+    response = client.get(f'/api/tests/changes?department_id={other_department_id}',
+                          headers=dict(headers, **cursor))
+    assert [e["type"] for e in response.get_json()["events"]] == ['update', 'delete']
+    # Resuming from the last id waits for new events, then returns empty
+    after = {'Last-Event-ID': feed["last_event_id"]}
+    assert client.get('/api/tests/changes?wait=0.05', headers=dict(headers, **after)).get_json()["events"] == []
+
+    # Ids from another process, or older than the ring buffer, reset
+    stale = client.get('/api/tests/changes', headers=dict(headers, **{'Last-Event-ID': 'deadbeef:3'}))
+    assert stale.get_json()["reset"] is True
+
+    # SSE: backlog from Last-Event-ID, then live events, then a resync for a
+    # write this worker never saw (made directly in the database)
+    monkeypatch.setattr(changes, 'CHANGES_HEARTBEAT_SECONDS', 0.05)
+    monkeypatch.setattr(changes, 'CHANGES_STREAM_SECONDS', 0.6)
+
+    def write_elsewhere():
+        with engine.begin() as conn:
+            conn.execute(insert(ReferenceRange), [dict(payload, test_name="Sodium", created_by=test_user)])
+
+    timer = threading.Timer(0.2, write_elsewhere)
+    timer.start()
+    response = client.get('/api/tests/changes', headers=dict(headers, **cursor, Accept='text/event-stream'))
+    timer.join()
+    assert response.mimetype == 'text/event-stream'
+    body = response.get_data(as_text=True)
+    kinds = [line[len('event: '):] for line in body.splitlines() if line.startswith('event: ')]
+    assert kinds == ['insert', 'update', 'insert', 'delete', 'resync']
+    assert f"id: {feed['last_event_id']}\n" in body
+    assert ': keep-alive' in body
+    response.close()
+    assert change_bus.subscribers == 0
+
+def test_asgi_change_feed_holds_no_sync_threads(app, test_user, test_department, monkeypatch):
+    import asyncio
+    pytest.importorskip('aiosqlite')
+    pytest.importorskip('greenlet')
+    from app import changes
+    from app.asgi import AsyncAPI
+    from app.changes import change_bus
+
+    monkeypatch.setattr(changes, 'CHANGES_HEARTBEAT_SECONDS', 0.05)
+    monkeypatch.setattr(changes, 'CHANGES_STREAM_SECONDS', 0.5)
+    # One sync thread: a feed served through the Flask fallback would hold
+    # it and the write below could not run until the feed closed
+    asgi_app = AsyncAPI(app, max_threads=1)
+    auth = {'Authorization': f'Bearer {get_token(app, identity=test_user)}'}
+    cursor = {'Last-Event-ID': change_bus.last_event_id}
+    payload = {"test_name": "Glucose", "min_value": 70, "max_value": 100, "units": "mg/dL",
+               "department_id": test_department}
+
+    async def scenario():
+        streams = [asyncio.ensure_future(call_asgi(asgi_app, '/api/tests/changes', text=True, headers={
+            **auth, **cursor, 'Accept': 'text/event-stream'
+        })) for _ in range(3)]
+        poll = asyncio.ensure_future(call_asgi(asgi_app, '/api/tests/changes', query='wait=5',
+                                               headers={**auth, **cursor}))
+        await asyncio.sleep(0.1)
+        assert change_bus.subscribers == 3
+        created = await asyncio.wait_for(call_asgi(
+            asgi_app, '/api/tests', method='POST', body=json.dumps(payload).encode(),
+            headers={**auth, 'Content-Type': 'application/json'}
+        ), timeout=0.3)
+        return created, await asyncio.gather(*streams), await poll
+
+    created, streams, poll = asyncio.run(scenario())
+    assert created[0] == 201
+    assert poll[0] == 200 and [e["ids"] for e in poll[1]["events"]] == [[created[1]["id"]]]
+    for status, body in streams:
+        assert status == 200
+        assert [line for line in body.splitlines() if line.startswith('event: ')] == ['event: insert']
+        assert ': keep-alive' in body
+    assert change_bus.subscribers == 0
+
+def test_reference_range_versions_as_of(client, app, test_user, test_department):
+    from app.cache import version_index_key
+    from app.models import ReferenceRangeVersion
+
+    token = get_token(app, identity=test_user)
+    headers = {'Authorization': f'Bearer {token}'}
+    before = datetime.utcnow().isoformat()
+
+    payload = {"test_name": "Glucose", "min_value": 70, "max_value": 100, "units": "mg/dL",
+               "department_id": test_department}
+    test_id = client.post('/api/tests', json=payload, headers=headers).get_json()["id"]
+    created = datetime.utcnow().isoformat()
+    assert client.put(f'/api/tests/{test_id}', json={"max_value": 110}, headers=headers).status_code == 200
+    # A PUT that changes nothing opens no version
+    assert client.put(f'/api/tests/{test_id}', json={"max_value": 110}, headers=headers).status_code == 200
+    updated = datetime.utcnow().isoformat()
+    assert client.delete(f'/api/tests/{test_id}', headers=headers).status_code == 200
+    deleted = datetime.utcnow().isoformat()
+
+    def as_of(when, path='/api/tests'):
+        response = client.get(path, query_string={"as_of": when}, headers=headers)
+        assert response.status_code == 200, response.get_data(as_text=True)
+        return response.get_json()
+
+    assert as_of(before) == []
+    [first] = as_of(created)
+    [second] = as_of(updated)
+    assert (first["id"], first["max_value"], second["id"], second["max_value"]) == (test_id, 100, test_id, 110)
+    assert first["valid_to"] == second["valid_from"] and second["valid_to"] is not None
+    assert as_of(updated, f'/api/departments/{test_department}/tests')[0]["max_value"] == 110
+    assert as_of(deleted) == [] and client.get('/api/tests', headers=headers).get_json() == []
+    assert client.get('/api/tests?as_of=yesterday', headers=headers).status_code == 400
+
+    session = SessionLocal()
+    versions = session.query(ReferenceRangeVersion).order_by(ReferenceRangeVersion.id).all()
+    session.close()
+    assert [(v.max_value, v.valid_to is None) for v in versions] == [(100, False), (110, False)]
+    assert versions[0].valid_to == versions[1].valid_from
+
+    # Lookups and classification go through the in-memory version index
+    query = {"test_name": "glucose", "units": "mg/dL"}
+    resolved = client.get('/api/tests/resolve', query_string=dict(query, as_of=created), headers=headers)
+    assert resolved.get_json()["max_value"] == 100 and resolved.get_json()["valid_to"] is not None
+    assert client.get('/api/tests/resolve', query_string=dict(query, as_of=updated),
+                      headers=headers).get_json()["max_value"] == 110
+    assert client.get('/api/tests/resolve', query_string=dict(query, as_of=deleted), headers=headers).status_code == 404
+    assert client.get('/api/tests/resolve', query_string=query, headers=headers).status_code == 404
+    index = range_cache.get(version_index_key(test_user))
+
+    results = [{"test_name": "Glucose", "value": 105, "units": "mg/dL"}]
+    flags = [client.post('/api/classify', json={"results": results, "as_of": when},
+                         headers=headers).get_json()["results"][0]["flag"] for when in (before, created, updated)]
+    assert flags == [None, 'H', 'N']
+    assert range_cache.get(version_index_key(test_user)) is index
+
+    # Bulk writes version every row they touch, and the cached index picks
+    # up only the new versions
+    rows = [{"test_name": name, "min_value": 1, "max_value": 2, "units": "mmol/L", "department_id": test_department}
+            for name in ("Urea", "Creatinine")]
+    assert client.post('/api/tests/bulk', json=rows, headers=headers).status_code == 201
+    inserted = datetime.utcnow().isoformat()
+    assert client.patch('/api/tests/bulk', json={"filter": {"test_name": "Urea"}, "set": {"max_value": 3}},
+                        headers=headers).status_code == 200
+    assert client.delete('/api/tests/bulk', json={"filter": {"test_name": "Creatinine"}},
+                         headers=headers).status_code == 200
+    assert [(r["test_name"], r["max_value"]) for r in as_of(inserted)] == [("Urea", 2), ("Creatinine", 2)]
+    assert [(r["test_name"], r["max_value"]) for r in as_of(datetime.utcnow().isoformat())] == [("Urea", 3)]
+    results = [{"test_name": "Urea", "value": 2.5, "units": "mmol/L"},
+               {"test_name": "Creatinine", "value": 1.5, "units": "mmol/L"}]
+    classified = client.post('/api/classify', json={"results": results, "as_of": inserted}, headers=headers)
+    assert [r["flag"] for r in classified.get_json()["results"]] == ['H', 'N']
+    refreshed = range_cache.get(version_index_key(test_user))
+    assert refreshed is not index and len(refreshed) == 5